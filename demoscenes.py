@@ -1218,7 +1218,7 @@ def christmas_demo(width=400, height=300):
     world.objects.append(fir_branch)
 
     for i in world.objects:
-        i.divide(7)
+        i.divide_sah(7)
 
     return camera, world
 
@@ -1987,7 +1987,7 @@ def shadow_glamour_shot(width=400, height=160):
 
     world = rt.World()
     light = rt.AreaLight(rt.Point(-1, 2, 4), rt.Vector(2, 0, 0), 10, rt.Vector(0, 2, 0), 10,
-                         True, rt.Color(1.5, 1.5, 1.5))
+                         True, rt.Color(1.5, 1.5, 1.5), adaptive=True)
     world.lights.append(light)
 
     cube = rt.Cube()
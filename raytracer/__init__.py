@@ -6,16 +6,22 @@ from .materials import Pattern, TestPattern, StripePattern, GradientPattern, Rin
 from .texturemap import UVCheckersPattern, UVAlignCheckPattern, spherical_map, planar_map, cylindrical_map, \
                         cube_uv_up, cube_uv_back, cube_uv_down, cube_uv_left, cube_uv_front, cube_uv_right, \
                         CubeMap, UVImagePattern
-from .matrices import matmul4x4, identity4, transpose4x4, inverse4x4, matmul4x1, matmul4xTuple
+from .matrices import matmul4x4, identity4, transpose4x4, inverse4x4, matmul4x1, matmul4xTuple, AffineMatrix
 from .transformations import translation, scaling, reflection, rotation_x, rotation_y, rotation_z, skew, \
                         view_transform, do_transformray, do_transform, chain_transforms
 from .objects import Intersection, IntersectionWithUV, HittableObject, Sphere, Plane, Cube, Cylinder, \
-                        Cone, Triangle, SmoothTriangle, ObjectGroup, CSG, Torus, Volumetric
+                        Cone, Triangle, SmoothTriangle, TriangleMesh, ObjectGroup, CSG, Torus, Volumetric, Instance, \
+                        InstanceHit
 from .world import World, WorldWithSky, HitRecord
-from .canvas import Canvas, mp_render, canvas_to_ppm, canvas_from_ppm, debug_render_pixel
+from .canvas import Canvas, mp_render, canvas_to_ppm, canvas_to_file, canvas_from_ppm, debug_render_pixel, \
+                        RenderPool
 from .perfcounters import getcount_rayforpixel, getcount_objintersecttests, getcount_objintersections, \
                         getcount_colortests, getcount_reflectionrays, getcount_refractionrays, save_raycount
 from .objfile_reader import Parser, GroupInfo
 from .boundingboxes import BoundingBox
+from .batchrays import BatchScene
+from .bvh import bvh_stats
+from .raypacket import RayPacket
+from .texturestore import Texture, TextureRegistry, load_texture
 
 from .unit_tests import run_unit_tests
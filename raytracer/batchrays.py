@@ -0,0 +1,215 @@
+import math
+import numpy as np
+import raytracer as rt
+from .objects import EPSILON, Intersection, IntersectionWithUV, Sphere, Plane, Cube, Triangle, ObjectGroup
+from .world import prepare_computations
+from .perfcounters import increment_colortests
+
+# Batched intersection of primary rays.  A BatchScene flattens the world's spheres, planes, cubes and triangles
+# (including the ones inside groups) into NumPy arrays once, and then intersects a whole tile of camera rays against
+# them at a time.  Only the nearest hit is found this way.  Shading still goes through the scalar World methods,
+# and any ray that needs more than the nearest hit falls back to World.color_at().
+
+# number of triangles intersected against the batch of rays at one time, to bound the size of the temporaries
+TRIANGLECHUNK = 256
+
+
+def batchable(obj):
+    # True if obj, and everything below it, is a primitive the batched intersector understands.
+    if isinstance(obj, ObjectGroup):
+        for child in obj.children:
+            if not batchable(child):
+                return False
+        return True
+    return type(obj) in (Sphere, Plane, Cube) or isinstance(obj, Triangle)
+
+
+def is_affine(mat):
+    return mat[3][0] == 0 and mat[3][1] == 0 and mat[3][2] == 0 and mat[3][3] == 1
+
+
+class BatchScene:
+    __slots__ = ['world', 'leaves', 'spheres', 'planes', 'cubes', 'tri_index', 'tri_p1', 'tri_e1', 'tri_e2',
+                 'others']
+
+    def __init__(self, world):
+        self.world = world
+        self.leaves = []  # every batched primitive; hits are reported as an index into this list
+        self.spheres = []  # (leaf index, world to object matrix) for each sphere
+        self.planes = []
+        self.cubes = []
+        tri_index = []
+        tri_p1 = []
+        tri_e1 = []
+        tri_e2 = []
+        self.others = []  # top-level objects that have to be intersected one ray at a time
+
+        def collect(obj, toobject, toworld):
+            toobject = np.array(obj.inversetransform, dtype=np.float64) @ toobject
+            toworld = toworld @ np.array(obj.transform, dtype=np.float64)
+            if isinstance(obj, ObjectGroup):
+                for child in obj.children:
+                    collect(child, toobject, toworld)
+            elif isinstance(obj, Triangle):
+                # Triangles are moved into world space once, which leaves t, u and v unchanged, as the transforms
+                # are affine.
+                p1 = (toworld @ np.array(obj.p1.arr, dtype=np.float64))[0:3]
+                p2 = (toworld @ np.array(obj.p2.arr, dtype=np.float64))[0:3]
+                p3 = (toworld @ np.array(obj.p3.arr, dtype=np.float64))[0:3]
+                tri_index.append(len(self.leaves))
+                tri_p1.append(p1)
+                tri_e1.append(p2 - p1)
+                tri_e2.append(p3 - p1)
+                self.leaves.append(obj)
+            else:
+                if isinstance(obj, Sphere):
+                    self.spheres.append((len(self.leaves), toobject))
+                elif isinstance(obj, Plane):
+                    self.planes.append((len(self.leaves), toobject))
+                else:
+                    self.cubes.append((len(self.leaves), toobject))
+                self.leaves.append(obj)
+
+        identity = np.identity(4)
+        for obj in world.objects:
+            if batchable(obj) and self.affine_chain(obj):
+                collect(obj, identity, identity)
+            else:
+                self.others.append(obj)
+
+        self.tri_index = np.array(tri_index, dtype=np.int64)
+        self.tri_p1 = np.array(tri_p1, dtype=np.float64).reshape(-1, 3)
+        self.tri_e1 = np.array(tri_e1, dtype=np.float64).reshape(-1, 3)
+        self.tri_e2 = np.array(tri_e2, dtype=np.float64).reshape(-1, 3)
+
+    def affine_chain(self, obj):
+        if not is_affine(obj.transform):
+            return False
+        if isinstance(obj, ObjectGroup):
+            for child in obj.children:
+                if not self.affine_chain(child):
+                    return False
+        return True
+
+    def nearest_hits(self, origins, directions):
+        # returns, for each ray, the smallest positive t, the index of the leaf that was hit (-1 for a miss)
+        # and the u and v of the hit, which are only meaningful for triangles.
+        numrays = len(origins)
+        best_t = np.full(numrays, np.inf)
+        best_leaf = np.full(numrays, -1, dtype=np.int64)
+        best_u = np.zeros(numrays)
+        best_v = np.zeros(numrays)
+
+        def record(t, leaf):
+            closer = t < best_t
+            best_t[closer] = t[closer]
+            best_leaf[closer] = leaf
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for leaf, toobject in self.spheres:
+                ro = origins @ toobject[0:3, 0:3].T + toobject[0:3, 3]
+                rd = directions @ toobject[0:3, 0:3].T
+                a = (rd * rd).sum(axis=1)
+                half_b = (rd * ro).sum(axis=1)
+                c = (ro * ro).sum(axis=1) - 1
+                discriminant = half_b * half_b - a * c
+                sqrtd = np.sqrt(np.maximum(discriminant, 0))
+                t1 = (-half_b - sqrtd) / a
+                t2 = (-half_b + sqrtd) / a
+                t = np.where(t1 > 0, t1, t2)
+                t = np.where((discriminant >= 0) & (t > 0), t, np.inf)
+                record(t, leaf)
+
+            for leaf, toobject in self.planes:
+                oy = origins @ toobject[1, 0:3] + toobject[1, 3]
+                dy = directions @ toobject[1, 0:3]
+                t = -oy / dy
+                t = np.where((np.abs(dy) > EPSILON) & (t > 0), t, np.inf)
+                record(t, leaf)
+
+            for leaf, toobject in self.cubes:
+                ro = origins @ toobject[0:3, 0:3].T + toobject[0:3, 3]
+                rd = directions @ toobject[0:3, 0:3].T
+                # same as check_axis(): an axis the ray is parallel to gives +/- infinity
+                parallel = np.abs(rd) < EPSILON
+                safe_rd = np.where(parallel, 1.0, rd)
+                tlo = np.where(parallel, (-1 - ro) * np.inf, (-1 - ro) / safe_rd)
+                thi = np.where(parallel, (1 - ro) * np.inf, (1 - ro) / safe_rd)
+                tmin = np.minimum(tlo, thi).max(axis=1)
+                tmax = np.maximum(tlo, thi).min(axis=1)
+                t = np.where(tmin > 0, tmin, tmax)
+                t = np.where((tmin <= tmax) & (t > 0), t, np.inf)
+                record(t, leaf)
+
+            # Moller-Trumbore, as in Triangle.local_intersect(), against a chunk of triangles at a time
+            for start in range(0, len(self.tri_index), TRIANGLECHUNK):
+                end = start + TRIANGLECHUNK
+                e1 = self.tri_e1[start:end]
+                e2 = self.tri_e2[start:end]
+                p1 = self.tri_p1[start:end]
+                pvec = np.cross(directions[:, np.newaxis, :], e2[np.newaxis, :, :])
+                det = (e1[np.newaxis, :, :] * pvec).sum(axis=2)
+                f = 1 / det
+                tvec = origins[:, np.newaxis, :] - p1[np.newaxis, :, :]
+                u = f * (tvec * pvec).sum(axis=2)
+                qvec = np.cross(tvec, e1[np.newaxis, :, :])
+                v = f * (directions[:, np.newaxis, :] * qvec).sum(axis=2)
+                t = f * (e2[np.newaxis, :, :] * qvec).sum(axis=2)
+                hit = (np.abs(det) >= EPSILON) & (u >= 0) & (u <= 1) & (v >= 0) & (u + v <= 1) & (t > 0)
+                t = np.where(hit, t, np.inf)
+                nearest = t.argmin(axis=1)
+                rows = np.arange(numrays)
+                t = t[rows, nearest]
+                closer = t < best_t
+                best_t[closer] = t[closer]
+                best_leaf[closer] = self.tri_index[start:end][nearest[closer]]
+                best_u[closer] = u[rows, nearest][closer]
+                best_v[closer] = v[rows, nearest][closer]
+
+        return best_t, best_leaf, best_u, best_v
+
+    def colors_for_rays(self, origins, directions, maxdepth, perfcount=False, spread=0.0):
+        # returns the color seen along each primary ray, as a list of Colors.  spread is the Ray.spread of every
+        # ray, normally the camera's pixel_size.
+        world = self.world
+        best_t, best_leaf, best_u, best_v = self.nearest_hits(origins, directions)
+        colors = []
+        for k in range(len(origins)):
+            ray = rt.Ray(rt.rttuple.point_from_floats(*origins[k].tolist()),
+                         rt.rttuple.vector_from_floats(*directions[k].tolist()), spread=spread)
+            leaf = int(best_leaf[k])
+            hit = None
+            if leaf >= 0:
+                obj = self.leaves[leaf]
+                if isinstance(obj, Triangle):
+                    hit = IntersectionWithUV(obj, float(best_t[k]), float(best_u[k]), float(best_v[k]))
+                else:
+                    hit = Intersection(obj, float(best_t[k]))
+
+            if self.others:
+                if hit is not None:
+                    ray.tmax = hit.t
+                for other in self.others:
+                    otherhit = other.closest_hit(ray)
+                    if otherhit is not None:
+                        hit = otherhit
+                        ray.tmax = hit.t
+                ray.tmax = math.inf
+
+            if hit is None:
+                colors.append(world.background_color(ray))
+            elif hit.objhit.material.transparency != 0:
+                # refraction needs n1 and n2, which come from the full list of intersections along the ray
+                colors.append(world.color_at(ray, maxdepth, perfcount))
+            else:
+                # with no refraction, n1 and n2 are never used, so the list of intersections is just the hit
+                hitrecord = prepare_computations(hit, ray, [hit])
+                if perfcount:
+                    increment_colortests()
+                colors.append(world.shade_hit(hitrecord, maxdepth, perfcount))
+        return colors
+
+
+def can_batch(world):
+    # a world with a volumetric medium changes what every ray sees, so it is always rendered one ray at a time
+    return not world.volumetric.can_interact()
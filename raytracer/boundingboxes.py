@@ -1,6 +1,7 @@
 import math
 import raytracer as rt
 from .objects import check_axis
+from .matrices import AffineMatrix
 
 # Bounding boxes are found in the bonus chapter at http://www.raytracerchallenge.com/bonus/bounding-boxes.html
 
@@ -46,10 +47,24 @@ class BoundingBox():
                 self.boxmin.y <= point.y <= self.boxmax.y and \
                 self.boxmin.z <= point.z <= self.boxmax.z
 
+    def is_finite(self):
+        return not (math.isinf(self.boxmin.x) or math.isinf(self.boxmin.y) or math.isinf(self.boxmin.z) or
+                    math.isinf(self.boxmax.x) or math.isinf(self.boxmax.y) or math.isinf(self.boxmax.z))
+
+    def surface_area(self):
+        dx = self.boxmax.x - self.boxmin.x
+        dy = self.boxmax.y - self.boxmin.y
+        dz = self.boxmax.z - self.boxmin.z
+        if dx < 0 or dy < 0 or dz < 0:
+            return 0.0  # empty box
+        return 2 * (dx * dy + dy * dz + dz * dx)
+
     def contains_box(self, other):
         return self.contains_point(other.boxmin) and self.contains_point(other.boxmax)
 
     def transform(self, matrix):
+        if matrix.__class__ is AffineMatrix and self.is_finite():
+            return self.transform_affine(matrix)
         # transform all 8 points on the cube by the matrix, add them all to a new box
         p1 = self.boxmin
         p2 = rt.Point(self.boxmin.x, self.boxmin.y, self.boxmax.z)
@@ -67,15 +82,42 @@ class BoundingBox():
 
         return new_box
 
+    def transform_affine(self, matrix):
+        # Same box as transform() gives, without making the 8 corners.  Each coordinate of a transformed point is
+        # a sum of one term per axis plus the translation, so its smallest and largest values over the box come
+        # from taking the smaller or larger term on each axis.
+        bmin = self.boxmin.arr
+        bmax = self.boxmax.arr
+        newmin = []
+        newmax = []
+        for row in matrix[0:3]:
+            lo = hi = row[3]
+            for j in range(3):
+                a = row[j] * bmin[j]
+                b = row[j] * bmax[j]
+                if a < b:
+                    lo += a
+                    hi += b
+                else:
+                    lo += b
+                    hi += a
+            newmin.append(lo)
+            newmax.append(hi)
+        return rt.BoundingBox(rt.Point(*newmin), rt.Point(*newmax))
+
     def intersects(self, ray):
         # very similar logic from objects.Cube()
-        xtmin, xtmax = check_axis(ray.origin.x, ray.direction.x, self.boxmin.x, self.boxmax.x)
-        ytmin, ytmax = check_axis(ray.origin.y, ray.direction.y, self.boxmin.y, self.boxmax.y)
+        ro = ray.origin.arr
+        rd = ray.direction.arr
+        bmin = self.boxmin.arr
+        bmax = self.boxmax.arr
+        xtmin, xtmax = check_axis(ro[0], rd[0], bmin[0], bmax[0])
+        ytmin, ytmax = check_axis(ro[1], rd[1], bmin[1], bmax[1])
 
         if xtmin > ytmax or ytmin > xtmax:
             return False
 
-        ztmin, ztmax = check_axis(ray.origin.z, ray.direction.z, self.boxmin.z, self.boxmax.z)
+        ztmin, ztmax = check_axis(ro[2], rd[2], bmin[2], bmax[2])
 
         tmin = max(xtmin, ytmin, ztmin)
         tmax = min(xtmax, ytmax, ztmax)
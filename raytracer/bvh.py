@@ -0,0 +1,453 @@
+import math
+import numpy as np
+import raytracer as rt
+
+# Bounding volume hierarchy built with the Surface Area Heuristic (SAH).  The chance that a ray which hits a box also
+# hits a box inside it is roughly the ratio of their surface areas.  A group tests every one of its children, and only
+# a child that is itself a group gets to skip its contents when the ray misses its box, so the expected cost of
+# splitting a group's children into two subgroups is
+#     2 * TRAVERSALCOST + (area(left) * count(left) + area(right) * count(right)) / area(parent) * INTERSECTCOST
+# and we pick the cheapest split, if it is cheaper than just testing every child.  Rather than trying every
+# possible split, the children are dropped into NUMBINS buckets along each axis by the centroid of their boxes,
+# and the splits between buckets are tried.  See http://www.pbr-book.org/3ed-2018/Primitives_and_Intersection_Acceleration/Bounding_Volume_Hierarchies.html
+
+TRAVERSALCOST = 1.0
+INTERSECTCOST = 1.0
+NUMBINS = 12
+BOXLEAFSIZE = 4  # a BoxBVH node with this many boxes or fewer is never split
+
+
+def box_area(minx, miny, minz, maxx, maxy, maxz):
+    dx = maxx - minx
+    dy = maxy - miny
+    dz = maxz - minz
+    if dx < 0 or dy < 0 or dz < 0:
+        return 0.0
+    return 2 * (dx * dy + dy * dz + dz * dx)
+
+
+def sah_split(bounds, numbins=NUMBINS):
+    # bounds is a list of [minx, miny, minz, maxx, maxy, maxz], one per item.  Returns the list of indices of the
+    # items that go on the left side of the best split, or None if no split is cheaper than keeping the items
+    # together.
+    count = len(bounds)
+    if count < 2:
+        return None
+
+    parent = [math.inf, math.inf, math.inf, -math.inf, -math.inf, -math.inf]
+    cmin = [math.inf, math.inf, math.inf]
+    cmax = [-math.inf, -math.inf, -math.inf]
+    centroids = []
+    for b in bounds:
+        c = ((b[0] + b[3]) / 2, (b[1] + b[4]) / 2, (b[2] + b[5]) / 2)
+        centroids.append(c)
+        for axis in range(3):
+            if b[axis] < parent[axis]:
+                parent[axis] = b[axis]
+            if b[axis + 3] > parent[axis + 3]:
+                parent[axis + 3] = b[axis + 3]
+            if c[axis] < cmin[axis]:
+                cmin[axis] = c[axis]
+            if c[axis] > cmax[axis]:
+                cmax[axis] = c[axis]
+
+    parentarea = box_area(*parent)
+    leafcost = count * INTERSECTCOST
+    bestcost = leafcost
+    bestaxis = None
+    bestbin = None
+
+    for axis in range(3):
+        extent = cmax[axis] - cmin[axis]
+        if extent <= 0:
+            continue  # every centroid is in the same place along this axis
+        binbounds = [[math.inf, math.inf, math.inf, -math.inf, -math.inf, -math.inf] for i in range(numbins)]
+        bincounts = [0] * numbins
+        for i in range(count):
+            binnum = min(int(numbins * (centroids[i][axis] - cmin[axis]) / extent), numbins - 1)
+            bincounts[binnum] += 1
+            bb = binbounds[binnum]
+            b = bounds[i]
+            for j in range(3):
+                if b[j] < bb[j]:
+                    bb[j] = b[j]
+                if b[j + 3] > bb[j + 3]:
+                    bb[j + 3] = b[j + 3]
+
+        # sweep from the right to get the area and count of everything right of each split
+        rightareas = [0.0] * numbins
+        rightcounts = [0] * numbins
+        acc = [math.inf, math.inf, math.inf, -math.inf, -math.inf, -math.inf]
+        account = 0
+        for binnum in range(numbins - 1, 0, -1):
+            bb = binbounds[binnum]
+            for j in range(3):
+                acc[j] = min(acc[j], bb[j])
+                acc[j + 3] = max(acc[j + 3], bb[j + 3])
+            account += bincounts[binnum]
+            rightareas[binnum] = box_area(*acc)
+            rightcounts[binnum] = account
+
+        # then sweep from the left, evaluating the split to the right of each bin
+        acc = [math.inf, math.inf, math.inf, -math.inf, -math.inf, -math.inf]
+        account = 0
+        for binnum in range(numbins - 1):
+            bb = binbounds[binnum]
+            for j in range(3):
+                acc[j] = min(acc[j], bb[j])
+                acc[j + 3] = max(acc[j + 3], bb[j + 3])
+            account += bincounts[binnum]
+            if account == 0 or rightcounts[binnum + 1] == 0:
+                continue
+            if parentarea > 0:
+                cost = 2 * TRAVERSALCOST + INTERSECTCOST * (box_area(*acc) * account +
+                                                            rightareas[binnum + 1] * rightcounts[binnum + 1]) / parentarea
+            else:
+                cost = 2 * TRAVERSALCOST + INTERSECTCOST * count
+            if cost < bestcost:
+                bestcost = cost
+                bestaxis = axis
+                bestbin = binnum
+
+    if bestaxis is None:
+        return None
+
+    extent = cmax[bestaxis] - cmin[bestaxis]
+    left = []
+    for i in range(count):
+        binnum = min(int(numbins * (centroids[i][bestaxis] - cmin[bestaxis]) / extent), numbins - 1)
+        if binnum <= bestbin:
+            left.append(i)
+    return left
+
+
+def sah_split_nodes(boxmin, boxmax, counts, numbins=NUMBINS):
+    # The same binned split as sah_split(), done with NumPy for every node of one level of a BoxBVH at once.  boxmin and boxmax are the N x 3 bounds of the boxes, node after node, and counts is how
+    # many boxes each node has.  Returns the bounds of each node, whether each node is split, and a boolean array
+    # that is True for the boxes that go on the left side of their node's split.
+    numnodes = len(counts)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    node = np.repeat(np.arange(numnodes), counts)
+    nodemin = np.minimum.reduceat(boxmin, starts, axis=0)
+    nodemax = np.maximum.reduceat(boxmax, starts, axis=0)
+    d = nodemax - nodemin
+    parentareas = 2 * (d[:, 0] * d[:, 1] + d[:, 1] * d[:, 2] + d[:, 2] * d[:, 0])
+    centroids = (boxmin + boxmax) / 2
+    cmin = np.minimum.reduceat(centroids, starts, axis=0)
+    cmax = np.maximum.reduceat(centroids, starts, axis=0)
+
+    bestcosts = counts * INTERSECTCOST
+    bestaxes = np.full(numnodes, -1)
+    bestbins = np.zeros(numnodes, dtype=np.int64)
+    allbins = []
+    for axis in range(3):
+        extent = cmax[:, axis] - cmin[:, axis]
+        usable = extent > 0  # otherwise every centroid is in the same place along this axis
+        scale = numbins / np.where(usable, extent, 1)
+        bins = np.minimum(((centroids[:, axis] - cmin[node, axis]) * scale[node]).astype(np.int64), numbins - 1)
+        allbins.append(bins)
+        keys = node * numbins + bins
+        bincounts = np.bincount(keys, minlength=numnodes * numbins).reshape(numnodes, numbins)
+        # the bounds of each bin, reduced over runs of equal keys, which is much faster than np.minimum.at()
+        order = np.argsort(keys, kind='stable')
+        sortedkeys = keys[order]
+        runstarts = np.flatnonzero(np.concatenate(([True], sortedkeys[1:] != sortedkeys[:-1])))
+        binmin = np.full((numnodes * numbins, 3), math.inf)
+        binmax = np.full((numnodes * numbins, 3), -math.inf)
+        binmin[sortedkeys[runstarts]] = np.minimum.reduceat(boxmin[order], runstarts, axis=0)
+        binmax[sortedkeys[runstarts]] = np.maximum.reduceat(boxmax[order], runstarts, axis=0)
+        binmin = binmin.reshape(numnodes, numbins, 3)
+        binmax = binmax.reshape(numnodes, numbins, 3)
+        # bounds of everything left of each split, and right of it
+        leftmin = np.minimum.accumulate(binmin, axis=1)[:, :-1]
+        leftmax = np.maximum.accumulate(binmax, axis=1)[:, :-1]
+        rightmin = np.minimum.accumulate(binmin[:, ::-1], axis=1)[:, ::-1][:, 1:]
+        rightmax = np.maximum.accumulate(binmax[:, ::-1], axis=1)[:, ::-1][:, 1:]
+        leftcounts = np.cumsum(bincounts, axis=1)[:, :-1]
+        rightcounts = counts[:, np.newaxis] - leftcounts
+        with np.errstate(invalid='ignore', divide='ignore'):
+            d = leftmax - leftmin
+            leftareas = 2 * (d[..., 0] * d[..., 1] + d[..., 1] * d[..., 2] + d[..., 2] * d[..., 0])
+            d = rightmax - rightmin
+            rightareas = 2 * (d[..., 0] * d[..., 1] + d[..., 1] * d[..., 2] + d[..., 2] * d[..., 0])
+            costs = 2 * TRAVERSALCOST + INTERSECTCOST * (leftareas * leftcounts + rightareas * rightcounts) / \
+                parentareas[:, np.newaxis]
+        costs[(leftcounts == 0) | (rightcounts == 0) | ~usable[:, np.newaxis]] = math.inf
+        binnums = costs.argmin(axis=1)
+        nodecosts = costs[np.arange(numnodes), binnums]
+        better = nodecosts < bestcosts
+        bestcosts = np.where(better, nodecosts, bestcosts)
+        bestaxes[better] = axis
+        bestbins[better] = binnums[better]
+
+    split = (bestaxes >= 0) & (counts > BOXLEAFSIZE) & (parentareas > 0)
+    allbins = np.array(allbins)
+    left = allbins[np.maximum(bestaxes[node], 0), np.arange(len(node))] <= bestbins[node]
+    return nodemin, nodemax, split, left
+
+
+def box_as_list(box):
+    return box.boxmin.arr[0:3] + box.boxmax.arr[0:3]
+
+
+def sah_divide(group, threshold, numbins=NUMBINS):
+    # Rebuilds the children of group into a binary tree of subgroups.  Unlike ObjectGroup.divide(), every child
+    # with finite bounds is assigned to one side of each split, so no child is left behind in a parent that it
+    # straddles.  Children with infinite bounds (e.g. planes) cannot be placed and stay in group itself.
+    if len(group.children) < threshold:
+        return
+
+    finite = []
+    infinite = []
+    for child in group.children:
+        box = child.parent_space_bounds_of()
+        if box.is_finite():
+            finite.append(child)
+        else:
+            infinite.append(child)
+
+    left = sah_split([box_as_list(child.parent_space_bounds_of()) for child in finite], numbins)
+    if left is None:
+        return
+
+    leftset = set(left)
+    leftchildren = [finite[i] for i in left]
+    rightchildren = [finite[i] for i in range(len(finite)) if i not in leftset]
+    group.children = infinite
+    for objlist in (leftchildren, rightchildren):
+        if len(objlist) == 1:
+            group.children.append(objlist[0])
+        else:
+            group.make_subgroup(objlist)
+            sah_divide(group.children[-1], threshold, numbins)
+
+
+def bvh_stats(obj):
+    # returns the number of group nodes at or below obj, the depth of the deepest group, and the SAH estimate of
+    # the cost of intersecting a ray with obj, in units of INTERSECTCOST.
+    if isinstance(obj, rt.ObjectGroup):
+        nodes = 1
+        depth = 0
+        cost = 0.0
+        area = obj.bounds_of().surface_area()
+        for child in obj.children:
+            childnodes, childdepth, childcost = bvh_stats(child)
+            nodes += childnodes
+            depth = max(depth, childdepth)
+            if childnodes == 0:
+                cost += childcost  # a primitive is always tested
+                continue
+            childarea = child.parent_space_bounds_of().surface_area()
+            if math.isinf(area) or math.isinf(childarea) or area <= 0:
+                cost += childcost  # no useful probability, assume the inside of the child is always tested
+            else:
+                cost += TRAVERSALCOST + (childcost - TRAVERSALCOST) * min(childarea / area, 1.0)
+        return nodes, depth + 1, TRAVERSALCOST + cost
+    elif isinstance(obj, rt.CSG):
+        leftnodes, leftdepth, leftcost = bvh_stats(obj.left)
+        rightnodes, rightdepth, rightcost = bvh_stats(obj.right)
+        return leftnodes + rightnodes, max(leftdepth, rightdepth), TRAVERSALCOST + leftcost + rightcost
+    else:
+        return 0, 0, INTERSECTCOST
+
+
+class LinearBVH:
+    # A group hierarchy compiled into flat lists, so it can be walked with a loop instead of a recursive call per
+    # group.  Every group below the root that has an identity transform is collapsed into a node; everything else
+    # (primitives, CSGs, and groups with a transform of their own) is a primitive of the node it sits in, and is
+    # intersected with its own intersect().  Node i has the box bounds[6*i:6*i+6], child nodes
+    # childstart[i]:childend[i] and primitives prims[primstart[i]:primend[i]].  Children of a node are next to each
+    # other in the lists because the nodes are numbered breadth first.
+    __slots__ = ['bounds', 'childstart', 'childend', 'primstart', 'primend', 'prims']
+
+    def __init__(self, group):
+        self.bounds = []
+        self.childstart = []
+        self.childend = []
+        self.primstart = []
+        self.primend = []
+        self.prims = []
+
+        identity = rt.identity4()
+        groups = [group]
+        nextnode = 1
+        i = 0
+        while i < len(groups):
+            g = groups[i]
+            box = g.bounds_of()
+            self.bounds.extend(box.boxmin.arr[0:3])
+            self.bounds.extend(box.boxmax.arr[0:3])
+            self.primstart.append(len(self.prims))
+            self.childstart.append(nextnode)
+            for child in g.children:
+                if isinstance(child, rt.ObjectGroup) and child.transform == identity:
+                    groups.append(child)
+                    nextnode += 1
+                else:
+                    self.prims.append(child)
+            self.primend.append(len(self.prims))
+            self.childend.append(nextnode)
+            i += 1
+
+    def nodes_hit(self, r, maxdist=None):
+        # generates the nodes whose boxes are hit by r (which is in the space of the root group) no further away
+        # than maxdist, or than r.tmax if maxdist is None.  r.tmax is read again for every node, so the caller
+        # can shrink it while walking.  The children of a node are only visited if the node itself is hit.
+        ox, oy, oz = r.origin.arr[0:3]
+        dx, dy, dz = r.direction.arr[0:3]
+        # same arithmetic as check_axis(), so exactly the same boxes are hit as BoundingBox.intersects()
+        xpar = math.fabs(dx) < rt.objects.EPSILON
+        ypar = math.fabs(dy) < rt.objects.EPSILON
+        zpar = math.fabs(dz) < rt.objects.EPSILON
+        inf = math.inf
+
+        bounds = self.bounds
+        childstart = self.childstart
+        childend = self.childend
+
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            b = 6 * node
+            if xpar:
+                xtmin = (bounds[b] - ox) * inf
+                xtmax = (bounds[b + 3] - ox) * inf
+            else:
+                xtmin = (bounds[b] - ox) / dx
+                xtmax = (bounds[b + 3] - ox) / dx
+            if xtmin > xtmax:
+                xtmin, xtmax = xtmax, xtmin
+            if ypar:
+                ytmin = (bounds[b + 1] - oy) * inf
+                ytmax = (bounds[b + 4] - oy) * inf
+            else:
+                ytmin = (bounds[b + 1] - oy) / dy
+                ytmax = (bounds[b + 4] - oy) / dy
+            if ytmin > ytmax:
+                ytmin, ytmax = ytmax, ytmin
+            if xtmin > ytmax or ytmin > xtmax:
+                continue
+            if zpar:
+                ztmin = (bounds[b + 2] - oz) * inf
+                ztmax = (bounds[b + 5] - oz) * inf
+            else:
+                ztmin = (bounds[b + 2] - oz) / dz
+                ztmax = (bounds[b + 5] - oz) / dz
+            if ztmin > ztmax:
+                ztmin, ztmax = ztmax, ztmin
+            tmin = max(xtmin, ytmin, ztmin)
+            tmax = min(xtmax, ytmax, ztmax)
+            if tmin > tmax or tmax < 0 or tmin > (r.tmax if maxdist is None else maxdist):
+                continue
+
+            yield node
+            stack.extend(range(childstart[node], childend[node]))
+
+    def intersect(self, r):
+        # Returns the intersections in no particular order, same as ObjectGroup.local_intersect() always has.
+        primstart = self.primstart
+        primend = self.primend
+        prims = self.prims
+        xs = []
+        for node in self.nodes_hit(r, math.inf):
+            for i in range(primstart[node], primend[node]):
+                xs.extend(prims[i].intersect(r))
+        return xs
+
+    def occluded(self, r, maxdist):
+        # returns the first shadow casting object found with 0 < t < maxdist, or None
+        primstart = self.primstart
+        primend = self.primend
+        prims = self.prims
+        for node in self.nodes_hit(r, maxdist):
+            for i in range(primstart[node], primend[node]):
+                hit = prims[i].occluded(r, maxdist)
+                if hit is not None:
+                    return hit
+        return None
+
+    def occluded_packet(self, packet, mask):
+        # occluded() for a RayPacket: a node's box is tested against all of the packet's rays at once, and its
+        # children are only visited with the rays that hit it
+        bounds = self.bounds
+        childstart = self.childstart
+        childend = self.childend
+        primstart = self.primstart
+        primend = self.primend
+        prims = self.prims
+        stack = [(0, mask)]
+        while stack:
+            node, mask = stack.pop()
+            b = 6 * node
+            mask = packet.hits_box(bounds[b:b + 3], bounds[b + 3:b + 6], mask)
+            if not mask.any():
+                continue
+            for i in range(primstart[node], primend[node]):
+                prims[i].occluded_packet(packet, mask)
+            for child in range(childstart[node], childend[node]):
+                stack.append((child, mask))
+
+    def closest_hit(self, r):
+        # r.tmax is pulled in to every hit found, so boxes beyond the nearest hit so far are skipped.  r may be
+        # the caller's own ray (see pass_ray()), which is fine, as it only ever ends up at the t of the hit returned.
+        primstart = self.primstart
+        primend = self.primend
+        prims = self.prims
+        best = None
+        for node in self.nodes_hit(r):
+            for i in range(primstart[node], primend[node]):
+                hit = prims[i].closest_hit(r)
+                if hit is not None:
+                    best = hit
+                    r.tmax = hit.t
+        return best
+
+    def nodecount(self):
+        return len(self.primstart)
+
+
+class BoxBVH(LinearBVH):
+    # A hierarchy over a plain array of boxes, laid out like a LinearBVH so it is walked with the same nodes_hit().
+    # Node i holds boxes primstart[i]:primend[i] in the order of the order array, which maps them back to the
+    # caller's own numbering.  A TriangleMesh builds one over its faces, and a World over its top level objects, in
+    # which case prims is filled in with the objects in that order.
+    __slots__ = ['order']
+
+    def __init__(self, boxmin, boxmax, numbins=NUMBINS):
+        # boxmin and boxmax are the N x 3 bounds of the boxes.  The tree is built a level at a time, so every node
+        # of a level is split with the same few NumPy calls.
+        self.bounds = []
+        self.childstart = []
+        self.childend = []
+        self.primstart = []
+        self.primend = []
+        self.prims = []
+
+        leaves = []
+        numboxes = 0
+        nextnode = 1
+        items = np.arange(len(boxmin))  # the boxes of this level's nodes, node after node
+        counts = np.array([len(boxmin)])
+        while len(counts) > 0:
+            nodemin, nodemax, split, left = sah_split_nodes(boxmin[items], boxmax[items], counts, numbins)
+            node = np.repeat(np.arange(len(counts)), counts)
+            self.bounds.extend(np.hstack((nodemin, nodemax)).ravel().tolist())
+            # a leaf holds its boxes and a split node has two children, numbered after everything so far
+            leafcounts = np.where(split, 0, counts)
+            primend = numboxes + np.cumsum(leafcounts)
+            self.primstart.extend((primend - leafcounts).tolist())
+            self.primend.extend(primend.tolist())
+            childend = nextnode + 2 * np.cumsum(split)
+            self.childstart.extend((childend - 2 * split).tolist())
+            self.childend.extend(childend.tolist())
+            numboxes = int(primend[-1])
+            nextnode = int(childend[-1])
+            leftcounts = np.bincount(node[left], minlength=len(counts))[split]
+            nextcounts = np.stack((leftcounts, counts[split] - leftcounts), axis=1).ravel()
+            nodesplit = split[node]
+            leaves.append(items[~nodesplit])
+            # the boxes of split nodes, left side first, make up the next level
+            keys = node[nodesplit] * 2 + ~left[nodesplit]
+            items = items[nodesplit][np.argsort(keys, kind='stable')]
+            counts = nextcounts
+        self.order = np.concatenate(leaves)
@@ -1,7 +1,8 @@
 import math
+import numpy as np
 from .transformations import do_transform
 from .matrices import identity4, inverse4x4
-from .rttuple import Point, normalize, Ray, random_in_unit_disk
+from .rttuple import Point, Ray, random_in_unit_disk, point_from_floats, vector_from_floats
 from .perfcounters import increment_rayforpixel
 
 
@@ -62,22 +63,64 @@ class Camera:
         world_x = self.half_width - px_center_x
         world_y = self.half_height - px_center_y
 
-        # canvas is at z = -1
-        px_transform = do_transform(self.__inversetransform, Point(world_x, world_y, -1))
-        direction = normalize(px_transform - self.__origin)
-
-        originalray = Ray(self.__origin, direction)
-        focalpoint = originalray.at(self.focal_length)
+        # canvas is at z = -1.  The math below is do_transform(), the subtraction from the origin, normalize() and
+        # Ray.at() done on plain floats, so that only the final ray allocates tuples.
+        m0, m1, m2, m3 = self.__inversetransform
+        ox, oy, oz = self.__origin.arr[0:3]
+        dx = m0[0] * world_x + m0[1] * world_y - m0[2] + m0[3] - ox
+        dy = m1[0] * world_x + m1[1] * world_y - m1[2] + m1[3] - oy
+        dz = m2[0] * world_x + m2[1] * world_y - m2[2] + m2[3] - oz
+        mag = math.sqrt(dx * dx + dy * dy + dz * dz)
+        dx /= mag
+        dy /= mag
+        dz /= mag
 
         # defocus blur a.k.a. depth of field.
         # find a random point on the aperture
         # performance - even bif self.__lensradius = 0 (no depth of field), the random_in_unit_disk() will execute.
         # since, for now, most renderings do not use depth of field, we will avoid that call unless we are using the
-        # feature.
+        # feature.  Without it, the ray through the focal point starts at the origin and so has the same direction.
         if self.__lensradius > 0:
+            focal_length = self.focal_length
+            fx = ox + dx * focal_length
+            fy = oy + dy * focal_length
+            fz = oz + dz * focal_length
             aperture_point = self.__origin + (random_in_unit_disk() * self.__lensradius)
+            ax, ay, az = aperture_point.arr[0:3]
+            dx = fx - ax
+            dy = fy - ay
+            dz = fz - az
+            mag = math.sqrt(dx * dx + dy * dy + dz * dz)
+            return Ray(point_from_floats(ax, ay, az), vector_from_floats(dx / mag, dy / mag, dz / mag),
+                       spread=self.pixel_size)
         else:
-            aperture_point = self.__origin
-        newdirection = normalize(focalpoint - aperture_point)
+            # the canvas is one unit away, so the beam through a pixel grows by a pixel's size every unit
+            return Ray(self.__origin, vector_from_floats(dx, dy, dz), spread=self.pixel_size)
+
+    def rays_for_pixels(self, xs, ys, perfcount=False):
+        # Vectorized ray_for_pixel() for the batched renderer.  xs and ys are NumPy arrays of (sub)pixel coordinates,
+        # and the result is an N x 3 array of ray origins and an N x 3 array of unit directions.
+        if perfcount:
+            increment_rayforpixel(len(xs))
 
-        return Ray(aperture_point, newdirection)
+        world_x = self.half_width - (xs + 0.5) * self.pixel_size
+        world_y = self.half_height - (ys + 0.5) * self.pixel_size
+
+        inv = np.array(self.__inversetransform, dtype=np.float64)
+        origin = np.array(self.__origin.arr[0:3], dtype=np.float64)
+        # canvas is at z = -1
+        directions = np.outer(world_x, inv[0:3, 0]) + np.outer(world_y, inv[0:3, 1]) - inv[0:3, 2] + inv[0:3, 3]
+        directions -= origin
+        directions /= np.sqrt((directions * directions).sum(axis=1))[:, np.newaxis]
+        origins = np.broadcast_to(origin, directions.shape).copy()
+
+        if self.__lensradius > 0:
+            # same depth of field logic as ray_for_pixel(), with the points on the aperture drawn by
+            # random_in_unit_disk() one ray after another, so a seeded render gives the same rays either way
+            focalpoints = origins + directions * self.focal_length
+            disk = np.array([random_in_unit_disk().arr[0:2] for _ in range(len(xs))], dtype=np.float64)
+            origins[:, 0:2] += disk * self.__lensradius
+            directions = focalpoints - origins
+            directions /= np.sqrt((directions * directions).sum(axis=1))[:, np.newaxis]
+
+        return origins, directions
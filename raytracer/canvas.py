@@ -1,22 +1,62 @@
 import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+import os
+import pickle
+import queue
 import random
+import sys
 import time
+import weakref
+import numpy as np
 from .rttuple import Color
 from .camera import Camera
 from .perfcounters import init_raycount, add_raycount
 from .world import World
+from .batchrays import BatchScene, can_batch
+from .imagefile import write_ppm_p3, write_image
+from .texturestore import read_ppm
 
 
 class Canvas():
-    __slots__ = ['arr', 'width', 'height', 'maxcolors']
+    # With shared set, the pixels live in a multiprocessing.shared_memory block, so render processes forked after
+    # the canvas is made (or attached to it by name) all write into the same memory, each to its own pixels,
+    # without a lock.  Other canvases, like textures, are plain NumPy arrays.  arr is a flat view of r, g, b floats
+    # in row order, and pixels is the same memory as a height x width x 3 array, which lets a whole tile be written
+    # in one assignment.
+    __slots__ = ['arr', 'pixels', 'width', 'height', 'maxcolors', 'shm', '__weakref__']
+
+    def __init__(self, width, height, maxcolors, shmname=None, shared=False):
+        # with shmname, attaches to the memory of a canvas made in another process instead of allocating new memory
+        self.maxcolors = maxcolors
+        self.shm = None
+        self.allocate(width, height, shmname, shared)
 
-    def __init__(self, width, height, maxcolors):
+    def allocate(self, width, height, shmname=None, shared=False):
+        self.close()
         self.width = width
         self.height = height
-        self.maxcolors = maxcolors
-        # multiprocessing arrays are initially zeroed.  We do not specify a lock here because when we do write,
-        # each process will write to different cells, so there is no collision risk.
-        self.arr = multiprocessing.Array('d', 3 * width * height)
+        if shmname is not None:
+            self.shm = attach_shm(shmname)
+            self.arr = np.ndarray((3 * width * height,), dtype=np.float64, buffer=self.shm.buf)
+        elif shared:
+            nbytes = max(1, 3 * width * height * 8)  # shared memory cannot have size 0
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            # only the process that made the block removes it; forked render processes exit without finalizers
+            weakref.finalize(self, release_shm, self.shm, os.getpid())
+            self.arr = np.ndarray((3 * width * height,), dtype=np.float64, buffer=self.shm.buf)
+            self.arr[:] = 0
+        else:
+            self.arr = np.zeros(3 * width * height, dtype=np.float64)
+        self.pixels = self.arr.reshape(height, width, 3)
+
+    def close(self):
+        # lets go of this process's mapping of the shared memory, if there is one.  The canvas cannot be used
+        # afterwards until allocate() is called again.
+        if self.shm is not None:
+            self.arr = None
+            self.pixels = None
+            self.shm.close()
+            self.shm = None
 
     def __getitem__(self, key):
         return self.arr[key]
@@ -28,59 +68,73 @@ class Canvas():
         assert 0 <= x < self.width
         assert 0 <= y < self.height
         startcell = (y * self.width * 3) + (x * 3)
-        # TODO - cannot use r, g, b any more because I'm dealing with tuples not colors
-        self.arr[startcell] = color.arr[0]
-        self.arr[startcell + 1] = color.arr[1]
-        self.arr[startcell + 2] = color.arr[2]
+        self.arr[startcell:startcell + 3] = color.arr[0:3]
 
-    def pixel_at(self, x, y):
+    def write_span(self, x, y, values):
+        # writes a run of consecutive pixels in one row, starting at x.  values is a flat list of r, g, b floats.
+        assert 0 <= x and x + len(values) // 3 <= self.width
+        assert 0 <= y < self.height
         startcell = (y * self.width * 3) + (x * 3)
-        res = Color(self.arr[startcell], self.arr[startcell + 1], self.arr[startcell + 2])
-        return res
+        self.arr[startcell:startcell + len(values)] = values
 
-    def canvas_to_ppm(self, filename):
-        f = open(filename, 'w')
-        f.write("P3\n")
-        f.write("{} {}\n".format(self.width, self.height))
-        f.write("255\n")
+    def write_tile(self, xmin, ymin, block):
+        # block is a rows x columns x 3 array of r, g, b floats with its top left corner at xmin, ymin
+        rows, columns = block.shape[0:2]
+        assert 0 <= xmin and xmin + columns <= self.width
+        assert 0 <= ymin and ymin + rows <= self.height
+        self.pixels[ymin:ymin + rows, xmin:xmin + columns] = block
 
-        for h in range(self.height):
-            for w in range(self.width):
-                startcell = (h * self.width * 3) + (w * 3)
+    def pixel_at(self, x, y):
+        startcell = (y * self.width * 3) + (x * 3)
+        return Color(*self.arr[startcell:startcell + 3].tolist())
 
-                r = self.arr[startcell]
-                g = self.arr[startcell + 1]
-                b = self.arr[startcell + 2]
+    def to_ints(self):
+        # the canvas as a height x width x 3 array of ints from 0 to maxcolors, the same values canvas_to_ppm() has
+        # always written
+        return ((self.maxcolors + 1) * np.clip(self.pixels, 0.0, 0.999)).astype(np.int64)
 
-                r = int((self.maxcolors + 1) * clamp(r, 0.0, 0.999))
-                g = int((self.maxcolors + 1) * clamp(g, 0.0, 0.999))
-                b = int((self.maxcolors + 1) * clamp(b, 0.0, 0.999))
-                f.write('{} {} {}\n'.format(r, g, b))
-        f.close()
+    def canvas_to_ppm(self, filename):
+        write_ppm_p3(filename, self.to_ints(), self.maxcolors)
+
+    def canvas_to_file(self, filename):
+        # PNG for a .png filename, otherwise binary PPM (P6), which is a fraction of the size of canvas_to_ppm()
+        write_image(filename, self.to_ints(), self.maxcolors)
 
     def canvas_from_ppm(self, filename):
         print('Loading {}'.format(filename))
         timestart = time.time()
-        f = open(filename, 'r')
-        lines = f.readlines()
-        comments_removed = [i for i in lines if i[0] != '#']
-        filestr = ' '.join(comments_removed)
-        data = filestr.split()
-        assert data[0] == 'P3'
-        assert data[1].isnumeric()
-        assert data[2].isnumeric()
-        assert data[3].isnumeric()
-        self.width = int(data[1])
-        self.height = int(data[2])
-        self.maxcolors = int(data[3])
-        self.arr = multiprocessing.Array('d', 3 * self.width * self.height)
-        for i in range(4, len(data)):
-            self.arr[i-4] = int(data[i]) / self.maxcolors
+        values, self.maxcolors = read_ppm(filename)
+        self.allocate(values.shape[1], values.shape[0])
+        self.pixels[:] = values / self.maxcolors
         timeend = time.time()
         print('{} loaded.'.format(filename))
         print('Elapsed time: {} seconds'.format(timeend - timestart))
 
 
+def release_shm(shm, creatorpid):
+    if os.getpid() == creatorpid:
+        shm.unlink()
+
+
+def attach_shm(name):
+    # Attaches to a block made by another process.  The maker registered it with the resource tracker, which
+    # unlinks whatever is still registered when the processes using it exit, and only the maker should: from 3.13
+    # attaching can leave it alone.  Before that, render processes share the maker's tracker (see
+    # start_processes()), where registering a name twice counts once, and unregistering here would take away the
+    # maker's entry.
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    return shared_memory.SharedMemory(name=name)
+
+
+def start_processes(procs):
+    # Processes only share a resource tracker that was running when they were started.  Otherwise each starts its
+    # own when it attaches to a canvas, and at exit warns about, and tries to unlink, blocks it never made.
+    resource_tracker.ensure_running()
+    for p in procs:
+        p.start()
+
+
 def clamp(x, minimum, maximum):
     if x < minimum:
         return minimum
@@ -90,7 +144,7 @@ def clamp(x, minimum, maximum):
 
 
 # Using these wrapper functions is a bit messy.  However, with python multiprocessing, global objects declared
-# before the Process.start() can be shared.  The Canvas objects have multiprocessing.arrays as members and that seems
+# before the Process.start() can be shared.  The Canvas objects have shared memory blocks as members and that seems
 # to work.  What I discovered, however, is that the global objects only seem to retain state if they are accessed by
 # functions in this file.  So the wrapper functions below allow me to do that.  There may be other ways, but since
 # this works, I'll keep it.
@@ -102,7 +156,7 @@ GLOBALTEXTUREPATTERNDICT = {}
 
 def init_canvas(width=10, height=10):
     global GLOBALCANVAS
-    GLOBALCANVAS = Canvas(width, height, 255)
+    GLOBALCANVAS = Canvas(width, height, 255, shared=True)
 
 
 def get_canvasdims(texturepattern=False, texturename='default'):
@@ -130,6 +184,10 @@ def canvas_to_ppm(filename):
     GLOBALCANVAS.canvas_to_ppm(filename)
 
 
+def canvas_to_file(filename):
+    GLOBALCANVAS.canvas_to_file(filename)
+
+
 def canvas_from_ppm(filename, texturename='default'):
     global GLOBALTEXTUREPATTERNDICT
     canvas = Canvas(1, 1, 255)
@@ -139,6 +197,7 @@ def canvas_from_ppm(filename, texturename='default'):
 
 MPGLOBALWORLD = World()
 MPGLOBALCAMERA = Camera()
+BATCHSCENE = None
 LHS_SAMPLE_LIST = [[]]
 LHS_DELTA_LIST = [[]]
 MAXNUMSAMPLES = 0
@@ -181,98 +240,291 @@ def LHS_samples(x, y, numsamples):
         return retlist
 
 
-def mp_render_rows(rowlist, maxdepth, adaptivesample=False, perfcount=False):
+def render_pixel(x, y, maxdepth, adaptivesample=False, perfcount=False):
+    # returns the color of the pixel at x, y, and the number of rays that were cast for it.
 
     if not adaptivesample:
-        for y in rowlist:
-            for x in range(MPGLOBALCAMERA.hsize):
-                c = Color(0, 0, 0)
-                samples = LHS_samples(x, y, MAXNUMSAMPLES)
-                for q in samples:
-                    r = MPGLOBALCAMERA.ray_for_pixel(q[0], q[1], perfcount)
-                    c += MPGLOBALWORLD.color_at(r, maxdepth, perfcount)
-                c = c / len(samples)
-                write_pixel(x, y, c)
-            print('line {} complete'.format(y))
+        c = Color(0, 0, 0)
+        samples = LHS_samples(x, y, MAXNUMSAMPLES)
+        for q in samples:
+            r = MPGLOBALCAMERA.ray_for_pixel(q[0], q[1], perfcount)
+            c += MPGLOBALWORLD.color_at(r, maxdepth, perfcount)
+        return c / len(samples), len(samples)
+
+    done = False
+
+    c = Color(0, 0, 0)
+    # take sample at center
+    r = MPGLOBALCAMERA.ray_for_pixel(x, y, perfcount)
+    c += MPGLOBALWORLD.color_at(r, maxdepth, perfcount)
+
+    # take samples at four corners
+    c1 = Color(0, 0, 0)
+    for px in [(x - 0.5, y - 0.5), (x + 0.5, y - 0.5),
+               (x - 0.5, y + 0.5), (x + 0.5, y + 0.5)]:
+        r = MPGLOBALCAMERA.ray_for_pixel(px[0], px[1], perfcount)
+        c1 += MPGLOBALWORLD.color_at(r, maxdepth, perfcount)
+    c1 = (c1 + c) / 5  # average of center + four corners
+    diff = c1 - c
+    sqdiff = diff * diff
+    if sqdiff.magnitude() < ADAPTIVE_EPSILON:
+        done = True  # we won't enter the while loop below
+
+    numrays = 5
+    curnumsamples = 3
+
+    while curnumsamples <= MAXNUMSAMPLES and not done:
+        c1 = Color(0, 0, 0)
+        samples = LHS_samples(x, y, curnumsamples)
+        for q in samples:
+            r = MPGLOBALCAMERA.ray_for_pixel(q[0], q[1], perfcount)
+            c1 += MPGLOBALWORLD.color_at(r, maxdepth, perfcount)
+        c1 += c * numrays
+        c1 = c1 / (len(samples) + numrays)
+        numrays += len(samples)
+
+        diff = c1 - c
+        sqdiff = diff * diff
+        if sqdiff.magnitude() < ADAPTIVE_EPSILON:
+            done = True
+        c = c1
+        curnumsamples += 1
+    return c, numrays
 
-    else:
-        for y in rowlist:
-            for x in range(MPGLOBALCAMERA.hsize):
-                done = False
 
+def mp_render_rows(rowlist, maxdepth, adaptivesample=False, perfcount=False):
+    for y in rowlist:
+        for x in range(MPGLOBALCAMERA.hsize):
+            c, numrays = render_pixel(x, y, maxdepth, adaptivesample, perfcount)
+            if perfcount and adaptivesample:
+                add_raycount(MPGLOBALCAMERA.hsize, x, y, numrays)
+            write_pixel(x, y, c)
+        print('line {} complete'.format(y))
+
+
+def make_tiles(width, height, tilesize):
+    # splits the image into tilesize x tilesize rectangles, returned as (xmin, ymin, xmax, ymax) with the max
+    # values exclusive.  Tiles on the right and bottom edges are smaller if the image does not divide evenly.
+    if tilesize < 1:
+        raise ValueError('tilesize must be at least 1')
+    tiles = []
+    for ymin in range(0, height, tilesize):
+        for xmin in range(0, width, tilesize):
+            tiles.append((xmin, ymin, min(xmin + tilesize, width), min(ymin + tilesize, height)))
+    return tiles
+
+
+def render_tile(xmin, ymin, xmax, ymax, maxdepth, adaptivesample=False, perfcount=False, batchprimary=False):
+    # renders one tile, returning its pixels as a rows x columns x 3 array of r, g, b floats, ready for
+    # Canvas.write_tile(), and the number of rays cast for each pixel in row order.
+    values = []
+    raycounts = []
+    if batchprimary and not adaptivesample and BATCHSCENE is not None:
+        # every sample for every pixel in the tile goes into one batch of primary rays
+        xs = []
+        ys = []
+        for y in range(ymin, ymax):
+            for x in range(xmin, xmax):
+                for q in LHS_samples(x, y, MAXNUMSAMPLES):
+                    xs.append(q[0])
+                    ys.append(q[1])
+        origins, directions = MPGLOBALCAMERA.rays_for_pixels(np.array(xs), np.array(ys), perfcount)
+        colors = BATCHSCENE.colors_for_rays(origins, directions, maxdepth, perfcount, MPGLOBALCAMERA.pixel_size)
+        numsamples = len(colors) // ((xmax - xmin) * (ymax - ymin))
+        k = 0
+        for y in range(ymin, ymax):
+            for x in range(xmin, xmax):
                 c = Color(0, 0, 0)
-                # take sample at center
-                r = MPGLOBALCAMERA.ray_for_pixel(x, y, perfcount)
-                c += MPGLOBALWORLD.color_at(r, maxdepth, perfcount)
-
-                # take samples at four corners
-                c1 = Color(0, 0, 0)
-                for px in [(x - 0.5, y - 0.5), (x + 0.5, y - 0.5),
-                           (x - 0.5, y + 0.5), (x + 0.5, y + 0.5)]:
-                    r = MPGLOBALCAMERA.ray_for_pixel(px[0], px[1], perfcount)
-                    c1 += MPGLOBALWORLD.color_at(r, maxdepth, perfcount)
-                c1 = (c1 + c) / 5  # average of center + four corners
-                diff = c1 - c
-                sqdiff = diff * diff
-                if sqdiff.magnitude() < ADAPTIVE_EPSILON:
-                    done = True  # we won't enter the while loop below
-                if perfcount:
-                    add_raycount(MPGLOBALCAMERA.hsize, x, y, 5)
-
-                numrays = 5
-                curnumsamples = 3
-
-                while curnumsamples <= MAXNUMSAMPLES and not done:
-                    c1 = Color(0, 0, 0)
-                    samples = LHS_samples(x, y, curnumsamples)
-                    for q in samples:
-                        r = MPGLOBALCAMERA.ray_for_pixel(q[0], q[1], perfcount)
-                        c1 += MPGLOBALWORLD.color_at(r, maxdepth, perfcount)
-                    c1 += c * numrays
-                    c1 = c1 / (len(samples) + numrays)
-                    numrays += len(samples)
-                    if perfcount:
-                        add_raycount(MPGLOBALCAMERA.hsize, x, y, len(samples))
-
-                    diff = c1 - c
-                    sqdiff = diff * diff
-                    if sqdiff.magnitude() < ADAPTIVE_EPSILON:
-                        done = True
-                    c = c1
-                    curnumsamples += 1
-                write_pixel(x, y, c)
-            print('line {} complete'.format(y))
-
-
-def mp_render(camera, world, numsamples=10, numprocesses=1, maxdepth=5, adaptivesample=False, perfcount=False):
+                for i in range(numsamples):
+                    c += colors[k]
+                    k += 1
+                values.extend((c / numsamples).arr[0:3])
+                raycounts.append(numsamples)
+    else:
+        for y in range(ymin, ymax):
+            for x in range(xmin, xmax):
+                c, numrays = render_pixel(x, y, maxdepth, adaptivesample, perfcount)
+                values.extend(c.arr[0:3])
+                raycounts.append(numrays)
+    return np.array(values, dtype=np.float64).reshape(ymax - ymin, xmax - xmin, 3), raycounts
+
+
+def mp_render_tiles(tilequeue, numtiles, maxdepth, adaptivesample=False, perfcount=False, batchprimary=False):
+    # Each process pulls the next tile off the shared queue until it receives the None sentinel, so a process that
+    # gets a cheap part of the image simply takes more tiles rather than sitting idle.
+    tile = tilequeue.get()
+    while tile is not None:
+        tilenum, xmin, ymin, xmax, ymax = tile
+        block, raycounts = render_tile(xmin, ymin, xmax, ymax, maxdepth, adaptivesample, perfcount, batchprimary)
+        GLOBALCANVAS.write_tile(xmin, ymin, block)
+        if perfcount and adaptivesample:
+            i = 0
+            for y in range(ymin, ymax):
+                for x in range(xmin, xmax):
+                    add_raycount(MPGLOBALCAMERA.hsize, x, y, raycounts[i])
+                    i += 1
+        print('tile {} of {} complete'.format(tilenum + 1, numtiles))
+        tile = tilequeue.get()
+
+
+def init_batchscene(world, batchprimary):
+    # builds the flattened scene used by the batched primary ray renderer, if it was requested and the world allows
+    global BATCHSCENE
+    if batchprimary and can_batch(world):
+        BATCHSCENE = BatchScene(world)
+    else:
+        BATCHSCENE = None
+
+
+def mp_render(camera, world, numsamples=10, numprocesses=1, maxdepth=5, adaptivesample=False, perfcount=False,
+              tilesize=16, batchprimary=False):
+    # batchprimary=True intersects each tile's primary rays as one NumPy batch (see batchrays.py).  It has no effect
+    # with adaptive sampling, which decides how many rays to cast one pixel at a time.
     global MPGLOBALWORLD
     global MPGLOBALCAMERA
     init_canvas(camera.hsize, camera.vsize)
+    world.freeze()
+    init_batchscene(world, batchprimary)
     init_LHS_sample_list(numsamples)
     if perfcount:
         init_raycount(camera.hsize, camera.vsize)
     MPGLOBALWORLD = world
     MPGLOBALCAMERA = camera
 
-    rowlists = []
+    tiles = make_tiles(camera.hsize, camera.vsize, tilesize)
+    tilequeue = multiprocessing.Queue()
+    for tilenum, tile in enumerate(tiles):
+        tilequeue.put((tilenum,) + tile)
+    # one sentinel per process, so that each one knows when the queue has been drained
     for i in range(numprocesses):
-        rowlists.append([])
-
-    for i in range(camera.vsize):
-        rowlists[i % numprocesses].append(i)
+        tilequeue.put(None)
 
     procArr = []
-    for s in rowlists:
-        p = multiprocessing.Process(target=mp_render_rows, args=(s, maxdepth, adaptivesample, perfcount))
+    for i in range(numprocesses):
+        p = multiprocessing.Process(target=mp_render_tiles,
+                                    args=(tilequeue, len(tiles), maxdepth, adaptivesample, perfcount, batchprimary))
         procArr.append(p)
 
-    for p in procArr:
-        p.start()
+    start_processes(procArr)
 
     for p in procArr:
         p.join()
 
 
+def pool_worker(worldbytes, numsamples, jobqueue, resultqueue, maxdepth, adaptivesample=False, perfcount=False,
+                batchprimary=False):
+    # Runs in each RenderPool process.  The world arrives pickled when the process starts, so it is loaded once
+    # however the process was started, and only the camera travels with each job; it is unpickled once per frame
+    # rather than once per tile.  Each frame has a new canvas, which the process attaches to by name and writes its
+    # tiles straight into.
+    global MPGLOBALWORLD
+    global MPGLOBALCAMERA
+    MPGLOBALWORLD = pickle.loads(worldbytes)
+    init_LHS_sample_list(numsamples)
+    init_batchscene(MPGLOBALWORLD, batchprimary)
+    curframe = None
+    canvas = None
+    job = jobqueue.get()
+    while job is not None:
+        framenum, camerabytes, shmname, tilenum, xmin, ymin, xmax, ymax = job
+        if framenum != curframe:
+            MPGLOBALCAMERA = pickle.loads(camerabytes)
+            if canvas is not None:
+                canvas.close()
+            canvas = Canvas(MPGLOBALCAMERA.hsize, MPGLOBALCAMERA.vsize, 255, shmname)
+            curframe = framenum
+        block, raycounts = render_tile(xmin, ymin, xmax, ymax, maxdepth, adaptivesample, perfcount, batchprimary)
+        canvas.write_tile(xmin, ymin, block)
+        resultqueue.put((framenum, tilenum, raycounts))
+        job = jobqueue.get()
+    if canvas is not None:
+        canvas.close()
+
+
+class RenderPool:
+    """ A set of long-lived render processes for one World.
+
+    mp_render() forks fresh processes for every frame.  A RenderPool starts its processes once, when it is created,
+    hands each of them the world pickled, and then renders as many frames as needed, e.g. a camera sweep over the
+    same scene.  It works with any multiprocessing start method, except that perfcount needs fork, as the counters
+    are shared by inheriting them.  Image textures mapped from the texture cache are mapped again by each process,
+    rather than copied to it.  Each call to render() fills the global canvas, so canvas_to_ppm() works as it does
+    after mp_render().  Changes made to the world after the pool is created are not seen by the workers.
+    """
+    __slots__ = ['numprocesses', 'maxdepth', 'adaptivesample', 'perfcount', 'framenum', 'jobqueue', 'resultqueue',
+                 'procs']
+
+    def __init__(self, world, numprocesses=1, numsamples=10, maxdepth=5, adaptivesample=False, perfcount=False,
+                 batchprimary=False):
+        if numprocesses < 1:
+            raise ValueError('numprocesses must be at least 1')
+        if perfcount and multiprocessing.get_start_method() != 'fork':
+            raise ValueError('perfcount needs the fork start method, not {}'.format(multiprocessing.get_start_method()))
+        self.numprocesses = numprocesses
+        self.maxdepth = maxdepth
+        self.adaptivesample = adaptivesample
+        self.perfcount = perfcount
+        self.framenum = 0
+        # frozen first, so that each process gets the matrices and hierarchies already built
+        world.freeze()
+        worldbytes = pickle.dumps(world)
+        self.jobqueue = multiprocessing.Queue()
+        self.resultqueue = multiprocessing.Queue()
+        self.procs = []
+        for i in range(numprocesses):
+            p = multiprocessing.Process(target=pool_worker, daemon=True,
+                                        args=(worldbytes, numsamples, self.jobqueue, self.resultqueue, maxdepth,
+                                              adaptivesample, perfcount, batchprimary))
+            self.procs.append(p)
+        start_processes(self.procs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def render(self, camera, tilesize=16):
+        if self.procs is None:
+            raise RuntimeError('RenderPool has been closed')
+        init_canvas(camera.hsize, camera.vsize)
+        if self.perfcount:
+            init_raycount(camera.hsize, camera.vsize)
+        self.framenum += 1
+        camerabytes = pickle.dumps(camera)
+
+        tiles = make_tiles(camera.hsize, camera.vsize, tilesize)
+        for tilenum, tile in enumerate(tiles):
+            self.jobqueue.put((self.framenum, camerabytes, GLOBALCANVAS.shm.name, tilenum) + tile)
+
+        numdone = 0
+        while numdone < len(tiles):
+            try:
+                framenum, tilenum, raycounts = self.resultqueue.get(timeout=1)
+            except queue.Empty:
+                if not all(p.is_alive() for p in self.procs):
+                    raise RuntimeError('A RenderPool process exited while rendering')
+                continue
+            xmin, ymin, xmax, ymax = tiles[tilenum]
+            if self.perfcount and self.adaptivesample:
+                i = 0
+                for y in range(ymin, ymax):
+                    for x in range(xmin, xmax):
+                        add_raycount(camera.hsize, x, y, raycounts[i])
+                        i += 1
+            numdone += 1
+            print('frame {}: tile {} of {} complete'.format(framenum, numdone, len(tiles)))
+
+    def close(self):
+        if self.procs is None:
+            return
+        for i in range(self.numprocesses):
+            self.jobqueue.put(None)
+        for p in self.procs:
+            p.join()
+        self.procs = None
+
+
 def debug_render_pixel(camera, world, x, y):
     # renders the single pixel
     global MPGLOBALWORLD
@@ -0,0 +1,66 @@
+import os
+import struct
+import zlib
+import numpy as np
+
+# Writers for images held as height x width x 3 arrays of ints from 0 to maxcolors.  write_image() picks the format
+# from the file extension: .png is PNG, anything else is a PPM, binary (P6) unless ascii is asked for.  The PNG
+# encoder only needs zlib and struct; see http://www.libpng.org/pub/png/spec/1.2/PNG-Structure.html
+
+
+def write_ppm_p3(filename, values, maxcolors=255):
+    height, width = values.shape[0:2]
+    with open(filename, 'w') as f:
+        f.write("P3\n")
+        f.write("{} {}\n".format(width, height))
+        f.write("{}\n".format(maxcolors))
+        # every value is one of maxcolors + 1 strings, so they are looked up rather than formatted
+        spaced = ['{} '.format(i) for i in range(maxcolors + 1)]
+        ended = ['{}\n'.format(i) for i in range(maxcolors + 1)]
+        flat = values.ravel().tolist()
+        f.write(''.join([spaced[r] + spaced[g] + ended[b] for r, g, b in zip(flat[0::3], flat[1::3], flat[2::3])]))
+
+
+def write_ppm_p6(filename, values, maxcolors=255):
+    height, width = values.shape[0:2]
+    # one byte per value, or two most significant byte first when maxcolors needs them
+    dtype = np.uint8 if maxcolors < 256 else np.dtype('>u2')
+    with open(filename, 'wb') as f:
+        f.write("P6\n{} {}\n{}\n".format(width, height, maxcolors).encode('ascii'))
+        f.write(values.astype(dtype).tobytes())
+
+
+def png_chunk(chunktype, data):
+    return struct.pack('>I', len(data)) + chunktype + data + struct.pack('>I', zlib.crc32(chunktype + data))
+
+
+def write_png(filename, values, maxcolors=255):
+    height, width = values.shape[0:2]
+    if maxcolors == 255:
+        bitdepth = 8
+        pixels = values.astype(np.uint8)
+    elif maxcolors < 256:
+        bitdepth = 8
+        pixels = np.rint(values * (255 / maxcolors)).astype(np.uint8)
+    else:
+        bitdepth = 16
+        pixels = np.rint(values * (65535 / maxcolors)).astype('>u2')
+    # each row starts with a filter type byte; 0 means the row is stored as is
+    rows = pixels.reshape(height, -1).view(np.uint8)
+    raw = np.zeros((height, rows.shape[1] + 1), dtype=np.uint8)
+    raw[:, 1:] = rows
+    with open(filename, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        # width, height, bit depth, color type 2 (RGB), compression, filter and interlace methods
+        f.write(png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, bitdepth, 2, 0, 0, 0)))
+        f.write(png_chunk(b'IDAT', zlib.compress(raw.tobytes())))
+        f.write(png_chunk(b'IEND', b''))
+
+
+def write_image(filename, values, maxcolors=255, ascii=False):
+    if os.path.splitext(filename)[1].lower() == '.png':
+        write_png(filename, values, maxcolors)
+    elif ascii:
+        write_ppm_p3(filename, values, maxcolors)
+    else:
+        write_ppm_p6(filename, values, maxcolors)
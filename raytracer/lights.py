@@ -1,8 +1,56 @@
 import math
 import random
+from .objects import EPSILON
+from .rttuple import point_from_floats, vector_from_floats
 import raytracer as rt
 
 
+def footprint_edges(point, eyev, normalv, footprint):
+    # A beam footprint wide hitting a surface at an angle covers an ellipse: footprint / cos across in the
+    # direction the ray was travelling, and footprint across at right angles to that.  Returns the two points on
+    # the surface that far from point along those axes, which is about where the rays through the neighbouring
+    # pixels hit.
+    nx, ny, nz = normalv.arr[0:3]
+    ex, ey, ez = eyev.arr[0:3]
+    cos = ex * nx + ey * ny + ez * nz
+    # the eye vector with the normal taken out is the first axis, unless the ray came straight in
+    ax = ex - nx * cos
+    ay = ey - ny * cos
+    az = ez - nz * cos
+    mag = math.sqrt(ax * ax + ay * ay + az * az)
+    if mag < EPSILON:
+        ax, ay, az = (0.0, 1.0, 0.0) if abs(nx) > 0.9 else (1.0, 0.0, 0.0)
+        dot = ax * nx + ay * ny + az * nz
+        ax -= nx * dot
+        ay -= ny * dot
+        az -= nz * dot
+        mag = math.sqrt(ax * ax + ay * ay + az * az)
+    ax /= mag
+    ay /= mag
+    az /= mag
+    bx = ny * az - nz * ay
+    by = nz * ax - nx * az
+    bz = nx * ay - ny * ax
+    stretch = footprint / max(abs(cos), 0.001)
+    px, py, pz = point.arr[0:3]
+    return (rt.Point(px + ax * stretch, py + ay * stretch, pz + az * stretch),
+            rt.Point(px + bx * footprint, py + by * footprint, pz + bz * footprint))
+
+
+def surface_color(material, obj, point, eyev, normalv, footprint=0.0):
+    # the color of material at point before any light falls on it, which is the same for every light
+    if material.pattern is not None:
+        pattern = material.pattern
+        object_point = obj.world_to_object(point)
+        pattern_point = rt.matmul4xTuple(pattern.inversetransform, object_point)
+        if footprint > 0 and pattern.usesfootprint:
+            edge_points = [rt.matmul4xTuple(pattern.inversetransform, obj.world_to_object(p))
+                           for p in footprint_edges(point, eyev, normalv, footprint)]
+            return pattern.filtered_color_at(pattern_point, *edge_points)
+        return pattern.color_at(pattern_point)
+    return material.color
+
+
 class Light:
     __slots__ = ['position', 'intensity', 'decays', 'decayfactor']
 
@@ -16,50 +64,76 @@ class Light:
         # at 1.0 when the light is 1.0 units away from an object.
         self.decayfactor = decayfactor
 
-    def lighting(self, material, obj, point, eyev, normalv, intensity_pct=1.0):
-        # combine the surface color with the light's color/intensity
-
-        if material.pattern is not None:
-            object_point = obj.world_to_object(point)
-            pattern_point = rt.matmul4xTuple(material.pattern.inversetransform, object_point)
-            effective_color = material.pattern.color_at(pattern_point) * self.intensity
-        else:
-            effective_color = material.color * self.intensity
+    def lighting(self, material, obj, point, eyev, normalv, intensity_pct=1.0, footprint=0.0):
+        # combine the surface color with the light's color/intensity, treating every sample of the light as
+        # visible and scaling them by intensity_pct.  World.shade_hit() uses light_samples() and shade() instead.
+        # footprint is the width of the ray's beam at point; see Ray.
+        # find the direction to the light source
+        directions = [rt.normalize(pos - point) for pos in self.position_samples()]
+        return self.shade(material, obj, point, eyev, normalv, intensity_pct, directions, footprint)
+
+    def light_samples(self, world, point, over_point):
+        # the light's samples as seen from a point on a surface, in one pass: returns the scale for its brightness
+        # there, and for each sample the direction to it from point, or None where it cannot be seen from over_point
+        return self.intensity_at(world, over_point), [rt.normalize(self.position - point)]
+
+    def shade(self, material, obj, point, eyev, normalv, scale, directions, footprint=0.0, color=None):
+        # the surface color at point lit by this light, from the directions of light_samples().  color is
+        # surface_color() at point, if it has already been worked out.
+        if color is None:
+            color = surface_color(material, obj, point, eyev, normalv, footprint)
+        effective_color = color * self.intensity
 
         # compute the ambient contribution
         ambient = effective_color * material.ambient
 
-        diffuse_specular_sum = rt.Color(0, 0, 0)
-        sample_list = self.position_samples()
-        for pos in sample_list:
-            # find the direction to the light source
-            lightv = rt.normalize(pos - point)
+        # the cosines for each sample are added up on floats, and the colors worked out once from the sums
+        nx, ny, nz = normalv.arr[0:3]
+        ex, ey, ez = eyev.arr[0:3]
+        shininess = material.shininess
+        diffuse_sum = 0.0
+        specular_sum = 0.0
+        lit = False
+        shiny = False
+        for lightv in directions:
+            if lightv is None:
+                # this sample is in shadow
+                continue
+            lx, ly, lz = lightv.arr[0:3]
 
             # light_dot_normal represents the cosine of the angle between the
             # light vector and the normal vector.  A negative number means the
             # light is on the other side of the surface.
-            light_dot_normal = rt.dot(lightv, normalv)
+            light_dot_normal = lx * nx + ly * ny + lz * nz
             if light_dot_normal < 0:
-                pass
-            else:
-                # compute the diffuse contribution
-                diffuse_specular_sum += effective_color * material.diffuse * light_dot_normal * intensity_pct
-
-                # reflect_dot_eye represents the cosine of the angel between the
-                # reflection vector and the eye vector.  A negative number means the
-                # light reflects away from the eye
-                reflectv = rt.reflect(-lightv, normalv)
-                reflect_dot_eye = rt.dot(reflectv, eyev)
-                if reflect_dot_eye <= 0:
-                    pass
-                else:
-                    # compute the specular contribution
-                    factor = math.pow(reflect_dot_eye, material.shininess)
-                    diffuse_specular_sum += self.intensity * material.specular * factor * intensity_pct
+                continue
+            # the diffuse contribution
+            diffuse_sum += light_dot_normal
+            lit = True
+
+            # reflect_dot_eye represents the cosine of the angel between the
+            # reflection vector and the eye vector, reflecting as reflect() does.  A negative number means the
+            # light reflects away from the eye
+            twodot = 2 * (-lx * nx + -ly * ny + -lz * nz)
+            reflect_dot_eye = (-lx - nx * twodot) * ex + (-ly - ny * twodot) * ey + (-lz - nz * twodot) * ez
+            if reflect_dot_eye > 0:
+                # the specular contribution
+                specular_sum += math.pow(reflect_dot_eye, shininess)
+                shiny = True
 
-        return ambient + (diffuse_specular_sum / len(sample_list))
+        diffuse_specular_sum = rt.Color(0, 0, 0)
+        if lit:
+            diffuse_specular_sum += effective_color * material.diffuse * diffuse_sum * scale
+        if shiny:
+            diffuse_specular_sum += self.intensity * material.specular * specular_sum * scale
+
+        return ambient + (diffuse_specular_sum / len(directions))
 
     def intensity_at(self, world, point):
+        return self.decay_at(point)
+
+    def decay_at(self, point):
+        # the fraction of the light's intensity that reaches point, were nothing in the way
         if self.decays:
             dist_squared = (self.position - point).magnitudesquared()
             if dist_squared > 0:
@@ -69,6 +143,25 @@ class Light:
         else:
             return 1.0
 
+    def max_contribution(self, point, over_point, normalv, material=None, color=None):
+        # the most this light could add to any channel of the diffuse and specular light at a point on a surface,
+        # whatever is in the way; see World.pick_lights().  Without a material, it is a fraction of a white light of
+        # intensity 1 shining straight on the point.  color is surface_color() at the point.
+        if rt.dot(self.position - point, normalv) < 0:
+            # the light is behind the surface
+            return 0.0
+        return self.max_reflected(material, color) * self.decay_at(over_point)
+
+    def max_reflected(self, material, color):
+        # the brightest channel of the light times the most of it the material sends back, diffuse and specular
+        brightest = max(self.intensity.arr[0:3])
+        if material is None:
+            return brightest
+        diffuse = material.diffuse
+        if color is not None:
+            diffuse *= max(color.arr[0:3])
+        return brightest * (diffuse + material.specular)
+
     def position_samples(self):
         return [self.position]
 
@@ -79,24 +172,17 @@ class PointLight(Light):
         super().__init__(position, intensity, decays, decayfactor)
 
     def intensity_at(self, world, point):
-        if world.is_shadowed(point, self.position):
+        if world.is_shadowed(point, self.position, self):
             return 0.0
         else:
-            if self.decays:
-                dist_squared = (self.position - point).magnitudesquared()
-                if dist_squared > 0:
-                    return 1 / (4 * math.pi * dist_squared * self.decayfactor)
-                else:
-                    return math.inf
-            else:
-                return 1.0
+            return self.decay_at(point)
 
 
 class AreaLight(Light):
-    __slots__ = ['corner', 'uvec', 'usteps', 'vvec', 'vsteps', 'samples', 'jitter']
+    __slots__ = ['corner', 'uvec', 'usteps', 'vvec', 'vsteps', 'samples', 'jitter', 'adaptive']
 
     def __init__(self, corner, full_uvec, usteps, full_vvec, vsteps, jitter, intensity,
-                 decays=False, decayfactor=1.0 / (4 * math.pi)):
+                 decays=False, decayfactor=1.0 / (4 * math.pi), adaptive=False):
         posx = (full_uvec.x + full_vvec.x) / 2 + corner.x
         posy = (full_uvec.y + full_vvec.y) / 2 + corner.y
         posz = (full_uvec.z + full_vvec.z) / 2 + corner.z
@@ -108,6 +194,9 @@ class AreaLight(Light):
         self.vsteps = vsteps
         self.samples = usteps * vsteps
         self.jitter = jitter
+        # with adaptive set, the corners and centre of the light are tried first, and only if some of them are
+        # shadowed and some not is the point in the penumbra and worth the full set of samples
+        self.adaptive = adaptive
 
     def point_on_light(self, u, v):
         # 0, 0 is the cell nearest the corner
@@ -116,26 +205,64 @@ class AreaLight(Light):
         else:
             return self.corner + (self.uvec * (u + 0.5)) + (self.vvec * (v + 0.5))
 
+    def probe_positions(self):
+        # the four corners of the light and its centre
+        full_uvec = self.uvec * self.usteps
+        full_vvec = self.vvec * self.vsteps
+        return [self.corner, self.corner + full_uvec, self.corner + full_vvec, self.corner + full_uvec + full_vvec,
+                self.position]
+
+    def max_contribution(self, point, over_point, normalv, material=None, color=None):
+        # part of the light may be in front of the surface even when its centre is behind
+        return self.max_reflected(material, color) * self.decay_at(over_point)
+
+    def shadowed_samples(self, world, point, positions):
+        # world.shadowed_from() for positions, which are samples of this light
+        if self.adaptive and self.samples > 5:
+            probes = world.shadowed_from(point, self.probe_positions(), self)
+            if all(probes):
+                return [True] * len(positions)
+            if not any(probes):
+                return [False] * len(positions)
+        return world.shadowed_from(point, positions, self)
+
     def intensity_at(self, world, point):
-        count = 0
-        for u in range(self.usteps):
-            for v in range(self.vsteps):
-                if not world.is_shadowed(point, self.point_on_light(u, v)):
-                    count += 1
-        if self.decays:
-            dist_squared = (self.position - point).magnitudesquared()
-            if dist_squared > 0:
-                return count / (self.samples * 4 * math.pi * dist_squared * self.decayfactor)
+        count = self.shadowed_samples(world, point, self.position_samples()).count(False)
+        return count / self.samples * self.decay_at(point)
+
+    def light_samples(self, world, point, over_point):
+        # shadow rays go to the same jittered positions the surface is shaded from, and only the visible ones light it
+        positions = self.position_samples()
+        shadowed = self.shadowed_samples(world, over_point, positions)
+        px, py, pz = point.arr[0:3]
+        directions = []
+        for pos, blocked in zip(positions, shadowed):
+            if blocked:
+                directions.append(None)
             else:
-                return math.inf
-        else:
-            return count / self.samples
+                x, y, z = pos.arr[0:3]
+                x -= px
+                y -= py
+                z -= pz
+                mag = math.sqrt(x * x + y * y + z * z)
+                directions.append(vector_from_floats(x / mag, y / mag, z / mag))
+        return self.decay_at(over_point), directions
 
     def position_samples(self):
+        # point_on_light() for every cell, worked out on floats, as there are a lot of them for every point shaded
+        cx, cy, cz = self.corner.arr[0:3]
+        ux, uy, uz = self.uvec.arr[0:3]
+        vx, vy, vz = self.vvec.arr[0:3]
         ret = []
         for u in range(self.usteps):
             for v in range(self.vsteps):
-                ret.append(self.point_on_light(u, v))
+                if self.jitter:
+                    su = u + random.random()
+                    sv = v + random.random()
+                else:
+                    su = u + 0.5
+                    sv = v + 0.5
+                ret.append(point_from_floats(cx + ux * su + vx * sv, cy + uy * su + vy * sv, cz + uz * su + vz * sv))
         return ret
 
 
@@ -190,13 +317,16 @@ class SpotLight(Light):
         self.__cos_diff = self.__cos_falloffstart - self.__cos_totalwidth
 
     def intensity_at(self, world, point):
+        if world.is_shadowed(point, self.position, self):
+            return 0.0
+        return self.decay_at(point)
+
+    def decay_at(self, point):
         vec = rt.normalize(point - self.position)
         cosv = rt.dot(vec, self.direction)
         # if the cosine is greater than the falloffstart, it's full intensity.
         # if it is less than the totalwidth, it's zero
         # if it is between the two, it is proportional
-        if world.is_shadowed(point, self.position):
-            return 0.0
         if cosv > self.__cos_falloffstart:
             return 1.0
         if cosv < self.__cos_totalwidth:
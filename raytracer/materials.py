@@ -6,6 +6,10 @@ from .objects import ONEMINUSEPSILON
 class Pattern:
     __slots__ = ['__transform', 'inversetransform']
 
+    # patterns that can filter themselves over the patch of surface a ray sees set this, and override
+    # filtered_color_at()
+    usesfootprint = False
+
     def __init__(self, transform=None):
         if transform is None:
             self.transform = rt.identity4()
@@ -25,6 +29,10 @@ class Pattern:
         # point is in pattern space
         return rt.Color(1.0, 1.0, 1.0)
 
+    def filtered_color_at(self, pattern_point, *edge_points):
+        # edge_points are points in pattern space on the edge of the patch of surface seen around pattern_point
+        return self.color_at(pattern_point)
+
 
 class TestPattern(Pattern):
     def __init__(self, transform=None):
@@ -3,7 +3,67 @@ import math
 import raytracer as rt
 
 
+class AffineMatrix(list):
+    # A 4x4 matrix, as a list of rows like any other, whose bottom row is [0, 0, 0, 1].  Every transform made by
+    # transformations.py is one, as are products and inverses of them.  Those leave w alone, so the functions here
+    # skip the bottom row for them, and the inverse is worked out from the 3x3 part instead of by np.linalg.inv.
+    # Changing the bottom row of one in place is not supported.
+    __slots__ = ()
+
+
+def is_affine(a):
+    a3 = a[3]
+    return a3[0] == 0 and a3[1] == 0 and a3[2] == 0 and a3[3] == 1
+
+
+def matmul_affine(a, b):
+    # matmul4x4() for two AffineMatrix: 36 multiplies instead of 64
+    a00, a01, a02, a03 = a[0]
+    a10, a11, a12, a13 = a[1]
+    a20, a21, a22, a23 = a[2]
+    b00, b01, b02, b03 = b[0]
+    b10, b11, b12, b13 = b[1]
+    b20, b21, b22, b23 = b[2]
+    return AffineMatrix([[a00 * b00 + a01 * b10 + a02 * b20, a00 * b01 + a01 * b11 + a02 * b21,
+                          a00 * b02 + a01 * b12 + a02 * b22, a00 * b03 + a01 * b13 + a02 * b23 + a03],
+                         [a10 * b00 + a11 * b10 + a12 * b20, a10 * b01 + a11 * b11 + a12 * b21,
+                          a10 * b02 + a11 * b12 + a12 * b22, a10 * b03 + a11 * b13 + a12 * b23 + a13],
+                         [a20 * b00 + a21 * b10 + a22 * b20, a20 * b01 + a21 * b11 + a22 * b21,
+                          a20 * b02 + a21 * b12 + a22 * b22, a20 * b03 + a21 * b13 + a22 * b23 + a23],
+                         [0.0, 0.0, 0.0, 1.0]])
+
+
+def inverse_affine(a):
+    # The inverse of [[M, t], [0, 1]] is [[M^-1, -M^-1 t], [0, 1]], and M^-1 is the transposed cofactors of M
+    # over its determinant.  Returns None if M is singular.
+    a00, a01, a02, a03 = a[0]
+    a10, a11, a12, a13 = a[1]
+    a20, a21, a22, a23 = a[2]
+    c00 = a11 * a22 - a12 * a21
+    c01 = a12 * a20 - a10 * a22
+    c02 = a10 * a21 - a11 * a20
+    det = a00 * c00 + a01 * c01 + a02 * c02
+    if det == 0:
+        return None
+    invdet = 1.0 / det
+    i00 = c00 * invdet
+    i01 = (a02 * a21 - a01 * a22) * invdet
+    i02 = (a01 * a12 - a02 * a11) * invdet
+    i10 = c01 * invdet
+    i11 = (a00 * a22 - a02 * a20) * invdet
+    i12 = (a02 * a10 - a00 * a12) * invdet
+    i20 = c02 * invdet
+    i21 = (a01 * a20 - a00 * a21) * invdet
+    i22 = (a00 * a11 - a01 * a10) * invdet
+    return AffineMatrix([[i00, i01, i02, -(i00 * a03 + i01 * a13 + i02 * a23)],
+                         [i10, i11, i12, -(i10 * a03 + i11 * a13 + i12 * a23)],
+                         [i20, i21, i22, -(i20 * a03 + i21 * a13 + i22 * a23)],
+                         [0.0, 0.0, 0.0, 1.0]])
+
+
 def matmul4x4(a, b):
+    if a.__class__ is AffineMatrix and b.__class__ is AffineMatrix:
+        return matmul_affine(a, b)
     a0 = a[0]
     a00 = a0[0]
     a01 = a0[1]
@@ -76,7 +136,7 @@ def matmul4x4(a, b):
 
 
 def identity4():
-    return [[1.0, 0.0, 0.0, 0.0], [0.0, 1.0, 0.0, 0.0], [0.0, 0.0, 1.0, 0.0], [0.0, 0.0, 0.0, 1.0]]
+    return AffineMatrix([[1.0, 0.0, 0.0, 0.0], [0.0, 1.0, 0.0, 0.0], [0.0, 0.0, 1.0, 0.0], [0.0, 0.0, 0.0, 1.0]])
 
 
 def transpose4x4(a):
@@ -92,6 +152,12 @@ def transpose4x4(a):
 
 
 def inverse4x4(a):
+    # a matrix given as plain lists gets the closed form too if its bottom row allows
+    if a.__class__ is AffineMatrix or is_affine(a):
+        inv = inverse_affine(a)
+        if inv is not None:
+            return inv
+    # singular, or not affine
     arr = np.array(a)
     inv = np.linalg.inv(arr)
     return inv.tolist()
@@ -101,7 +167,6 @@ def matmul4x1(a, b):
     a0 = a[0]
     a1 = a[1]
     a2 = a[2]
-    a3 = a[3]
 
     b0 = b[0]
     b1 = b[1]
@@ -111,15 +176,17 @@ def matmul4x1(a, b):
     c0 = a0[0] * b0 + a0[1] * b1 + a0[2] * b2 + a0[3] * b3
     c1 = a1[0] * b0 + a1[1] * b1 + a1[2] * b2 + a1[3] * b3
     c2 = a2[0] * b0 + a2[1] * b1 + a2[2] * b2 + a2[3] * b3
+    if a.__class__ is AffineMatrix:
+        # points stay points and vectors stay vectors
+        return [c0, c1, c2, b3]
+    a3 = a[3]
     c3 = a3[0] * b0 + a3[1] * b1 + a3[2] * b2 + a3[3] * b3
 
     return [c0, c1, c2, c3]
 
 
 def matmul4xTuple(a, tup):
-    res = rt.RT_Tuple()
-    res.arr = matmul4x1(a, tup.arr)
-    return res
+    return rt.rttuple.tuple_from_arr(matmul4x1(a, tup.arr))
 
 
 def allclose4x4(a, b):
@@ -1,10 +1,13 @@
+import copyreg
 import math
 import random
 from copy import deepcopy
+import numpy as np
 import raytracer as rt
-from .matrices import identity4, inverse4x4, transpose4x4
-from .transformations import scaling
+from .matrices import identity4, inverse4x4, transpose4x4, matmul4x4, is_affine
+from .transformations import scaling, ray_transform_for, pass_ray
 from .quarticsolver import quartic_solver
+from .bvh import NUMBINS, sah_divide, LinearBVH, BoxBVH
 
 
 class Intersection:
@@ -16,27 +19,43 @@ class Intersection:
 
 
 class IntersectionWithUV(Intersection):
-    __slots__ = ['u', 'v']
+    __slots__ = ['u', 'v', 'face']
 
-    def __init__(self, objhit, t, u, v):
+    def __init__(self, objhit, t, u, v, face=None):
         super().__init__(objhit, t)
         self.u = u
         self.v = v
+        # which face of a TriangleMesh was hit
+        self.face = face
 
 
 EPSILON = 0.0001
 ONEMINUSEPSILON = 1 - EPSILON
 
+# Goes up every time a transform is set or a child is added to a group, anywhere, so a World can tell that the
+# bounds of its objects may have changed since it built its top level hierarchy; see World.check_toplevel()
+GEOMETRYGENERATION = 0
+
+
+def geometry_changed():
+    global GEOMETRYGENERATION
+    GEOMETRYGENERATION += 1
+
+
+def geometry_generation():
+    return GEOMETRYGENERATION
+
 
 class HittableObject:
-    __slots__ = ['material', '__transform', 'inversetransform', '__inversetransformtranspose', 'casts_shadow',
-                 'parent', 'boundingbox']
+    __slots__ = ['material', '__transform', 'inversetransform', 'raytransform', 'casts_shadow', 'parent',
+                 'boundingbox', 'worldinverse', 'worldnormal']
 
     def __init__(self, transform=None, material=None, casts_shadow=True, parent=None):
+        # parent first, as setting the transform looks at it
+        self.parent = parent
         self.transform = transform or rt.identity4()
         self.material = material or rt.Material()
         self.casts_shadow = casts_shadow
-        self.parent = parent
         self.boundingbox = None
 
     @property
@@ -47,7 +66,48 @@ class HittableObject:
     def transform(self, trans):
         self.__transform = trans
         self.inversetransform = inverse4x4(self.__transform)
-        self.__inversetransformtranspose = transpose4x4(self.inversetransform)
+        # takes rays into object space; see ray_transform_for()
+        self.raytransform = ray_transform_for(self.inversetransform)
+        self.invalidate_world_matrices()
+        # a group with the identity transform may have been collapsed into the compiled hierarchies above it
+        if self.parent is not None:
+            self.parent.invalidate_linearbvh()
+        geometry_changed()
+
+    def invalidate_linearbvh(self):
+        # the compiled hierarchy of this object if it is a group, and of any group above it, may have collapsed
+        # this group into it, so all of them need to be rebuilt the next time they are intersected.
+        obj = self
+        while obj is not None:
+            if isinstance(obj, ObjectGroup):
+                obj.linearbvh = None
+            obj = obj.parent
+
+    def invalidate_world_matrices(self):
+        # world_inverse() and world_normal_matrix() fold in the transforms of every ancestor, so they are thrown
+        # away here and below when a transform is set or an object is added to a group.  Overridden for
+        # ObjectGroups and CSGs to pass it on to their children.
+        self.worldinverse = None
+        self.worldnormal = None
+
+    def world_inverse(self):
+        # world space to object space in one matrix, computed once instead of walking up the parents for every
+        # point
+        if self.worldinverse is None:
+            if self.parent is None:
+                self.worldinverse = self.inversetransform
+            else:
+                self.worldinverse = matmul4x4(self.inversetransform, self.parent.world_inverse())
+        return self.worldinverse
+
+    def world_normal_matrix(self):
+        if self.worldnormal is None:
+            self.worldnormal = transpose4x4(self.world_inverse())
+        return self.worldnormal
+
+    def freeze(self):
+        # computes the world matrices now rather than on the first hit, e.g. before render processes are forked
+        self.world_normal_matrix()
 
     def includes(self, obj):
         # used for CSGs.  An object always includes itself.  Overridden for ObjectGroups and CSGs
@@ -55,7 +115,7 @@ class HittableObject:
 
     def intersect(self, r):
         # returns a list of intersections
-        object_ray = rt.do_transformray(self.inversetransform, r)
+        object_ray = self.raytransform(self.inversetransform, r)
         return self.local_intersect(object_ray)
 
     def local_intersect(self, object_ray):
@@ -63,6 +123,39 @@ class HittableObject:
         # ray should be converted to object space by intersect() before calling this
         return []
 
+    def occluded(self, r, maxdist):
+        # any-hit query for shadow rays.  Returns an object that casts a shadow and is hit with 0 < t < maxdist,
+        # or None.  Transforms don't normalize the ray direction, so t is the same in every space.
+        object_ray = self.raytransform(self.inversetransform, r)
+        return self.local_occluded(object_ray, maxdist)
+
+    def occluded_packet(self, packet, mask):
+        # occluded() for the rays of a RayPacket that are in mask, marking the ones that are blocked.  Groups walk
+        # their hierarchy with the whole packet; everything else is tested a ray at a time.
+        packet.occlude_each(self, mask)
+
+    def local_occluded(self, object_ray, maxdist):
+        # primitives get this for free from local_intersect(); no need to sort, any hit in range will do
+        for i in self.local_intersect(object_ray):
+            if 0 < i.t < maxdist and i.objhit.casts_shadow:
+                return i.objhit
+        return None
+
+    def closest_hit(self, r):
+        # returns the nearest intersection with r.tmin < t < r.tmax, or None
+        object_ray = self.raytransform(self.inversetransform, r)
+        return self.local_closest_hit(object_ray)
+
+    def local_closest_hit(self, object_ray):
+        tmin = object_ray.tmin
+        best = None
+        besttmax = object_ray.tmax
+        for i in self.local_intersect(object_ray):
+            if tmin < i.t < besttmax:
+                best = i
+                besttmax = i.t
+        return best
+
     def normal_at(self, point, uv_intersection=None):
         object_point = self.world_to_object(point)
         object_normal = self.local_normal_at(object_point, uv_intersection)
@@ -77,20 +170,13 @@ class HittableObject:
         return NotImplementedError
 
     def world_to_object(self, world_point):
-        if self.parent is not None:
-            return rt.matmul4xTuple(self.inversetransform, self.parent.world_to_object(world_point))
-        else:
-            return rt.matmul4xTuple(self.inversetransform, world_point)
+        return rt.matmul4xTuple(self.world_inverse(), world_point)
 
     def normal_to_world(self, normal):
-        n = rt.matmul4xTuple(self.__inversetransformtranspose, normal)
+        # the normal matrix of each parent leaves w alone, so the product of them can be applied all at once
+        n = rt.matmul4xTuple(self.world_normal_matrix(), normal)
         n.w = 0
-        n = rt.normalize(n)
-
-        if self.parent is not None:
-            return self.parent.normal_to_world(n)
-        else:
-            return n
+        return rt.normalize(n)
 
     def bounds_of(self):
         if self.boundingbox is None:
@@ -104,6 +190,9 @@ class HittableObject:
     def divide(self, threshold):
         pass
 
+    def divide_sah(self, threshold, numbins=NUMBINS):
+        pass
+
     # TODO - this could be done more cleanly but it works
     def push_material_to_children(self):
         # takes the material of the group and sets all children to have this material
@@ -149,13 +238,13 @@ class Sphere(HittableObject):
         # speedup from mpraytracer, factoring in that center is always 0,0,0 and
         # radius is always 1, and we use transform to move the ray:
 
-        # TODO - since we never change the origin of the sphere, we could
-        # just create a vector out of object_ray.origin.x/y/z and save the
-        # 4 subtractions that are done here in the tuple subtract.
-        sphere_to_ray = object_ray.origin - self.origin
-        a = rt.dot(object_ray.direction, object_ray.direction)
-        half_b = rt.dot(object_ray.direction, sphere_to_ray)
-        c = rt.dot(sphere_to_ray, sphere_to_ray) - 1
+        # since we never change the origin of the sphere, sphere_to_ray is just the ray origin, so the dot
+        # products are done directly on the floats.
+        ox, oy, oz = object_ray.origin.arr[0:3]
+        dx, dy, dz = object_ray.direction.arr[0:3]
+        a = dx * dx + dy * dy + dz * dz
+        half_b = dx * ox + dy * oy + dz * oz
+        c = ox * ox + oy * oy + oz * oz - 1
         discriminant = (half_b * half_b) - (a * c)
 
         if discriminant < 0:
@@ -166,6 +255,53 @@ class Sphere(HittableObject):
             t2 = (-half_b + sqrtd) / a
             return [Intersection(self, t1), Intersection(self, t2)]
 
+    def local_occluded(self, object_ray, maxdist):
+        # same as local_intersect() without building the Intersections
+        if not self.casts_shadow:
+            return None
+        ox, oy, oz = object_ray.origin.arr[0:3]
+        dx, dy, dz = object_ray.direction.arr[0:3]
+        a = dx * dx + dy * dy + dz * dz
+        half_b = dx * ox + dy * oy + dz * oz
+        c = ox * ox + oy * oy + oz * oz - 1
+        discriminant = (half_b * half_b) - (a * c)
+        if discriminant < 0:
+            return None
+        sqrtd = math.sqrt(discriminant)
+        if 0 < (-half_b - sqrtd) / a < maxdist or 0 < (-half_b + sqrtd) / a < maxdist:
+            return self
+        return None
+
+    def occluded_packet(self, packet, mask):
+        # local_occluded() for all the rays of the packet at once
+        if not self.casts_shadow:
+            return
+        mask = packet.vector_mask(self, mask)
+        if mask is None:
+            return
+        if self.raytransform is not pass_ray:
+            if not is_affine(self.inversetransform):
+                packet.occlude_each(self, mask)
+                return
+            packet = packet.transformed(self.inversetransform)
+        ox = packet.ox
+        oy = packet.oy
+        oz = packet.oz
+        dx = packet.dx
+        dy = packet.dy
+        dz = packet.dz
+        a = dx * dx + dy * dy + dz * dz
+        half_b = dx * ox + dy * oy + dz * oz
+        c = ox * ox + oy * oy + oz * oz - 1
+        discriminant = (half_b * half_b) - (a * c)
+        with np.errstate(invalid='ignore'):
+            sqrtd = np.sqrt(discriminant)
+        t1 = (-half_b - sqrtd) / a
+        t2 = (-half_b + sqrtd) / a
+        maxdist = packet.maxdist
+        packet.mark(mask & (discriminant >= 0) &
+                    (((0 < t1) & (t1 < maxdist)) | ((0 < t2) & (t2 < maxdist))), self)
+
     def local_normal_at(self, object_point, uv_intersection=None):
         return object_point - self.origin
 
@@ -177,12 +313,38 @@ class Plane(HittableObject):
     def local_intersect(self, object_ray):
         # if ray is parallel to plane we say it misses (even if it's a
         # coplanar ray, cannot see an infinitely thin plane looking head on)
-        if math.fabs(object_ray.direction.y) <= EPSILON:
+        dy = object_ray.direction.arr[1]
+        if -EPSILON <= dy <= EPSILON:
             return []
         else:
-            t = -object_ray.origin.y / object_ray.direction.y
+            t = -object_ray.origin.arr[1] / dy
             return [Intersection(self, t)]
 
+    def local_occluded(self, object_ray, maxdist):
+        dy = object_ray.direction.arr[1]
+        if not self.casts_shadow or -EPSILON <= dy <= EPSILON:
+            return None
+        if 0 < -object_ray.origin.arr[1] / dy < maxdist:
+            return self
+        return None
+
+    def occluded_packet(self, packet, mask):
+        if not self.casts_shadow:
+            return
+        mask = packet.vector_mask(self, mask)
+        if mask is None:
+            return
+        if self.raytransform is not pass_ray:
+            if not is_affine(self.inversetransform):
+                packet.occlude_each(self, mask)
+                return
+            packet = packet.transformed(self.inversetransform)
+        dy = packet.dy
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = -packet.oy / dy
+        packet.mark(mask & ((dy < -EPSILON) | (dy > EPSILON)) & (0 < t) & (t < packet.maxdist),
+                    self)
+
     def local_normal_at(self, object_point, uv_intersection=None):
         return rt.Vector(0, 1, 0)
 
@@ -216,14 +378,16 @@ class Cube(HittableObject):
         super().__init__(transform, material)
 
     def local_intersect(self, object_ray):
+        ro = object_ray.origin.arr
+        rd = object_ray.direction.arr
 
-        xtmin, xtmax = check_axis(object_ray.origin.x, object_ray.direction.x)
-        ytmin, ytmax = check_axis(object_ray.origin.y, object_ray.direction.y)
+        xtmin, xtmax = check_axis(ro[0], rd[0])
+        ytmin, ytmax = check_axis(ro[1], rd[1])
 
         if xtmin > ytmax or ytmin > xtmax:
             return []
 
-        ztmin, ztmax = check_axis(object_ray.origin.z, object_ray.direction.z)
+        ztmin, ztmax = check_axis(ro[2], rd[2])
 
         tmin = max(xtmin, ytmin, ztmin)
         tmax = min(xtmax, ytmax, ztmax)
@@ -233,6 +397,22 @@ class Cube(HittableObject):
         else:
             return [Intersection(self, tmin), Intersection(self, tmax)]
 
+    def occluded_packet(self, packet, mask):
+        if not self.casts_shadow:
+            return
+        mask = packet.vector_mask(self, mask)
+        if mask is None:
+            return
+        if self.raytransform is not pass_ray:
+            if not is_affine(self.inversetransform):
+                packet.occlude_each(self, mask)
+                return
+            packet = packet.transformed(self.inversetransform)
+        tmin, tmax = packet.slab_times((-1, -1, -1), (1, 1, 1))
+        maxdist = packet.maxdist
+        packet.mark(mask & (tmin <= tmax) &
+                    (((0 < tmin) & (tmin < maxdist)) | ((0 < tmax) & (tmax < maxdist))), self)
+
     def local_normal_at(self, object_point, uv_intersection=None):
         abs_point = (math.fabs(object_point.x), math.fabs(object_point.y), math.fabs(object_point.z))
         maxc = max(abs_point)
@@ -614,23 +794,39 @@ class Triangle(HittableObject):
 
     def local_intersect(self, object_ray):
         # https://en.wikipedia.org/wiki/M%C3%B6ller%E2%80%93Trumbore_intersection_algorithm
-        dir_cross_e2 = rt.cross(object_ray.direction, self.e2)
-        det = rt.dot(self.e1, dir_cross_e2)
-        if math.fabs(det) < EPSILON:
+        # the crosses and dots are written out on floats, as this is the innermost loop for meshes
+        dx, dy, dz = object_ray.direction.arr[0:3]
+        e1x, e1y, e1z = self.e1.arr[0:3]
+        e2x, e2y, e2z = self.e2.arr[0:3]
+
+        # dir_cross_e2
+        cx = dy * e2z - dz * e2y
+        cy = dz * e2x - dx * e2z
+        cz = dx * e2y - dy * e2x
+        det = e1x * cx + e1y * cy + e1z * cz
+        if -EPSILON < det < EPSILON:
             return []
 
         f = 1/det
-        p1_to_origin = object_ray.origin - self.p1
-        u = f * rt.dot(p1_to_origin, dir_cross_e2)
+        ro = object_ray.origin.arr
+        p1 = self.__p1.arr
+        # p1_to_origin
+        px = ro[0] - p1[0]
+        py = ro[1] - p1[1]
+        pz = ro[2] - p1[2]
+        u = f * (px * cx + py * cy + pz * cz)
         if u < 0 or u > 1:
             return []
 
-        origin_cross_e1 = rt.cross(p1_to_origin, self.e1)
-        v = f * rt.dot(object_ray.direction, origin_cross_e1)
+        # origin_cross_e1
+        qx = py * e1z - pz * e1y
+        qy = pz * e1x - px * e1z
+        qz = px * e1y - py * e1x
+        v = f * (dx * qx + dy * qy + dz * qz)
         if v < 0 or (u + v) > 1:
             return []
 
-        t = f * rt.dot(self.e2, origin_cross_e1)
+        t = f * (e2x * qx + e2y * qy + e2z * qz)
         return [IntersectionWithUV(self, t, u, v)]
 
     def local_normal_at(self, object_point, uv_intersection=None):
@@ -655,18 +851,182 @@ class SmoothTriangle(Triangle):
                (self.n1 * (1 - uv_intersection.u - uv_intersection.v))
 
 
+class TriangleMesh(HittableObject):
+    # Many triangles sharing one transform and material, kept in arrays rather than as a Triangle object each.
+    # vertices is an N x 3 array of points, and faces an M x 3 array of indices into it, counting from 0.  For smooth
+    # shading, normals is an array of vectors and normalfaces the indices into it for each face; a row of -1s makes
+    # that face flat.  The arrays are not copied, so meshes can share them.  The faces are put in a bounding volume
+    # hierarchy when the mesh is made, so the mesh is never divided; hits carry the number of the face in faces.
+    __slots__ = ['vertices', 'faces', 'normals', 'normalfaces', 'bvh', 'p1', 'e1', 'e2', 'order']
+
+    def __init__(self, vertices, faces, normals=None, normalfaces=None, transform=None, material=None):
+        super().__init__(transform, material)
+        self.vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+        self.faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+        self.normals = None if normals is None else np.asarray(normals, dtype=np.float64).reshape(-1, 3)
+        self.normalfaces = None if normalfaces is None else np.asarray(normalfaces, dtype=np.int64).reshape(-1, 3)
+
+        p1 = self.vertices[self.faces[:, 0]]
+        p2 = self.vertices[self.faces[:, 1]]
+        p3 = self.vertices[self.faces[:, 2]]
+        self.boundingbox = rt.BoundingBox()
+        if len(self.faces) > 0:
+            boxmin = np.minimum(np.minimum(p1, p2), p3)
+            boxmax = np.maximum(np.maximum(p1, p2), p3)
+            self.boundingbox.addpoint(rt.Point(*boxmin.min(axis=0).tolist()))
+            self.boundingbox.addpoint(rt.Point(*boxmax.max(axis=0).tolist()))
+            self.bvh = BoxBVH(boxmin, boxmax)
+            order = self.bvh.order
+        else:
+            self.bvh = None
+            order = np.zeros(0, dtype=np.int64)
+        # the corner and edges of every face, in the order of the hierarchy's leaves.  memoryviews of the arrays
+        # hand out plain floats, which is faster for the math one face at a time than indexing NumPy.
+        self.p1 = memoryview(np.ascontiguousarray(p1[order]).ravel())
+        self.e1 = memoryview(np.ascontiguousarray((p2 - p1)[order]).ravel())
+        self.e2 = memoryview(np.ascontiguousarray((p3 - p1)[order]).ravel())
+        self.order = memoryview(np.ascontiguousarray(order))
+
+    def __getstate__(self):
+        # memoryviews cannot be pickled or deep copied, so the arrays behind them are sent instead and wrapped again
+        # by __setstate__(), e.g. when RenderPool hands the world to its processes
+        state = {name: getattr(self, name) for name in copyreg._slotnames(type(self)) if hasattr(self, name)}
+        for name in ('p1', 'e1', 'e2', 'order'):
+            state[name] = state[name].obj
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        for name in ('p1', 'e1', 'e2', 'order'):
+            setattr(self, name, memoryview(getattr(self, name)))
+
+    def face_hits(self, object_ray, start, end):
+        # Moller-Trumbore against faces start to end of the hierarchy's order, as in Triangle.local_intersect().
+        # Returns (t, u, v, face) for each face hit, whatever the sign of t.
+        dx, dy, dz = object_ray.direction.arr[0:3]
+        ox, oy, oz = object_ray.origin.arr[0:3]
+        p1 = self.p1
+        e1 = self.e1
+        e2 = self.e2
+        hits = []
+        for k in range(start, end):
+            j = 3 * k
+            e1x = e1[j]
+            e1y = e1[j + 1]
+            e1z = e1[j + 2]
+            e2x = e2[j]
+            e2y = e2[j + 1]
+            e2z = e2[j + 2]
+            cx = dy * e2z - dz * e2y
+            cy = dz * e2x - dx * e2z
+            cz = dx * e2y - dy * e2x
+            det = e1x * cx + e1y * cy + e1z * cz
+            if -EPSILON < det < EPSILON:
+                continue
+            f = 1 / det
+            px = ox - p1[j]
+            py = oy - p1[j + 1]
+            pz = oz - p1[j + 2]
+            u = f * (px * cx + py * cy + pz * cz)
+            if u < 0 or u > 1:
+                continue
+            qx = py * e1z - pz * e1y
+            qy = pz * e1x - px * e1z
+            qz = px * e1y - py * e1x
+            v = f * (dx * qx + dy * qy + dz * qz)
+            if v < 0 or (u + v) > 1:
+                continue
+            hits.append((f * (e2x * qx + e2y * qy + e2z * qz), u, v, self.order[k]))
+        return hits
+
+    def local_intersect(self, object_ray):
+        if self.bvh is None:
+            return []
+        primstart = self.bvh.primstart
+        primend = self.bvh.primend
+        xs = []
+        for node in self.bvh.nodes_hit(object_ray, math.inf):
+            if primstart[node] < primend[node]:
+                for t, u, v, face in self.face_hits(object_ray, primstart[node], primend[node]):
+                    xs.append(IntersectionWithUV(self, t, u, v, face))
+        return xs
+
+    def local_occluded(self, object_ray, maxdist):
+        if self.bvh is None or not self.casts_shadow:
+            return None
+        primstart = self.bvh.primstart
+        primend = self.bvh.primend
+        for node in self.bvh.nodes_hit(object_ray, maxdist):
+            if primstart[node] < primend[node]:
+                for hit in self.face_hits(object_ray, primstart[node], primend[node]):
+                    if 0 < hit[0] < maxdist:
+                        return self
+        return None
+
+    def local_closest_hit(self, object_ray):
+        # object_ray.tmax is pulled in to each hit found, so nodes beyond it are skipped, as in LinearBVH
+        if self.bvh is None:
+            return None
+        primstart = self.bvh.primstart
+        primend = self.bvh.primend
+        tmin = object_ray.tmin
+        best = None
+        for node in self.bvh.nodes_hit(object_ray):
+            if primstart[node] < primend[node]:
+                for t, u, v, face in self.face_hits(object_ray, primstart[node], primend[node]):
+                    if tmin < t < object_ray.tmax:
+                        best = IntersectionWithUV(self, t, u, v, face)
+                        object_ray.tmax = t
+        return best
+
+    def local_normal_at(self, object_point, uv_intersection=None):
+        a, b, c = self.faces[uv_intersection.face].tolist()
+        if self.normalfaces is not None:
+            na, nb, nc = self.normalfaces[uv_intersection.face].tolist()
+            if na >= 0:
+                # interpolated as in SmoothTriangle
+                u = uv_intersection.u
+                v = uv_intersection.v
+                n1, n2, n3 = self.normals[[na, nb, nc]].tolist()
+                w = 1 - u - v
+                return rt.Vector(n2[0] * u + n3[0] * v + n1[0] * w, n2[1] * u + n3[1] * v + n1[1] * w,
+                                 n2[2] * u + n3[2] * v + n1[2] * w)
+        p1, p2, p3 = self.vertices[[a, b, c]].tolist()
+        e1 = rt.Vector(p2[0] - p1[0], p2[1] - p1[1], p2[2] - p1[2])
+        e2 = rt.Vector(p3[0] - p1[0], p3[1] - p1[1], p3[2] - p1[2])
+        return rt.normalize(rt.cross(e2, e1))
+
+    def bounds_of(self):
+        return self.boundingbox
+
+
 class ObjectGroup(HittableObject):
-    __slots__ = ['children']
+    __slots__ = ['children', 'linearbvh']
 
     def __init__(self, transform=identity4()):
-        super().__init__(transform, None)
         self.children = []
+        super().__init__(transform, None)
         self.boundingbox = rt.BoundingBox()
+        self.linearbvh = None
 
     def addchild(self, obj):
         obj.parent = self
+        obj.invalidate_world_matrices()
         self.children.append(obj)
         self.boundingbox += obj.parent_space_bounds_of()
+        self.invalidate_linearbvh()
+        geometry_changed()
+
+    def invalidate_world_matrices(self):
+        super().invalidate_world_matrices()
+        for child in self.children:
+            child.invalidate_world_matrices()
+
+    def freeze(self):
+        super().freeze()
+        for child in self.children:
+            child.freeze()
 
     def includes(self, obj):
         for child in self.children:
@@ -680,13 +1040,36 @@ class ObjectGroup(HittableObject):
     def local_intersect(self, object_ray):
         if len(self.children) == 0:
             return []
-        elif not self.bounds_of().intersects(object_ray):
-            return []
-        else:
-            xs = []
-            for child in self.children:
-                xs.extend(child.intersect(object_ray))
-            return xs
+        if self.linearbvh is None:
+            self.linearbvh = LinearBVH(self)
+        # this tests our own bounding box first
+        return self.linearbvh.intersect(object_ray)
+
+    def local_occluded(self, object_ray, maxdist):
+        if len(self.children) == 0:
+            return None
+        if self.linearbvh is None:
+            self.linearbvh = LinearBVH(self)
+        return self.linearbvh.occluded(object_ray, maxdist)
+
+    def local_closest_hit(self, object_ray):
+        if len(self.children) == 0:
+            return None
+        if self.linearbvh is None:
+            self.linearbvh = LinearBVH(self)
+        return self.linearbvh.closest_hit(object_ray)
+
+    def occluded_packet(self, packet, mask):
+        if len(self.children) == 0:
+            return
+        if self.linearbvh is None:
+            self.linearbvh = LinearBVH(self)
+        if self.raytransform is not pass_ray:
+            if not is_affine(self.inversetransform):
+                packet.occlude_each(self, mask)
+                return
+            packet = packet.transformed(self.inversetransform)
+        self.linearbvh.occluded_packet(packet, mask)
 
     def bounds_of(self):
         return self.boundingbox
@@ -730,6 +1113,14 @@ class ObjectGroup(HittableObject):
 
         for i in self.children:
             i.divide(threshold)
+        self.invalidate_linearbvh()
+
+    def divide_sah(self, threshold, numbins=NUMBINS):
+        # an alternative to divide() that builds the subgroups with the surface area heuristic, see bvh.py
+        for i in self.children:
+            i.divide_sah(threshold, numbins)
+        sah_divide(self, threshold, numbins)
+        self.invalidate_linearbvh()
 
 
 def intersection_allowed(oper, lhit, inl, inr):
@@ -751,15 +1142,25 @@ class CSG(HittableObject):
     __slots__ = ['left', 'right', 'operation']
 
     def __init__(self, operation, left, right):
-        super().__init__()
         if operation not in ['union', 'intersection', 'difference']:
             raise ValueError('Invalid operation: {}'.format(operation))
         self.operation = operation
         self.left = left
-        left.parent = self
         self.right = right
+        super().__init__()
+        left.parent = self
         right.parent = self
 
+    def invalidate_world_matrices(self):
+        super().invalidate_world_matrices()
+        self.left.invalidate_world_matrices()
+        self.right.invalidate_world_matrices()
+
+    def freeze(self):
+        super().freeze()
+        self.left.freeze()
+        self.right.freeze()
+
     def includes(self, obj):
         if self.left.includes(obj):
             return True
@@ -813,6 +1214,107 @@ class CSG(HittableObject):
         self.left.divide(threshold)
         self.right.divide(threshold)
 
+    def divide_sah(self, threshold, numbins=NUMBINS):
+        self.left.divide_sah(threshold, numbins)
+        self.right.divide_sah(threshold, numbins)
+
+
+class Instance(HittableObject):
+    # Another copy of prototype (a group, mesh, CSG or primitive), placed by this object's transform.  Any number of
+    # Instances can share one prototype, which is divided once by whoever made it and is never added to the scene
+    # itself, so its parent stays None.  Only the Instance has a place in the scene's hierarchy.  If material is
+    # given it is used for everything in the prototype, otherwise each primitive keeps its own.
+    #
+    # The primitives of the prototype do not know which Instance they were hit through, so hits are reported on an
+    # InstanceHit standing in for the pair.
+    __slots__ = ['prototype', 'hits']
+
+    def __init__(self, prototype, transform=None, material=None):
+        super().__init__(transform, None)
+        self.prototype = prototype
+        self.material = material
+        self.hits = {}  # primitive of the prototype -> its InstanceHit
+        self.boundingbox = prototype.parent_space_bounds_of()
+
+    def instance_hit(self, obj):
+        # the same InstanceHit every time, as refraction keeps track of which objects a ray is inside by identity
+        hit = self.hits.get(obj)
+        if hit is None:
+            hit = InstanceHit(self, obj)
+            self.hits[obj] = hit
+        return hit
+
+    def includes(self, obj):
+        return obj is self or (isinstance(obj, InstanceHit) and obj.instance is self)
+
+    def local_intersect(self, object_ray):
+        xs = self.prototype.intersect(object_ray)
+        for i in xs:
+            i.objhit = self.instance_hit(i.objhit)
+        return xs
+
+    def local_occluded(self, object_ray, maxdist):
+        if not self.casts_shadow:
+            return None
+        hit = self.prototype.occluded(object_ray, maxdist)
+        if hit is None:
+            return None
+        return self.instance_hit(hit)
+
+    def local_closest_hit(self, object_ray):
+        hit = self.prototype.closest_hit(object_ray)
+        if hit is not None:
+            hit.objhit = self.instance_hit(hit.objhit)
+        return hit
+
+    def local_normal_at(self, object_point, uv_intersection=None):
+        raise NotImplementedError('Instances do not have local normals, their InstanceHits do')
+
+    def freeze(self):
+        # the prototype's matrices are relative to the prototype, so they are shared by every Instance of it
+        super().freeze()
+        self.prototype.freeze()
+
+    def bounds_of(self):
+        return self.boundingbox
+
+
+class InstanceHit:
+    # A primitive of an Instance's prototype, as seen through that Instance.  It has the parts of HittableObject
+    # that shading uses, with the Instance's transforms wrapped around the primitive's own.
+    __slots__ = ['instance', 'obj']
+
+    def __init__(self, instance, obj):
+        self.instance = instance
+        self.obj = obj
+
+    @property
+    def material(self):
+        if self.instance.material is not None:
+            return self.instance.material
+        return self.obj.material
+
+    @property
+    def casts_shadow(self):
+        return self.instance.casts_shadow and self.obj.casts_shadow
+
+    def includes(self, obj):
+        return self is obj
+
+    def world_to_object(self, world_point):
+        return self.obj.world_to_object(self.instance.world_to_object(world_point))
+
+    def normal_to_world(self, normal):
+        return self.instance.normal_to_world(self.obj.normal_to_world(normal))
+
+    def local_normal_at(self, object_point, uv_intersection=None):
+        return self.obj.local_normal_at(object_point, uv_intersection)
+
+    def normal_at(self, point, uv_intersection=None):
+        object_point = self.world_to_object(point)
+        object_normal = self.local_normal_at(object_point, uv_intersection)
+        return self.normal_to_world(object_normal)
+
 
 class Volumetric():
     __slots__ = ['__absorption_coefficient', '__scattering_coefficient', '__extinction_coefficient', 'particle',
@@ -1,153 +1,242 @@
-import math
+import os
+import tempfile
+import numpy as np
+from .texturestore import cache_key
 import raytracer as rt
 
+# OBJ files are read in one pass into arrays: the vertices and normals as N x 3 arrays of floats, and the faces of
+# each group as M x 3 arrays of indices into them, counting from 1 as the file does.  Triangle objects are only made
+# when a group is first asked for.  The arrays are saved in a .npz cache keyed by the file's path, size and
+# modification time, so reading the same file again does not parse the text.  obj_to_group(mesh=True) skips the
+# Triangles altogether and hands the arrays to a TriangleMesh per group.
+#
+# Set MESHCACHEDIR to None to turn the cache off.
+
+MESHCACHEDIR = os.path.join(tempfile.gettempdir(), 'raytracer_mesh_cache')
+
 
 class GroupInfo:
-    __slots__ = ['name', 'group']
+    # A named group of an OBJ file.  GroupInfo(name, group) wraps a group already built.  The parser makes them
+    # with from_faces() instead, keeping faces, the vertex indices of each triangle, and normalfaces, the normal
+    # indices or 0s for a triangle without normals, and only building the group when it is first asked for.
+    __slots__ = ['name', 'faces', 'normalfaces', 'parser', 'builtgroup']
 
-    def __init__(self, name, group):
+    def __init__(self, name, group=None):
         self.name = name
-        self.group = group
+        self.parser = None
+        self.faces = []
+        self.normalfaces = []
+        self.builtgroup = group
+
+    @classmethod
+    def from_faces(cls, name, parser, faces=None, normalfaces=None):
+        groupinfo = cls(name)
+        groupinfo.parser = parser
+        groupinfo.faces = faces if faces is not None else []
+        groupinfo.normalfaces = normalfaces if normalfaces is not None else []
+        return groupinfo
+
+    @property
+    def group(self):
+        if self.builtgroup is None and self.parser is not None:
+            self.builtgroup = rt.ObjectGroup()
+            vertices = self.parser.vertices
+            normals = self.parser.normals
+            for (a, b, c), (na, nb, nc) in zip(np.asarray(self.faces).tolist(), np.asarray(self.normalfaces).tolist()):
+                if na == 0:
+                    t = rt.Triangle(vertices[a], vertices[b], vertices[c])
+                else:
+                    t = rt.SmoothTriangle(vertices[a], vertices[b], vertices[c], normals[na], normals[nb], normals[nc])
+                self.builtgroup.addchild(t)
+        return self.builtgroup
+
+    @group.setter
+    def group(self, group):
+        self.builtgroup = group
+
+    def mesh(self):
+        # the file counts from 1, the mesh from 0, which turns the 0s of faces without normals into -1s
+        if self.parser is None:
+            raise ValueError('Group {} was not read by a Parser, so it has no faces to make a mesh of'.format(
+                self.name))
+        normals = self.parser.normalarray if self.parser.numnormals > 0 else None
+        normalfaces = np.asarray(self.normalfaces) - 1 if normals is not None else None
+        return rt.TriangleMesh(self.parser.vertexarray, np.asarray(self.faces) - 1, normals, normalfaces)
 
 
 class Parser:
-    __slots__ = ['vertices', 'groupinfos', 'normals']
+    __slots__ = ['vertexarray', 'normalarray', 'groups', 'vertexpoints', 'normalvectors']
 
     def __init__(self):
-        self.vertices = [None]
-        self.groupinfos = []
-        self.normals = [None]
+        self.vertexarray = np.zeros((0, 3))
+        self.normalarray = np.zeros((0, 3))
+        self.groups = {}  # group name -> GroupInfo, in the order they appear in the file
+        self.vertexpoints = None
+        self.normalvectors = None
 
     @property
     def numvertices(self):
-        return len(self.vertices) - 1
+        return len(self.vertexarray)
 
     @property
     def numnormals(self):
-        return len(self.normals) - 1
+        return len(self.normalarray)
 
-    def parse_obj_file(self, filename, autoscale=True):
-        self.vertices = [None]
-        self.groupinfos = []
-        self.normals = [None]
+    @property
+    def vertices(self):
+        # Points, with a None in front so they can be indexed the same way as in the file
+        if self.vertexpoints is None:
+            self.vertexpoints = [None] + [rt.Point(x, y, z) for x, y, z in self.vertexarray.tolist()]
+        return self.vertexpoints
 
-        minx = miny = minz = math.inf
-        maxx = maxy = maxz = -math.inf
-        sx = sy = sz = scale = 0
+    @property
+    def normals(self):
+        if self.normalvectors is None:
+            self.normalvectors = [None] + [rt.Vector(x, y, z) for x, y, z in self.normalarray.tolist()]
+        return self.normalvectors
 
-        if autoscale:
-            f = open(filename, 'r')
-            line = f.readline()
-            while line:
-                linesplit = line.split()
-                if len(linesplit) > 0:
-                    if linesplit[0] == 'v':
-                        assert len(linesplit) >= 4
-                        x = float(linesplit[1])
-                        y = float(linesplit[2])
-                        z = float(linesplit[3])
-                        if x < minx:
-                            minx = x
-                        if x > maxx:
-                            maxx = x
-                        if y < miny:
-                            miny = y
-                        if y > maxy:
-                            maxy = y
-                        if z < minz:
-                            minz = z
-                        if z > maxz:
-                            maxz = z
-
-                line = f.readline()
-            f.close()
-
-            if math.isinf(minx):
-                # there were no vertices in the file, just exit
+    @property
+    def groupinfos(self):
+        return list(self.groups.values())
+
+    def parse_obj_file(self, filename, autoscale=True):
+        self.vertexarray = np.zeros((0, 3))
+        self.normalarray = np.zeros((0, 3))
+        self.groups = {}
+        self.vertexpoints = None
+        self.normalvectors = None
+        cachefile = None
+        if MESHCACHEDIR is not None:
+            cachefile = os.path.join(MESHCACHEDIR, '{}-{}.npz'.format(cache_key(filename),
+                                                                      'scaled' if autoscale else 'unscaled'))
+            if os.path.exists(cachefile):
+                self.load_cache(cachefile)
                 return
 
-            print('Boundaries - ({}, {}, {}) to ({}, {}, {})'.format(minx, miny, minz, maxx, maxy, maxz))
-            sx = maxx-minx
-            sy = maxy-miny
-            sz = maxz-minz
-            scale = max(sx, sy, sz) / 2
+        self.parse_text(filename)
+        if autoscale:
+            if self.numvertices == 0:
+                # there were no vertices in the file, so there is nothing to scale or show
+                self.groups = {}
+                return
+            # see https://forum.raytracerchallenge.com/thread/27/triangle-mesh-normalization
+            minv = self.vertexarray.min(axis=0)
+            maxv = self.vertexarray.max(axis=0)
+            print('Boundaries - ({}, {}, {}) to ({}, {}, {})'.format(*minv.tolist(), *maxv.tolist()))
+            size = maxv - minv
+            scale = size.max() / 2
             print('Scale - {}'.format(scale))
+            if scale == 0:
+                raise ValueError('Cannot autoscale {}, all of its vertices are at the same point'.format(filename))
+            self.vertexarray = (self.vertexarray - (minv + size / 2)) / scale
 
-        f = open(filename, 'r')
-        current_groupname = ''
-        line = f.readline()
+        if cachefile is not None:
+            self.save_cache(cachefile)
 
-        while line:
-            linesplit = line.split()
-            if len(linesplit) > 0:
+    def parse_text(self, filename):
+        vertexvalues = []
+        normalvalues = []
+        groups = self.groups
+        current_groupname = ''
+        current_group = None
+        with open(filename, 'r') as f:
+            for line in f:
+                linesplit = line.split()
+                if len(linesplit) == 0:
+                    continue
                 # TODO - technically objects ('o') can be made up of groups ('g').
                 # however, we will treat objects and groups as synonyms for right now.
                 if linesplit[0] in ('g', 'o'):
                     assert len(linesplit) >= 2
                     # group name
                     current_groupname = linesplit[1]
-                else:
-                    current_group = self.get_group_by_name(current_groupname)
+                    current_group = None
+                    continue
+                if current_group is None:
+                    current_group = groups.get(current_groupname)
                     if current_group is None:
-                        current_group = rt.ObjectGroup()
-                        self.groupinfos.append(GroupInfo(current_groupname, current_group))
-                    if linesplit[0] == 'v':
-                        # vertex
-                        assert len(linesplit) >= 4
-                        x = float(linesplit[1])
-                        y = float(linesplit[2])
-                        z = float(linesplit[3])
-
-                        if autoscale:
-                            # scale it - see https://forum.raytracerchallenge.com/thread/27/triangle-mesh-normalization
-                            x = (x - (minx + sx/2)) / scale
-                            y = (y - (miny + sy/2)) / scale
-                            z = (z - (minz + sz/2)) / scale
-
-                        self.vertices.append(rt.Point(x, y, z))
-                    elif linesplit[0] == 'f':
-                        # face (a.k.a. polygons)
-                        assert len(linesplit) >= 4
-                        lsints = []
-                        normints = []
-                        i = 1
-                        while i < len(linesplit):
-                            vertexinfo = linesplit[i].split('/')
-                            if not vertexinfo[0].isdigit():
-                                break
-                            lsints.append(int(vertexinfo[0]))
-                            if len(vertexinfo) >= 2:
-                                normints.append(int(vertexinfo[2]))
-                            i += 1
-                        assert len(lsints) >= 3
-                        assert len(normints) == 0 or len(normints) == len(lsints)
-                        i = 2
-                        while i < len(lsints):
-                            if len(normints) == 0:
-                                t = rt.Triangle(self.vertices[lsints[0]], self.vertices[lsints[i-1]],
-                                                self.vertices[lsints[i]])
-                            else:
-                                t = rt.SmoothTriangle(self.vertices[lsints[0]], self.vertices[lsints[i-1]],
-                                                      self.vertices[lsints[i]], self.normals[normints[0]],
-                                                      self.normals[normints[i-1]], self.normals[normints[i]])
-                            i += 1
-                            current_group.addchild(t)
-                    elif linesplit[0] == 'vn':
-                        # vertex normals
-                        assert len(linesplit) >= 4
-                        self.normals.append(rt.Vector(float(linesplit[1]), float(linesplit[2]), float(linesplit[3])))
-            line = f.readline()
-        f.close()
+                        current_group = GroupInfo.from_faces(current_groupname, self)
+                        groups[current_groupname] = current_group
+                if linesplit[0] == 'v':
+                    # vertex
+                    assert len(linesplit) >= 4
+                    vertexvalues.append((float(linesplit[1]), float(linesplit[2]), float(linesplit[3])))
+                elif linesplit[0] == 'f':
+                    # face (a.k.a. polygons)
+                    assert len(linesplit) >= 4
+                    lsints = []
+                    normints = []
+                    for vertexinfo in linesplit[1:]:
+                        vertexinfo = vertexinfo.split('/')
+                        if not vertexinfo[0].isdigit():
+                            break
+                        lsints.append(int(vertexinfo[0]))
+                        if len(vertexinfo) >= 3:
+                            normints.append(int(vertexinfo[2]))
+                    assert len(lsints) >= 3
+                    assert len(normints) == 0 or len(normints) == len(lsints)
+                    # the faces are only turned into triangles later, so indices that do not name a vertex or
+                    # normal read so far are caught here rather than wrapping around to the end of the arrays
+                    if min(lsints) < 1 or max(lsints) > len(vertexvalues):
+                        raise ValueError('Face in {} uses a vertex that does not exist: {}'.format(
+                            filename, line.strip()))
+                    if normints and (min(normints) < 1 or max(normints) > len(normalvalues)):
+                        raise ValueError('Face in {} uses a normal that does not exist: {}'.format(
+                            filename, line.strip()))
+                    # split polygons into a fan of triangles
+                    for i in range(2, len(lsints)):
+                        current_group.faces.append((lsints[0], lsints[i-1], lsints[i]))
+                        if len(normints) == 0:
+                            current_group.normalfaces.append((0, 0, 0))
+                        else:
+                            current_group.normalfaces.append((normints[0], normints[i-1], normints[i]))
+                elif linesplit[0] == 'vn':
+                    # vertex normals
+                    assert len(linesplit) >= 4
+                    normalvalues.append((float(linesplit[1]), float(linesplit[2]), float(linesplit[3])))
+
+        self.vertexarray = np.array(vertexvalues, dtype=np.float64).reshape(-1, 3)
+        self.normalarray = np.array(normalvalues, dtype=np.float64).reshape(-1, 3)
+        for groupinfo in groups.values():
+            groupinfo.faces = np.array(groupinfo.faces, dtype=np.int32).reshape(-1, 3)
+            groupinfo.normalfaces = np.array(groupinfo.normalfaces, dtype=np.int32).reshape(-1, 3)
+
+    def save_cache(self, cachefile):
+        arrays = {'vertices': self.vertexarray, 'normals': self.normalarray,
+                  'groupnames': np.array(list(self.groups), dtype=np.str_)}
+        for i, groupinfo in enumerate(self.groups.values()):
+            arrays['faces{}'.format(i)] = groupinfo.faces
+            arrays['normalfaces{}'.format(i)] = groupinfo.normalfaces
+        try:
+            os.makedirs(MESHCACHEDIR, exist_ok=True)
+            # written under a temporary name and renamed, so other processes never see half a file
+            tmpfile = os.path.join(MESHCACHEDIR, 'tmp-{}-{}'.format(os.getpid(), os.path.basename(cachefile)))
+            np.savez(tmpfile, **arrays)
+            os.replace(tmpfile, cachefile)
+        except OSError:
+            print('Could not write mesh cache {}'.format(cachefile))
+
+    def load_cache(self, cachefile):
+        with np.load(cachefile) as arrays:
+            self.vertexarray = arrays['vertices']
+            self.normalarray = arrays['normals']
+            for i, name in enumerate(arrays['groupnames'].tolist()):
+                self.groups[name] = GroupInfo.from_faces(name, self, arrays['faces{}'.format(i)],
+                                                         arrays['normalfaces{}'.format(i)])
 
     def get_group_by_name(self, name=''):
-        for i in self.groupinfos:
-            if i.name == name:
-                return i.group
-
-        return None
-
-    def obj_to_group(self):
+        groupinfo = self.groups.get(name)
+        if groupinfo is None:
+            return None
+        return groupinfo.group
+
+    def obj_to_group(self, mesh=False):
+        # with mesh True, each group of the file is a TriangleMesh sharing the parser's arrays, rather than a group
+        # of Triangles
         g = rt.ObjectGroup()
-        for groupinfo in self.groupinfos:
-            g.addchild(groupinfo.group)
+        for groupinfo in self.groups.values():
+            if mesh:
+                g.addchild(groupinfo.mesh())
+            else:
+                g.addchild(groupinfo.group)
         return g
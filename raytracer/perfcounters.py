@@ -1,4 +1,6 @@
 import multiprocessing as mp
+import numpy as np
+from .imagefile import write_image
 
 
 COUNTER_RAYFORPIXEL = mp.Value('L', 0)
@@ -32,10 +34,10 @@ def getcount_refractionrays():
     return COUNTER_REFRACTIONRAYS.value
 
 
-def increment_rayforpixel():
+def increment_rayforpixel(n=1):
     global COUNTER_RAYFORPIXEL
     with COUNTER_RAYFORPIXEL.get_lock():
-        COUNTER_RAYFORPIXEL.value += 1
+        COUNTER_RAYFORPIXEL.value += n
 
 
 def getcount_rayforpixel():
@@ -87,19 +89,10 @@ def add_raycount(w, x, y, numrays):
 
 
 def save_raycount(width, height, filename):
-    maxv = -1
-    for i in range(width * height):
-        if COUNTER_RAYCOUNT[i] > maxv:
-            maxv = COUNTER_RAYCOUNT[i]
-
-    f = open(filename, 'w')
-    f.write("P3\n")
-    f.write("{} {}\n".format(width, height))
-    f.write("255\n")
-
-    for h in range(height):
-        for w in range(width):
-            val = int((COUNTER_RAYCOUNT[(h * width) + w] / maxv) * 255)
-            f.write('{} {} {}\n'.format(val, val, val))
-    f.close()
-    return maxv
\ No newline at end of file
+    # saves the rays cast per pixel as a grayscale image, brightest where the most rays were cast.  The format comes
+    # from the filename, see imagefile.write_image().
+    counts = np.array(COUNTER_RAYCOUNT[0:width * height])
+    maxv = int(counts.max())
+    val = (counts / maxv * 255).astype(np.int64)
+    write_image(filename, np.repeat(val, 3).reshape(height, width, 3))
+    return maxv
@@ -0,0 +1,136 @@
+import math
+import numpy as np
+import raytracer as rt
+from .objects import EPSILON
+
+# Shadow rays from one shading point to the samples of an AreaLight all start at the same place and head the same
+# way, so they mostly pass through the same boxes.  A RayPacket holds such a bundle as NumPy arrays and tests all of
+# them against a box at once, so walking a hierarchy costs one box test per node for the whole bundle, rather than
+# one per ray.  Spheres, planes and cubes are tested against the whole packet too; anything else a ray at a time.
+#
+# The coordinates are kept as separate arrays, and when every ray starts at the same point (as shadow rays do) the
+# origin is three plain floats, so the arithmetic on it is done once rather than once per ray.  All of it is done
+# in the same order as the scalar code, so a packet finds exactly what tracing its rays one at a time would.
+#
+# A ray stops taking part once something blocks it; blocked, and the object that did it, are shared by every
+# space the packet is transformed into.
+
+# fewer rays than this are cheaper to trace one at a time
+PACKETMINRAYS = 20
+# and once a packet gets down into the hierarchy, a primitive reached by fewer rays than this is tested one at a time
+PACKETMINPRIMRAYS = 4
+
+
+class RayPacket:
+    __slots__ = ['ox', 'oy', 'oz', 'dx', 'dy', 'dz', 'maxdist', 'blocked', 'occluders', 'rays']
+
+    def __init__(self, ox, oy, oz, dx, dy, dz, maxdist, blocked=None, occluders=None):
+        # the origin coordinates are floats or arrays, the direction coordinates arrays, and maxdist the distances
+        # along each ray to look for occluders
+        self.ox = ox
+        self.oy = oy
+        self.oz = oz
+        self.dx = dx
+        self.dy = dy
+        self.dz = dz
+        self.maxdist = maxdist
+        self.blocked = blocked if blocked is not None else np.zeros(len(maxdist), dtype=bool)
+        self.occluders = occluders if occluders is not None else [None] * len(maxdist)
+        self.rays = None
+
+    @classmethod
+    def shadow_rays(cls, point, positions):
+        # one ray from point to each of positions, which are Points, as World.is_shadowed() would make them
+        ox, oy, oz = point.arr[0:3]
+        targets = np.array([p.arr[0:3] for p in positions], dtype=np.float64)
+        vx = targets[:, 0] - ox
+        vy = targets[:, 1] - oy
+        vz = targets[:, 2] - oz
+        # summed in the same order as magnitude() and normalize()
+        distances = np.sqrt(vx * vx + vy * vy + vz * vz)
+        return cls(ox, oy, oz, vx / distances, vy / distances, vz / distances, distances)
+
+    def __len__(self):
+        return len(self.maxdist)
+
+    def ray_list(self):
+        # the rays as Rays, made the first time they are needed
+        if self.rays is None:
+            directions = zip(self.dx.tolist(), self.dy.tolist(), self.dz.tolist())
+            if np.ndim(self.ox) == 0:
+                origin = rt.Point(float(self.ox), float(self.oy), float(self.oz))
+                self.rays = [rt.Ray(origin, rt.Vector(dx, dy, dz)) for dx, dy, dz in directions]
+            else:
+                origins = zip(self.ox.tolist(), self.oy.tolist(), self.oz.tolist())
+                self.rays = [rt.Ray(rt.Point(ox, oy, oz), rt.Vector(dx, dy, dz))
+                             for (ox, oy, oz), (dx, dy, dz) in zip(origins, directions)]
+        return self.rays
+
+    def transformed(self, mat):
+        # the same rays in the space that mat takes them to, worked out as do_transformray() does.  blocked and
+        # occluders are shared with this packet.  The bottom row of mat is not used, so it must be [0, 0, 0, 1]:
+        # objects with any other transform test the packet a ray at a time instead.
+        m0, m1, m2 = mat[0:3]
+        ox = self.ox
+        oy = self.oy
+        oz = self.oz
+        dx = self.dx
+        dy = self.dy
+        dz = self.dz
+        return RayPacket(m0[0] * ox + m0[1] * oy + m0[2] * oz + m0[3],
+                         m1[0] * ox + m1[1] * oy + m1[2] * oz + m1[3],
+                         m2[0] * ox + m2[1] * oy + m2[2] * oz + m2[3],
+                         m0[0] * dx + m0[1] * dy + m0[2] * dz,
+                         m1[0] * dx + m1[1] * dy + m1[2] * dz,
+                         m2[0] * dx + m2[1] * dy + m2[2] * dz,
+                         self.maxdist, self.blocked, self.occluders)
+
+    def hits_box(self, bmin, bmax, mask):
+        # returns the rays of mask that are not blocked yet and hit the box from bmin to bmax no further away
+        # than maxdist.  bmin and bmax are sequences of 3 floats.
+        tmin, tmax = self.slab_times(bmin, bmax)
+        return mask & ~self.blocked & ~((tmin > tmax) | (tmax < 0) | (tmin > self.maxdist))
+
+    def slab_times(self, bmin, bmax):
+        # where each ray enters and leaves the box from bmin to bmax, found with the same arithmetic as
+        # check_axis() and LinearBVH.nodes_hit().  A ray that misses leaves before it enters.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tmin = None
+            tmax = None
+            for lo, hi, o, d in ((bmin[0], bmax[0], self.ox, self.dx), (bmin[1], bmax[1], self.oy, self.dy),
+                                 (bmin[2], bmax[2], self.oz, self.dz)):
+                parallel = np.abs(d) < EPSILON
+                t1 = np.where(parallel, (lo - o) * math.inf, (lo - o) / d)
+                t2 = np.where(parallel, (hi - o) * math.inf, (hi - o) / d)
+                near = np.minimum(t1, t2)
+                far = np.maximum(t1, t2)
+                tmin = near if tmin is None else np.maximum(tmin, near)
+                tmax = far if tmax is None else np.minimum(tmax, far)
+        return tmin, tmax
+
+    def vector_mask(self, obj, mask):
+        # for primitives that can test the whole packet: returns the rays of mask still to be tested, or None if
+        # there are none left or so few that they have been tested one at a time instead
+        mask = mask & ~self.blocked
+        count = np.count_nonzero(mask)
+        if count == 0:
+            return None
+        if count < PACKETMINPRIMRAYS:
+            self.occlude_each(obj, mask)
+            return None
+        return mask
+
+    def mark(self, hit, obj):
+        # the rays where hit is True are blocked by obj
+        self.blocked |= hit
+        for k in np.flatnonzero(hit).tolist():
+            self.occluders[k] = obj
+
+    def occlude_each(self, obj, mask):
+        # tests obj against each ray of mask that is still unblocked, a ray at a time
+        rays = self.ray_list()
+        for k in np.flatnonzero(mask & ~self.blocked).tolist():
+            hit = obj.occluded(rays[k], float(self.maxdist[k]))
+            if hit is not None:
+                self.blocked[k] = True
+                self.occluders[k] = hit
@@ -48,44 +48,40 @@ class RT_Tuple(object):
         return allclose4x1(self.arr, other.arr)
 
     def __neg__(self):
-        res = RT_Tuple()
-        res.arr = [-self.arr[0], -self.arr[1], -self.arr[2], -self.arr[3]]
-        return res
+        a = self.arr
+        return tuple_from_arr([-a[0], -a[1], -a[2], -a[3]])
 
     def __iadd__(self, other):
-        self.arr = [self.arr[0] + other.arr[0], self.arr[1] + other.arr[1],
-                    self.arr[2] + other.arr[2], self.arr[3] + other.arr[3]]
+        a = self.arr
+        b = other.arr
+        self.arr = [a[0] + b[0], a[1] + b[1], a[2] + b[2], a[3] + b[3]]
         return self
 
     def __add__(self, other):
-        res = RT_Tuple()
-        res.arr = [self.arr[0] + other.arr[0], self.arr[1] + other.arr[1],
-                   self.arr[2] + other.arr[2], self.arr[3] + other.arr[3]]
-        return res
+        a = self.arr
+        b = other.arr
+        return tuple_from_arr([a[0] + b[0], a[1] + b[1], a[2] + b[2], a[3] + b[3]])
 
     def __sub__(self, other):
-        res = RT_Tuple()
-        res.arr = [self.arr[0] - other.arr[0], self.arr[1] - other.arr[1],
-                   self.arr[2] - other.arr[2], self.arr[3] - other.arr[3]]
-        return res
+        a = self.arr
+        b = other.arr
+        return tuple_from_arr([a[0] - b[0], a[1] - b[1], a[2] - b[2], a[3] - b[3]])
 
     def __mul__(self, other):
-        res = RT_Tuple()
+        a = self.arr
         if isinstance(other, RT_Tuple):
-            res.arr = [self.arr[0] * other.arr[0], self.arr[1] * other.arr[1],
-                       self.arr[2] * other.arr[2], self.arr[3] * other.arr[3]]
+            b = other.arr
+            return tuple_from_arr([a[0] * b[0], a[1] * b[1], a[2] * b[2], a[3] * b[3]])
         else:
-            res.arr = [self.arr[0] * other, self.arr[1] * other, self.arr[2] * other, self.arr[3] * other]
-        return res
+            return tuple_from_arr([a[0] * other, a[1] * other, a[2] * other, a[3] * other])
 
     def __truediv__(self, other):
-        res = RT_Tuple()
+        a = self.arr
         if isinstance(other, RT_Tuple):
-            res.arr = [self.arr[0] / other.arr[0], self.arr[1] / other.arr[1],
-                       self.arr[2] / other.arr[2], self.arr[3] / other.arr[3]]
+            b = other.arr
+            return tuple_from_arr([a[0] / b[0], a[1] / b[1], a[2] / b[2], a[3] / b[3]])
         else:
-            res.arr = [self.arr[0] / other, self.arr[1] / other, self.arr[2] / other, self.arr[3] / other]
-        return res
+            return tuple_from_arr([a[0] / other, a[1] / other, a[2] / other, a[3] / other])
 
     def ispoint(self):
         return math.isclose(self.w, 1.0)
@@ -111,7 +107,36 @@ class RT_Tuple(object):
         return a0 * a0 + a1 * a1 + a2 * a2
 
 
+# Python-level allocation and attribute lookups are the biggest cost in the render loop.  The subclasses below
+# declare empty __slots__ so they do not carry a __dict__, and the hot paths build results through
+# tuple_from_arr() and its siblings, which wrap an already-computed list of floats without running __init__.
+
+
+new_tuple = object.__new__
+
+
+def tuple_from_arr(arr):
+    # wraps an existing [x, y, z, w] list in an RT_Tuple without copying it
+    res = new_tuple(RT_Tuple)
+    res.arr = arr
+    return res
+
+
+def point_from_floats(x, y, z):
+    res = new_tuple(Point)
+    res.arr = [x, y, z, 1.0]
+    return res
+
+
+def vector_from_floats(x, y, z):
+    res = new_tuple(Vector)
+    res.arr = [x, y, z, 0.0]
+    return res
+
+
 class Point(RT_Tuple):
+    __slots__ = []
+
     def __init__(self, x=0.0, y=0.0, z=0.0):
         super().__init__(x, y, z, 1.0)
 
@@ -120,6 +145,8 @@ class Point(RT_Tuple):
 
 
 class Vector(RT_Tuple):
+    __slots__ = []
+
     def __init__(self, x=0.0, y=0.0, z=0.0):
         super().__init__(x, y, z, 0.0)
 
@@ -128,6 +155,8 @@ class Vector(RT_Tuple):
 
 
 class Color(RT_Tuple):
+    __slots__ = []
+
     def __init__(self, r=0.0, g=0.0, b=0.0):
         super().__init__(r, g, b, 0.0)
 
@@ -159,12 +188,13 @@ class Color(RT_Tuple):
         self.arr[2] = b
 
     def __mul__(self, other):
-        res = Color()
+        a = self.arr
+        res = new_tuple(Color)
         if isinstance(other, RT_Tuple):
-            res.arr = [self.arr[0] * other.arr[0], self.arr[1] * other.arr[1],
-                       self.arr[2] * other.arr[2], self.arr[3] * other.arr[3]]
+            b = other.arr
+            res.arr = [a[0] * b[0], a[1] * b[1], a[2] * b[2], a[3] * b[3]]
         else:
-            res.arr = [self.arr[0] * other, self.arr[1] * other, self.arr[2] * other, self.arr[3] * other]
+            res.arr = [a[0] * other, a[1] * other, a[2] * other, a[3] * other]
         return res
 
 
@@ -174,24 +204,34 @@ WHITE = Color(1, 1, 1)
 
 
 class Ray:
-    __slots__ = ['origin', 'direction']
+    __slots__ = ['origin', 'direction', 'tmin', 'tmax', 'width', 'spread']
 
-    def __init__(self, origin=Point(), direction=Vector()):
+    def __init__(self, origin=Point(), direction=Vector(), tmin=0.0, tmax=math.inf, width=0.0, spread=0.0):
+        # only hits with tmin < t < tmax count for closest_hit().  intersect() ignores the interval and returns
+        # every intersection, as it always has.
+        # width and spread describe the beam the ray stands for: it is width across at the origin, and grows by
+        # spread for every unit travelled.  Texture lookups use it to pick how blurred a copy of the image to sample.
         self.origin = origin
         self.direction = direction
+        self.tmin = tmin
+        self.tmax = tmax
+        self.width = width
+        self.spread = spread
 
     def __str__(self):
         return 'Ray: orig:({}), dir:({})'.format(self.origin.arr, self.direction.arr)
 
     def at(self, t=0.0):
-        return self.origin + (self.direction * t)
+        o = self.origin.arr
+        d = self.direction.arr
+        return tuple_from_arr([o[0] + d[0] * t, o[1] + d[1] * t, o[2] + d[2] * t, o[3] + d[3] * t])
 
 
 def normalize(vec):
     # returns a vector which is the normalized version of self
-    mag = vec.magnitude()
-    res = vec / mag
-    return res
+    a = vec.arr
+    mag = math.sqrt(a[0] * a[0] + a[1] * a[1] + a[2] * a[2])
+    return tuple_from_arr([a[0] / mag, a[1] / mag, a[2] / mag, a[3] / mag])
 
 
 def dot(tup1, tup2):
@@ -205,7 +245,6 @@ def dot(tup1, tup2):
 
 def cross(vec1, vec2):
     # cross product of two vectors
-    res = Vector()
     v1arr = vec1.arr
     v2arr = vec2.arr
     v10 = v1arr[0]
@@ -215,15 +254,16 @@ def cross(vec1, vec2):
     v21 = v2arr[1]
     v22 = v2arr[2]
 
-    res.arr = [v11 * v22 - v12 * v21,
-               v12 * v20 - v10 * v22,
-               v10 * v21 - v11 * v20,
-               0.0]
-    return res
+    return vector_from_floats(v11 * v22 - v12 * v21,
+                              v12 * v20 - v10 * v22,
+                              v10 * v21 - v11 * v20)
 
 
 def reflect(v, n):
-    return v - (n * (dot(v, n) * 2))
+    a = v.arr
+    b = n.arr
+    twodot = 2 * (a[0] * b[0] + a[1] * b[1] + a[2] * b[2] + a[3] * b[3])
+    return tuple_from_arr([a[0] - b[0] * twodot, a[1] - b[1] * twodot, a[2] - b[2] * twodot, a[3] - b[3] * twodot])
 
 
 def tuples_are_close(tup1, tup2, abs_tol=1e-05, rel_tol=1e-05):
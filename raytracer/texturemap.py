@@ -1,6 +1,7 @@
 import math
+import weakref
 from .materials import Pattern
-from .canvas import get_canvasdims, pixel_at
+from .texturestore import TEXTUREREGISTRY
 import raytracer as rt
 
 
@@ -52,6 +53,10 @@ def cylindrical_map(point):
     return u, v
 
 
+# Whether u and v of a map wrap around, so that 0 and 1 are next to each other: the way round a sphere or
+# cylinder, and the repeats of a map taken modulo 1.  The faces of a cube, and any other map, do not.
+WRAPPINGMAPS = {spherical_map: (True, False), cylindrical_map: (True, True), planar_map: (True, True)}
+
 FACELEFT = 0
 FACERIGHT = 1
 FACEFRONT = 2
@@ -59,6 +64,10 @@ FACEBACK = 3
 FACEUP = 4
 FACEDOWN = 5
 
+# the axis each face of the cube is at right angles to, and which end of it the face is at
+FACEAXES = {FACELEFT: (0, -1), FACERIGHT: (0, 1), FACEFRONT: (2, 1), FACEBACK: (2, -1), FACEUP: (1, 1),
+            FACEDOWN: (1, -1)}
+
 
 def face_from_point(point):
     absx = math.fabs(point.x)
@@ -81,6 +90,25 @@ def face_from_point(point):
         return FACEFRONT
 
 
+def fold_onto_face(face, point, edge):
+    # For footprints on a cube.  An edge point on another face than point is moved onto face as if the cube were
+    # unfolded along the edge they share, keeping its distance from point across the surface.  It is then mirrored
+    # through point, so it stays on face and the face's map does not wrap it round to the far side.  Returns None
+    # for a point on the opposite face.
+    edgeface = face_from_point(edge)
+    if edgeface == face:
+        return edge
+    axis, sign = FACEAXES[face]
+    edgeaxis, edgesign = FACEAXES[edgeface]
+    if edgeaxis == axis:
+        return None
+    coords = list(edge.arr[0:3])
+    coords[edgeaxis] = edgesign * (1 + abs(sign - coords[axis]))
+    coords[axis] = sign
+    px, py, pz = point.arr[0:3]
+    return rt.Point(2 * px - coords[0], 2 * py - coords[1], 2 * pz - coords[2])
+
+
 def cube_uv_front(point):
     # u goes -1 .. 1 on the x axis
     # v goes -1 .. 1 on the y axis
@@ -203,14 +231,28 @@ class UVCheckersPattern(UVPattern):
             return self.color2
 
 
-# TODO - support more than one image pattern at a time
 class UVImagePattern(UVPattern):
-    __slots__ = ['width', 'height']
+    __slots__ = ['width', 'height', 'texture', 'usesfootprint', '__weakref__']
 
-    def __init__(self, filename, mapfn=None):
+    def __init__(self, filename, mapfn=None, filtered=True):
         super().__init__(mapfn or planar_map)
-        rt.canvas_from_ppm(filename, str(id(self)))
-        self.width, self.height = get_canvasdims(True, str(id(self)))
+        # with filtered False, rays always see the nearest pixel of the full size image, as uv_color_at() does
+        self.usesfootprint = filtered
+        self.texture = TEXTUREREGISTRY.acquire(filename)
+        self.width = self.texture.width
+        self.height = self.texture.height
+        # the pattern is a user of the texture until it is garbage collected
+        weakref.finalize(self, TEXTUREREGISTRY.release, self.texture)
+
+    def __setstate__(self, state):
+        # Deep copies, e.g. from push_material_to_children(), share the Texture and are users of it too, so they take
+        # their own reference.  Unpickled copies in render processes find their registry does not know the texture,
+        # and retain() and release() leave it alone.
+        dictstate, slotstate = state
+        for name, value in slotstate.items():
+            setattr(self, name, value)
+        TEXTUREREGISTRY.retain(self.texture)
+        weakref.finalize(self, TEXTUREREGISTRY.release, self.texture)
 
     def uv_color_at(self, u, v):
         # flip v over so it matches the image layout, with y at the top
@@ -218,12 +260,35 @@ class UVImagePattern(UVPattern):
 
         x = round(u * (self.width - 1))
         y = round(realv * (self.height - 1))
-        return pixel_at(x, y, True, str(id(self)))
+        return self.texture.pixel_at(x, y)
+
+    def footprint(self, u, v, edge_points):
+        # the longest distance in pixels of the image from u, v to where an edge point maps.  Where the map wraps
+        # around, a distance of more than half the image is the short way round.
+        wrapsu, wrapsv = WRAPPINGMAPS.get(self.mapfn, (False, False))
+        footprint = 0.0
+        for edge in edge_points:
+            eu, ev = self.mapfn(edge)
+            du = abs(eu - u)
+            if wrapsu:
+                du = min(du, 1 - du)
+            dv = abs(ev - v)
+            if wrapsv:
+                dv = min(dv, 1 - dv)
+            footprint = max(footprint, math.hypot(du * self.width, dv * self.height))
+        return footprint
+
+    def filtered_color_at(self, pattern_point, *edge_points):
+        u, v = self.mapfn(pattern_point)
+        footprint = self.footprint(u, v, edge_points)
+        return self.texture.sample(u * (self.width - 1), (1 - v) * (self.height - 1), footprint)
 
 
 class CubeMap(Pattern):
     __slots__ = ["leftpattern", "rightpattern", "frontpattern", "backpattern", "uppattern", "downpattern"]
 
+    usesfootprint = True
+
     def __init__(self):
         super().__init__(None)
         self.leftpattern = None
@@ -250,7 +315,7 @@ class CubeMap(Pattern):
         self.uppattern = UVAlignCheckPattern(brown, cyan, purple, red, yellow, rt.cube_uv_up)
         self.downpattern = UVAlignCheckPattern(purple, brown, green, blue, white, rt.cube_uv_down)
 
-    def color_at(self, pattern_point):
+    def face_pattern(self, pattern_point):
         face = face_from_point(pattern_point)
         if face == FACELEFT:
             pat = self.leftpattern
@@ -264,6 +329,19 @@ class CubeMap(Pattern):
             pat = self.uppattern
         else:
             pat = self.downpattern
+        return pat
+
+    def color_at(self, pattern_point):
+        pat = self.face_pattern(pattern_point)
+        u, v = pat.mapfn(pattern_point)
+        return pat.uv_color_at(u, v)
 
+    def filtered_color_at(self, pattern_point, *edge_points):
+        pat = self.face_pattern(pattern_point)
+        if pat.usesfootprint:
+            # edge points over a seam are brought round onto this face, so its map sees how far away they are
+            face = face_from_point(pattern_point)
+            folded = [fold_onto_face(face, pattern_point, edge) for edge in edge_points]
+            return pat.filtered_color_at(pattern_point, *[edge for edge in folded if edge is not None])
         u, v = pat.mapfn(pattern_point)
         return pat.uv_color_at(u, v)
@@ -0,0 +1,355 @@
+import glob
+import hashlib
+import math
+import os
+import tempfile
+import time
+from collections import OrderedDict
+import numpy as np
+from .rttuple import Color
+
+# Image textures.  Reading a big ASCII PPM takes seconds, so the first time a file is loaded its pixels are saved as
+# a binary .npy cache file, keyed by the file's path, size and modification time.  From then on the cache is opened
+# with np.load(mmap_mode='r'), which maps the file rather than reading it: loading is instant, pages are only read
+# when they are sampled, and render processes forked after loading share the same pages.
+#
+# Each texture also has a mip pyramid: the image halved again and again down to a single pixel, each pixel the
+# average of 2x2 pixels of the level above.  Sampling a level whose pixels are about the size of the patch of surface
+# a ray sees stops a minified texture shimmering without more samples per pixel.  The pyramid is built when the file is
+# first loaded and cached next to the pixels, in <key>.mip.npy, as one flat array of all the levels after the first.
+# The digest of the pixels, which TEXTUREREGISTRY uses to spot the same image under two names, is worked out while the
+# pixels are still in memory and cached in <key>.digest, so a cached texture is never read through just to hash it.
+#
+# Set TEXTURECACHEDIR to None to turn the cache off, in which case the pixels are kept in memory.
+#
+# Patterns get their textures through TEXTUREREGISTRY rather than calling load_texture() themselves, so every pattern
+# using the same image shares one Texture.
+
+TEXTURECACHEDIR = os.path.join(tempfile.gettempdir(), 'raytracer_texture_cache')
+TEXTUREMEMORYBUDGET = 512 * 1024 * 1024  # bytes of textures kept around after nothing uses them any more
+
+
+def ppm_header_tokens(data, count):
+    # returns the first count whitespace separated tokens of a PPM file held in bytes, skipping # comments, and the
+    # position just after the last one
+    tokens = []
+    pos = 0
+    while len(tokens) < count:
+        while pos < len(data) and data[pos:pos + 1].isspace():
+            pos += 1
+        if pos >= len(data):
+            break
+        if data[pos:pos + 1] == b'#':
+            while pos < len(data) and data[pos:pos + 1] not in (b'\n', b'\r'):
+                pos += 1
+            continue
+        start = pos
+        while pos < len(data) and not data[pos:pos + 1].isspace():
+            pos += 1
+        tokens.append(data[start:pos].decode('ascii', errors='replace'))
+    return tokens, pos
+
+
+def read_ppm(filename):
+    # Reads a P3 (ASCII) or P6 (binary) PPM file in bulk.  Returns a height x width x 3 array of the ints in the
+    # file, and the maximum color value.  Raises AssertionError if the file is not a PPM.
+    with open(filename, 'rb') as f:
+        data = f.read()
+    tokens, pos = ppm_header_tokens(data, 4)
+    assert len(tokens) == 4
+    assert tokens[0] in ('P3', 'P6')
+    assert tokens[1].isnumeric()
+    assert tokens[2].isnumeric()
+    assert tokens[3].isnumeric()
+    width = int(tokens[1])
+    height = int(tokens[2])
+    maxcolors = int(tokens[3])
+    size = 3 * width * height
+
+    if tokens[0] == 'P6':
+        # a single whitespace character separates the header from the pixels, which are one byte each, or two most
+        # significant byte first if maxcolors needs them
+        dtype = np.uint8 if maxcolors < 256 else np.dtype('>u2')
+        values = np.frombuffer(data, dtype=dtype, count=size, offset=pos + 1)
+    else:
+        # comments are only allowed on lines of their own, even in the pixel data
+        lines = data[pos:].decode('ascii').splitlines()
+        text = ' '.join([line for line in lines if not line.startswith('#')])
+        values = np.array(text.split(), dtype=np.int64)
+        if len(values) != size:
+            # a short file leaves the rest of the image black
+            padded = np.zeros(size, dtype=np.int64)
+            padded[0:min(size, len(values))] = values[0:size]
+            values = padded
+    values = values.astype(np.uint8 if maxcolors < 256 else np.uint16)
+    return values.reshape(height, width, 3), maxcolors
+
+
+def cache_key(filename):
+    st = os.stat(filename)
+    key = '{}|{}|{}'.format(os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def mip_sizes(height, width):
+    # the (height, width) of every level after the first, down to 1x1.  Odd sizes round up.
+    sizes = []
+    while height > 1 or width > 1:
+        height = (height + 1) // 2
+        width = (width + 1) // 2
+        sizes.append((height, width))
+    return sizes
+
+
+def build_mip_levels(values):
+    # returns the levels after the first as a list of arrays of the same dtype as values.  An odd row or column is
+    # repeated before halving, so the edge pixels are not darkened.
+    levels = []
+    level = values
+    while level.shape[0] > 1 or level.shape[1] > 1:
+        h, w = level.shape[0:2]
+        padded = np.pad(level.astype(np.float64), ((0, h % 2), (0, w % 2), (0, 0)), mode='edge')
+        average = (padded[0::2, 0::2] + padded[1::2, 0::2] + padded[0::2, 1::2] + padded[1::2, 1::2]) / 4
+        level = np.rint(average).astype(values.dtype)
+        levels.append(level)
+    return levels
+
+
+def split_mip_levels(flat, height, width):
+    # the inverse of concatenating the raveled levels, as views into flat
+    levels = []
+    start = 0
+    for h, w in mip_sizes(height, width):
+        levels.append(flat[start:start + h * w * 3].reshape(h, w, 3))
+        start += h * w * 3
+    return levels
+
+
+def content_digest(values, maxcolors):
+    h = hashlib.sha1()
+    h.update('{} {} {}'.format(values.shape[1], values.shape[0], maxcolors).encode('ascii'))
+    h.update(np.ascontiguousarray(values).data)
+    return h.hexdigest()
+
+
+class Texture:
+    # An image read by load_texture().  values is a height x width x 3 array of ints from 0 to maxcolors, usually
+    # memory mapped from the cache, and never written to.  levels is the mip pyramid, with levels[0] being values.
+    # digest is content_digest() of the pixels.
+    __slots__ = ['filename', 'width', 'height', 'maxcolors', 'values', 'levels', 'digest']
+
+    def __init__(self, filename, values, maxcolors, levels=None, digest=None):
+        self.filename = filename
+        self.height, self.width = values.shape[0:2]
+        self.maxcolors = maxcolors
+        self.values = values
+        if levels is None:
+            levels = build_mip_levels(values)
+        self.levels = [values] + levels
+        if digest is None:
+            digest = content_digest(values, maxcolors)
+        self.digest = digest
+
+    def __reduce__(self):
+        # Pickled, e.g. for RenderPool's processes, a texture mapped from the cache is sent as the names of its cache
+        # files, so each process maps the same pages rather than getting a copy of the pixels.  Others are sent whole.
+        mipfile = None
+        if len(self.levels) > 1:
+            mipfile = getattr(self.levels[1], 'filename', None)
+        cachefile = getattr(self.values, 'filename', None)
+        if cachefile is not None and (mipfile is not None or len(self.levels) == 1):
+            return map_texture, (self.filename, cachefile, mipfile, self.maxcolors, self.digest)
+        return Texture, (self.filename, np.asarray(self.values), self.maxcolors,
+                         [np.asarray(level) for level in self.levels[1:]], self.digest)
+
+    def __deepcopy__(self, memo):
+        # Materials are deep copied, e.g. by push_material_to_children().  The pixels never change, so copies share
+        # them rather than each reading the whole map into memory.  Whatever holds the copy has to take its own
+        # reference from the registry, as UVImagePattern does.
+        return self
+
+    def pixel_at(self, x, y):
+        r, g, b = self.values[y, x].tolist()
+        maxcolors = self.maxcolors
+        return Color(r / maxcolors, g / maxcolors, b / maxcolors)
+
+    def bilinear_at(self, level, x, y):
+        # x and y are in pixels of the first level, with pixel centers on whole numbers.  Blends the four pixels of
+        # the given level around the point, and returns r, g, b from 0 to maxcolors.  Each pixel of a level covers
+        # the pixels of the level above it averaged into it, so the pixel centers of the levels are lined up rather
+        # than their corners.
+        values = self.levels[level]
+        h, w = values.shape[0:2]
+        x = min(max((x + 0.5) * w / self.width - 0.5, 0.0), w - 1)
+        y = min(max((y + 0.5) * h / self.height - 0.5, 0.0), h - 1)
+        x0 = int(x)
+        y0 = int(y)
+        fx = x - x0
+        fy = y - y0
+        # one slice rather than four lookups; on the last row or column it is only one pixel wide
+        block = values[y0:y0 + 2, x0:x0 + 2].tolist()
+        r00, g00, b00 = block[0][0]
+        r10, g10, b10 = block[0][-1]
+        r01, g01, b01 = block[-1][0]
+        r11, g11, b11 = block[-1][-1]
+        w00 = (1 - fx) * (1 - fy)
+        w10 = fx * (1 - fy)
+        w01 = (1 - fx) * fy
+        w11 = fx * fy
+        return (r00 * w00 + r10 * w10 + r01 * w01 + r11 * w11,
+                g00 * w00 + g10 * w10 + g01 * w01 + g11 * w11,
+                b00 * w00 + b10 * w10 + b01 * w01 + b11 * w11)
+
+    def sample(self, x, y, footprint):
+        # Trilinear lookup.  x and y are as for bilinear_at(), and footprint is the width, in pixels of the first
+        # level, of what is being looked at.  The two levels whose pixels are nearest that size are blended.
+        maxcolors = self.maxcolors
+        if footprint <= 1:
+            r, g, b = self.bilinear_at(0, x, y)
+            return Color(r / maxcolors, g / maxcolors, b / maxcolors)
+        lod = min(math.log2(footprint), len(self.levels) - 1)
+        level = int(lod)
+        r, g, b = self.bilinear_at(level, x, y)
+        blend = lod - level
+        if blend > 0:
+            r2, g2, b2 = self.bilinear_at(level + 1, x, y)
+            r += (r2 - r) * blend
+            g += (g2 - g) * blend
+            b += (b2 - b) * blend
+        return Color(r / maxcolors, g / maxcolors, b / maxcolors)
+
+
+def map_texture(filename, cachefile, mipfile, maxcolors, digest):
+    # the Texture that load_texture() made from these cache files; see Texture.__reduce__()
+    values = np.load(cachefile, mmap_mode='r')
+    levels = None
+    if mipfile is not None:
+        levels = split_mip_levels(np.load(mipfile, mmap_mode='r'), values.shape[0], values.shape[1])
+    return Texture(filename, values, maxcolors, levels, digest)
+
+
+def load_texture(filename):
+    print('Loading {}'.format(filename))
+    timestart = time.time()
+    if TEXTURECACHEDIR is None:
+        values, maxcolors = read_ppm(filename)
+        texture = Texture(filename, values, maxcolors)
+    else:
+        key = cache_key(filename)
+        cached = glob.glob(os.path.join(TEXTURECACHEDIR, key + '-*.npy'))
+        digest = None
+        digestfile = os.path.join(TEXTURECACHEDIR, key + '.digest')
+        if cached:
+            maxcolors = int(os.path.splitext(cached[0])[0].rsplit('-', 1)[1])
+            try:
+                with open(digestfile) as f:
+                    digest = f.read().strip()
+            except OSError:
+                pass
+        else:
+            values, maxcolors = read_ppm(filename)
+            digest = content_digest(values, maxcolors)
+            cachefile = os.path.join(TEXTURECACHEDIR, '{}-{}.npy'.format(key, maxcolors))
+            try:
+                os.makedirs(TEXTURECACHEDIR, exist_ok=True)
+                # written under a temporary name and renamed, so other processes never see half a file
+                tmpfile = os.path.join(TEXTURECACHEDIR, 'tmp-{}-{}.npy'.format(os.getpid(), key))
+                np.save(tmpfile, values)
+                os.replace(tmpfile, cachefile)
+                cached = [cachefile]
+            except OSError:
+                print('Could not write texture cache {}'.format(cachefile))
+        if cached:
+            values = np.load(cached[0], mmap_mode='r')
+        if cached and not digest:
+            # caches written before digests were kept have to be read through once
+            digest = content_digest(values, maxcolors)
+        if cached and not os.path.exists(digestfile):
+            try:
+                tmpfile = os.path.join(TEXTURECACHEDIR, 'tmp-{}-{}.digest'.format(os.getpid(), key))
+                with open(tmpfile, 'w') as f:
+                    f.write(digest)
+                os.replace(tmpfile, digestfile)
+            except OSError:
+                print('Could not write texture cache {}'.format(digestfile))
+        levels = None
+        mipfile = os.path.join(TEXTURECACHEDIR, key + '.mip.npy')
+        if cached and os.path.exists(mipfile):
+            levels = split_mip_levels(np.load(mipfile, mmap_mode='r'), values.shape[0], values.shape[1])
+        elif cached:
+            levels = build_mip_levels(values)
+            try:
+                tmpfile = os.path.join(TEXTURECACHEDIR, 'tmp-{}-{}.mip.npy'.format(os.getpid(), key))
+                np.save(tmpfile, np.concatenate([level.ravel() for level in levels]))
+                os.replace(tmpfile, mipfile)
+                levels = split_mip_levels(np.load(mipfile, mmap_mode='r'), values.shape[0], values.shape[1])
+            except OSError:
+                print('Could not write texture cache {}'.format(mipfile))
+        texture = Texture(filename, values, maxcolors, levels, digest)
+    timeend = time.time()
+    print('{} loaded.'.format(filename))
+    print('Elapsed time: {} seconds'.format(timeend - timestart))
+    return texture
+
+
+def texture_bytes(texture):
+    return sum(level.nbytes for level in texture.levels)
+
+
+class TextureRegistry:
+    # Shares textures between everything that uses them.  A file is looked up first by its path, size and
+    # modification time, and then by the digest of its pixels, so two copies of the same image are also loaded
+    # once.  acquire(), retain() and release() count the users of each texture.  A texture nobody uses stays in the
+    # registry, in least recently used order, until the textures held add up to more than budget bytes.  Dropping a
+    # texture from the registry never breaks anything still holding it; it is only loaded again next time it is
+    # acquired.
+    __slots__ = ['budget', 'textures', 'refcounts', 'digests', 'loads']
+
+    def __init__(self, budget=TEXTUREMEMORYBUDGET):
+        self.budget = budget
+        self.textures = OrderedDict()  # content digest -> Texture, least recently used first
+        self.refcounts = {}  # content digest -> number of users
+        self.digests = {}  # cache_key() of a file -> content digest
+        self.loads = 0  # number of times a file was actually loaded
+
+    def acquire(self, filename):
+        digest = self.digests.get(cache_key(filename))
+        if digest is None or digest not in self.textures:
+            texture = load_texture(filename)
+            self.loads += 1
+            digest = texture.digest
+            self.digests[cache_key(filename)] = digest
+            if digest not in self.textures:
+                self.textures[digest] = texture
+                self.refcounts[digest] = 0
+        self.textures.move_to_end(digest)
+        self.refcounts[digest] += 1
+        self.evict()
+        return self.textures[digest]
+
+    def retain(self, texture):
+        # another user of a texture already acquired, e.g. a deep copy of a pattern
+        if self.textures.get(texture.digest) is texture:
+            self.textures.move_to_end(texture.digest)
+            self.refcounts[texture.digest] += 1
+
+    def release(self, texture):
+        if self.textures.get(texture.digest) is texture:
+            self.refcounts[texture.digest] -= 1
+        self.evict()
+
+    def memory_used(self):
+        return sum(texture_bytes(t) for t in self.textures.values())
+
+    def evict(self):
+        used = self.memory_used()
+        for digest in list(self.textures):
+            if used <= self.budget:
+                break
+            if self.refcounts[digest] == 0:
+                used -= texture_bytes(self.textures[digest])
+                del self.textures[digest]
+                del self.refcounts[digest]
+
+
+TEXTUREREGISTRY = TextureRegistry()
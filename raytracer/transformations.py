@@ -1,29 +1,76 @@
 import math
 import raytracer as rt
-from .matrices import matmul4x1
+from .matrices import matmul4x1, AffineMatrix
+from .rttuple import tuple_from_arr
 
 
 def do_transform(mat, tup):
     # returns the result of multiplying a transformation matrix by a rt_tuple.  Result will be a tuple
-    res = rt.RT_Tuple()
-    res.arr = matmul4x1(mat, tup.arr)
-    return res
+    return tuple_from_arr(matmul4x1(mat, tup.arr))
 
 
 def do_transformray(mat, ray):
-    neworigin = do_transform(mat, ray.origin)
-    newdirection = do_transform(mat, ray.direction)
-    return rt.Ray(neworigin, newdirection)
+    # same as calling do_transform() on the origin and direction, but with the matrix rows unpacked once
+    m0, m1, m2, m3 = mat
+    ox, oy, oz, ow = ray.origin.arr
+    dx, dy, dz, dw = ray.direction.arr
+    if mat.__class__ is AffineMatrix:
+        # the origin is a point and the direction a vector, so neither w changes and the direction is not moved
+        neworigin = tuple_from_arr([m0[0] * ox + m0[1] * oy + m0[2] * oz + m0[3],
+                                    m1[0] * ox + m1[1] * oy + m1[2] * oz + m1[3],
+                                    m2[0] * ox + m2[1] * oy + m2[2] * oz + m2[3],
+                                    ow])
+        newdirection = tuple_from_arr([m0[0] * dx + m0[1] * dy + m0[2] * dz,
+                                       m1[0] * dx + m1[1] * dy + m1[2] * dz,
+                                       m2[0] * dx + m2[1] * dy + m2[2] * dz,
+                                       dw])
+        return rt.Ray(neworigin, newdirection, ray.tmin, ray.tmax, ray.width, ray.spread)
+    neworigin = tuple_from_arr([m0[0] * ox + m0[1] * oy + m0[2] * oz + m0[3] * ow,
+                                m1[0] * ox + m1[1] * oy + m1[2] * oz + m1[3] * ow,
+                                m2[0] * ox + m2[1] * oy + m2[2] * oz + m2[3] * ow,
+                                m3[0] * ox + m3[1] * oy + m3[2] * oz + m3[3] * ow])
+    newdirection = tuple_from_arr([m0[0] * dx + m0[1] * dy + m0[2] * dz + m0[3] * dw,
+                                   m1[0] * dx + m1[1] * dy + m1[2] * dz + m1[3] * dw,
+                                   m2[0] * dx + m2[1] * dy + m2[2] * dz + m2[3] * dw,
+                                   m3[0] * dx + m3[1] * dy + m3[2] * dz + m3[3] * dw])
+    # the direction is not normalized, so t, and with it the interval, is the same in both spaces
+    return rt.Ray(neworigin, newdirection, ray.tmin, ray.tmax, ray.width, ray.spread)
+
+
+def pass_ray(mat, ray):
+    # do_transformray() for an identity matrix: the ray is used as it is, so anything done to it, like pulling in
+    # tmax, is done to the caller's ray
+    return ray
+
+
+def translate_ray(mat, ray):
+    # do_transformray() for a translation: only the origin moves, and the direction is shared
+    ox, oy, oz, ow = ray.origin.arr
+    neworigin = tuple_from_arr([ox + mat[0][3], oy + mat[1][3], oz + mat[2][3], ow])
+    return rt.Ray(neworigin, ray.direction, ray.tmin, ray.tmax, ray.width, ray.spread)
+
+
+def ray_transform_for(mat):
+    # returns the cheapest of do_transformray(), translate_ray() and pass_ray() that gives the right answer for mat
+    m0, m1, m2, m3 = mat
+    if m3[0] != 0 or m3[1] != 0 or m3[2] != 0 or m3[3] != 1:
+        return do_transformray
+    if m0[0] != 1 or m0[1] != 0 or m0[2] != 0 or m1[0] != 0 or m1[1] != 1 or m1[2] != 0 or \
+            m2[0] != 0 or m2[1] != 0 or m2[2] != 1:
+        return do_transformray
+    if m0[3] == 0 and m1[3] == 0 and m2[3] == 0:
+        return pass_ray
+    return translate_ray
 
 
 def translation(x, y, z):
     # the leading 1.0 makes it a float64
-    return [[1.0, 0, 0, x], [0, 1, 0, y], [0, 0, 1, z], [0, 0, 0, 1]]
+    return AffineMatrix([[1.0, 0, 0, x], [0, 1, 0, y], [0, 0, 1, z], [0, 0, 0, 1]])
 
 
 def scaling(x, y, z):
     # the 0.0 makes it a float64
-    return [[x, 0.0, 0, 0], [0, y, 0, 0], [0, 0, z, 0], [0, 0, 0, 1]]
+    return AffineMatrix([[x, 0.0, 0, 0], [0, y, 0, 0], [0, 0, z, 0], [0, 0, 0, 1]])
 
 
 def reflection(acrossx=False, acrossy=False, acrossz=False):
@@ -41,45 +88,45 @@ def reflection(acrossx=False, acrossy=False, acrossz=False):
 
 def rotation_x(theta):
     # theta is in radians
-    return [[1.0, 0, 0, 0],
-            [0, math.cos(theta), -math.sin(theta), 0],
-            [0, math.sin(theta), math.cos(theta), 0],
-            [0, 0, 0, 1]]
+    return AffineMatrix([[1.0, 0, 0, 0],
+                         [0, math.cos(theta), -math.sin(theta), 0],
+                         [0, math.sin(theta), math.cos(theta), 0],
+                         [0, 0, 0, 1]])
 
 
 def rotation_y(theta):
     # theta is in radians
-    return [[math.cos(theta), 0.0, math.sin(theta), 0],
-            [0, 1, 0, 0],
-            [-math.sin(theta), 0, math.cos(theta), 0],
-            [0, 0, 0, 1]]
+    return AffineMatrix([[math.cos(theta), 0.0, math.sin(theta), 0],
+                         [0, 1, 0, 0],
+                         [-math.sin(theta), 0, math.cos(theta), 0],
+                         [0, 0, 0, 1]])
 
 
 def rotation_z(theta):
     # theta is in radians
-    return [[math.cos(theta), -math.sin(theta), 0.0, 0],
-            [math.sin(theta), math.cos(theta), 0, 0],
-            [0, 0, 1, 0],
-            [0, 0, 0, 1]]
+    return AffineMatrix([[math.cos(theta), -math.sin(theta), 0.0, 0],
+                         [math.sin(theta), math.cos(theta), 0, 0],
+                         [0, 0, 1, 0],
+                         [0, 0, 0, 1]])
 
 
 def skew(xy, xz, yx, yz, zx, zy):
     # xy = skew of x in proportion to y
     # xz = skew of x in proportion to z
     # etc.
-    return [[1.0, xy, xz, 0],
-            [yx, 1, yz, 0],
-            [zx, zy, 1, 0],
-            [0, 0, 0, 1]]
+    return AffineMatrix([[1.0, xy, xz, 0],
+                         [yx, 1, yz, 0],
+                         [zx, zy, 1, 0],
+                         [0, 0, 0, 1]])
 
 
 def view_transform(from_pt, to_pt, up_vec):
     forward = rt.normalize(to_pt - from_pt)
     left = rt.cross(forward, rt.normalize(up_vec))
     true_up = rt.cross(left, forward)
-    orientation = [left.arr, true_up.arr,
-                   [-forward.arr[0], -forward.arr[1], -forward.arr[2], -forward.arr[3]],
-                   [0, 0, 0, 1.0]]
+    orientation = AffineMatrix([left.arr, true_up.arr,
+                                [-forward.arr[0], -forward.arr[1], -forward.arr[2], -forward.arr[3]],
+                                [0, 0, 0, 1.0]])
     return rt.matmul4x4(orientation, translation(-from_pt.x, -from_pt.y, -from_pt.z))
 
 
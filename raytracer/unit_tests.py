@@ -1,15 +1,26 @@
 import math
+import random
 import time
 import os
+import pickle
+import struct
+import zlib
+from copy import deepcopy
+import numpy as np
 import raytracer as rt
-from .rttuple import random_in_unit_disk, tuples_are_close
+from .rttuple import random_in_unit_disk, tuples_are_close, tuple_from_arr, point_from_floats, \
+                    vector_from_floats
 from .transformations import do_transform, do_transformray, translation, scaling, reflection, rotation_x, rotation_y, \
-                            rotation_z, skew, view_transform
+                            rotation_z, skew, view_transform, pass_ray, translate_ray
 from .world import prepare_computations, schlick_reflectance
-from .canvas import init_canvas, write_pixel, pixel_at, get_canvasdims
-from .matrices import allclose4x4
+from .canvas import init_canvas, write_pixel, pixel_at, get_canvasdims, make_tiles
+from .matrices import allclose4x4, AffineMatrix
 from .objects import EPSILON, intersection_allowed, TestShape
 from .texturemap import FACELEFT, FACERIGHT, FACEFRONT, FACEBACK, FACEUP, FACEDOWN, face_from_point
+from .batchrays import BatchScene
+from .imagefile import write_ppm_p6
+from .texturestore import read_ppm, load_texture, TextureRegistry, cache_key, content_digest, \
+    TEXTUREREGISTRY, TEXTURECACHEDIR
 from .quarticsolver import quadratic_solver, cubic_solver, quartic_solver
 
 
@@ -250,6 +261,20 @@ def rtunittest_cross1():
     assert rt.cross(b, a) == rt.Vector(1, -2, 1)
 
 
+def rtunittest_fasttuples1():
+    # Fred test: the float constructors used in the hot paths build the same tuples as the public classes
+    p = point_from_floats(1.5, -2, 3)
+    assert isinstance(p, rt.Point)
+    assert p == rt.Point(1.5, -2, 3)
+    v = vector_from_floats(0, 1, 0)
+    assert isinstance(v, rt.Vector)
+    assert v == rt.Vector(0, 1, 0)
+    arr = [1, 2, 3, 0]
+    t = tuple_from_arr(arr)
+    assert t.arr is arr
+    assert t == rt.RT_Tuple(1, 2, 3, 0)
+
+
 def rtunittest_color1():
     # Adding colors
     c1 = rt.Color(0.9, 0.6, 0.75)
@@ -318,6 +343,54 @@ def rtunittest_canvas3():
     os.remove('test_canvas3.ppm')
 
 
+def rtunittest_canvas4():
+    # Fred test: a tile is written in one go, and a canvas attached by name shares the same pixels until it lets go
+    c = rt.Canvas(5, 4, 255, shared=True)
+    block = np.zeros((2, 3, 3))
+    block[1, 2] = [0.25, 0.5, 0.75]
+    block[0, 0] = [1, 1, 1]
+    c.write_tile(2, 1, block)
+    assert c.pixel_at(4, 2) == rt.Color(0.25, 0.5, 0.75)
+    assert c.pixel_at(2, 1) == rt.Color(1, 1, 1)
+    assert c.pixel_at(1, 1) == rt.Color(0, 0, 0)
+
+    other = rt.Canvas(5, 4, 255, c.shm.name)
+    other.write_pixel(0, 3, rt.Color(0.1, 0.2, 0.3))
+    assert c.pixel_at(0, 3) == rt.Color(0.1, 0.2, 0.3)
+    assert other.pixel_at(4, 2) == rt.Color(0.25, 0.5, 0.75)
+    other.close()
+    assert other.shm is None
+    assert c.pixel_at(0, 3) == rt.Color(0.1, 0.2, 0.3)
+    # only canvases that render processes write into need shared memory
+    assert rt.Canvas(5, 4, 255).shm is None
+
+
+def rtunittest_canvas5():
+    # Fred test: canvases are saved as binary PPM or PNG depending on the file extension
+    init_canvas(3, 2)
+    write_pixel(0, 0, rt.Color(1, 0, 0))
+    write_pixel(2, 1, rt.Color(0.5, 0.25, 1.5))
+    expected = bytes([255, 0, 0] + [0] * 12 + [128, 64, 255])
+
+    rt.canvas_to_file('test_canvas5.ppm')
+    with open('test_canvas5.ppm', 'rb') as f:
+        data = f.read()
+    os.remove('test_canvas5.ppm')
+    assert data == b'P6\n3 2\n255\n' + expected
+
+    rt.canvas_to_file('test_canvas5.png')
+    with open('test_canvas5.png', 'rb') as f:
+        data = f.read()
+    os.remove('test_canvas5.png')
+    assert data[0:8] == b'\x89PNG\r\n\x1a\n'
+    assert data[12:16] == b'IHDR'
+    assert struct.unpack('>IIBB', data[16:26]) == (3, 2, 8, 2)
+    idatlen = struct.unpack('>I', data[33:37])[0]
+    assert data[37:41] == b'IDAT'
+    assert zlib.decompress(data[41:41 + idatlen]) == b'\x00' + expected[0:9] + b'\x00' + expected[9:18]
+    assert data[-8:-4] == b'IEND'
+
+
 def rtunittest_matrix1():
     # A matrix mutliplied by a tuple
     A = [[1, 2, 3, 4], [2, 4, 4, 2], [8, 6, 4, 1], [0, 0, 0, 1]]
@@ -373,6 +446,63 @@ def rtunittest_matrices():
     assert allclose4x4(rt.matmul4x4(C, rt.inverse4x4(B)), A)
 
 
+def rtunittest_matrices2():
+    # Fred test: transforms are AffineMatrix, which are inverted and multiplied without the bottom row and give
+    # the same answers as the general code
+    A = rt.chain_transforms(scaling(1, 2, 3), rotation_x(0.3), skew(0.5, 0, 0, 0, 0.2, 0), translation(1, -2, 3))
+    assert isinstance(A, AffineMatrix)
+    B = rt.inverse4x4(A)
+    assert isinstance(B, AffineMatrix)
+    assert allclose4x4(B, np.linalg.inv(np.array(A)).tolist())
+    assert allclose4x4(rt.matmul4x4(A, B), rt.identity4())
+    C = [list(row) for row in A]
+    assert allclose4x4(rt.matmul4x4(A, A), rt.matmul4x4(C, C))
+    assert not isinstance(rt.matmul4x4(C, C), AffineMatrix)
+    # plain lists with an affine bottom row are inverted in closed form too
+    assert isinstance(rt.inverse4x4(C), AffineMatrix)
+    p = rt.Point(1, 2, 3)
+    assert do_transform(A, p) == do_transform(C, p)
+    assert do_transform(A, p).w == 1 and do_transform(A, rt.Vector(1, 2, 3)).w == 0
+    r = do_transformray(A, rt.Ray(p, rt.Vector(0, 1, 0)))
+    r2 = do_transformray(C, rt.Ray(p, rt.Vector(0, 1, 0)))
+    assert r.origin == r2.origin and r.direction == r2.direction
+
+    # singular matrices still go to numpy, which raises
+    try:
+        rt.inverse4x4(scaling(1, 0, 1))
+        assert False
+    except np.linalg.LinAlgError:
+        pass
+
+    box = rt.BoundingBox(rt.Point(-1, -2, -3), rt.Point(4, 5, 6))
+    fast = box.transform(A)
+    slow = box.transform(C)
+    assert fast.boxmin == slow.boxmin and fast.boxmax == slow.boxmax
+
+
+def rtunittest_matrices3():
+    # Fred test: objects pick a ray transform when their transform is set, passing rays straight through an
+    # identity and only moving the origin for a translation
+    s = rt.Sphere()
+    assert s.raytransform is pass_ray
+    r = rt.Ray(rt.Point(0, 0, -5), rt.Vector(0, 0, 1))
+    assert s.raytransform(s.inversetransform, r) is r
+    assert [x.t for x in s.intersect(r)] == [4, 6]
+
+    s.transform = translation(0, 0, 1)
+    assert s.raytransform is translate_ray
+    moved = s.raytransform(s.inversetransform, r)
+    general = do_transformray(s.inversetransform, r)
+    assert moved.origin == general.origin == rt.Point(0, 0, -6)
+    assert moved.direction is r.direction
+    assert [x.t for x in s.intersect(r)] == [5, 7]
+
+    s.transform = rt.chain_transforms(translation(0, 0, 1), scaling(2, 2, 2))
+    assert s.raytransform is do_transformray
+    s.transform = rt.identity4()
+    assert s.raytransform is pass_ray
+
+
 def rtunittest_translation1():
     # Multiplying by a translation matrix
     trans = translation(5, -3, 2)
@@ -916,6 +1046,46 @@ def rtunittest_lighting11():
     assert result == rt.Color(0.62318, 0.62318, 0.62318)
 
 
+def rtunittest_lighting12():
+    # Fred test: an adaptive area light only sends the full set of shadow rays from points in its penumbra
+    w = default_world()
+    corner = rt.Point(-0.5, -0.5, -5)
+    v1 = rt.Vector(1, 0, 0)
+    v2 = rt.Vector(0, 1, 0)
+    full = rt.AreaLight(corner, v1, 4, v2, 4, False, rt.Color(1, 1, 1))
+    adaptive = rt.AreaLight(corner, v1, 4, v2, 4, False, rt.Color(1, 1, 1), adaptive=True)
+    assert len(adaptive.probe_positions()) == 5
+    for pt in [rt.Point(0, 0, 2), rt.Point(1, -1, 2), rt.Point(1.5, 0, 2), rt.Point(0, 0, -2)]:
+        assert math.isclose(adaptive.intensity_at(w, pt), full.intensity_at(w, pt))
+    assert len(adaptive.position_samples()) == 16
+
+
+def rtunittest_lighting13():
+    # Fred test: light_samples() gives the direction to each sample of a light that can be seen from a point, and
+    # shade() lights the point from just those
+    w = default_world()
+    light = rt.AreaLight(rt.Point(-0.5, -0.5, -5), rt.Vector(1, 0, 0), 2, rt.Vector(0, 1, 0), 2, False,
+                         rt.Color(1, 1, 1))
+    pt = rt.Point(1, -1, 2)
+    scale, directions = light.light_samples(w, pt, pt)
+    assert scale == 1.0
+    assert len(directions) == 4
+    assert [d is None for d in directions].count(True) == 3
+    assert light.intensity_at(w, pt) == 0.25
+    k = [d is not None for d in directions].index(True)
+    assert directions[k] == rt.normalize(light.position_samples()[k] - pt)
+
+    shape = rt.Sphere()
+    pt = rt.Point(0, 0, -1)
+    eyev = rt.Vector(0, 0, -1)
+    normalv = rt.Vector(0, 0, -1)
+    scale, directions = light.light_samples(rt.World(), pt, pt)
+    assert all(d is not None for d in directions)
+    assert light.shade(shape.material, shape, pt, eyev, normalv, scale, directions) == \
+        light.lighting(shape.material, shape, pt, eyev, normalv)
+    assert light.shade(shape.material, shape, pt, eyev, normalv, scale, [None] * 4) == rt.Color(0.1, 0.1, 0.1)
+
+
 def rtunittest_world1():
     # Creating a world
     w = rt.World()
@@ -1048,6 +1218,58 @@ def rtunittest_shadehit3():
     assert color == rt.Color(0.87677, 0.92436, 0.82918)
 
 
+def rtunittest_shadehit4():
+    # Fred test: lights that cannot reach a point only add their ambient light there
+    w = default_world()
+    w.lights.append(rt.SpotLight(rt.Point(-10, 10, -10), rt.Vector(-1, 0, 0), math.pi / 4, math.pi / 4))
+    w.lights.append(rt.PointLight(rt.Point(0, 0, 10), rt.Color(1, 1, 1)))
+    r = rt.Ray(rt.Point(0, 0, -5), rt.Vector(0, 0, 1))
+    i = rt.Intersection(w.objects[0], 4)
+    hitrecord = prepare_computations(i, r, [i])
+    assert w.pick_lights(hitrecord.point, hitrecord.over_point, hitrecord.normalv) == [1.0, 0.0, 0.0]
+    assert w.shade_hit(hitrecord, 0) == rt.Color(0.38066 + 0.16, 0.47583 + 0.2, 0.2855 + 0.12)
+
+
+def rtunittest_shadehit5():
+    # Fred test: with many lights a few are picked at random, weighted so that on average they add up to all of them
+    w = default_world()
+    count = rt.world.MANYLIGHTS + 24
+    w.lights = [rt.PointLight(rt.Point(-10, 10, -10), rt.Color(1, 1, 1) / count) for _ in range(count)]
+    r = rt.Ray(rt.Point(0, 0, -5), rt.Vector(0, 0, 1))
+    i = rt.Intersection(w.objects[0], 4)
+    hitrecord = prepare_computations(i, r, [i])
+    weights = w.pick_lights(hitrecord.point, hitrecord.over_point, hitrecord.normalv)
+    assert 1 <= len([weight for weight in weights if weight > 0]) <= rt.world.LIGHTPICKS
+    assert math.isclose(sum(weights), count)
+    # these lights are all the same, so any pick of them adds up to one light as bright as all of them
+    assert w.shade_hit(hitrecord, 0) == rt.Color(0.38066, 0.47583, 0.2855)
+
+
+def rtunittest_shadehit6():
+    # Fred test: a decaying light too far away to change the color of a point, or one lighting a material that
+    # reflects no diffuse or specular light, is culled
+    w = default_world()
+    far = rt.PointLight(rt.Point(-100, 100, -100), rt.Color(1, 1, 1), decays=True)
+    near = rt.PointLight(rt.Point(-1, 1, -5), rt.Color(1, 1, 1), decays=True)
+    w.lights = [far, near]
+    r = rt.Ray(rt.Point(0, 0, -5), rt.Vector(0, 0, 1))
+    i = rt.Intersection(w.objects[0], 4)
+    hitrecord = prepare_computations(i, r, [i])
+    material = w.objects[0].material
+    color = material.color
+    assert far.max_contribution(hitrecord.point, hitrecord.over_point, hitrecord.normalv) > 0
+    assert w.pick_lights(hitrecord.point, hitrecord.over_point, hitrecord.normalv, material, color) == [0.0, 1.0]
+    # what the far light could have added is less than half a step of an 8 bit image
+    full = far.lighting(material, w.objects[0], hitrecord.point, hitrecord.eyev, hitrecord.normalv,
+                        far.decay_at(hitrecord.over_point))
+    ambient = color * material.ambient
+    assert max((full - ambient).arr[0:3]) < rt.world.LIGHTCUTOFF
+
+    material.diffuse = 0
+    material.specular = 0
+    assert w.pick_lights(hitrecord.point, hitrecord.over_point, hitrecord.normalv, material, color) == [0.0, 0.0]
+
+
 def rtunittest_colorat1():
     # The color when a ray misses
     w = default_world()
@@ -1188,6 +1410,108 @@ def rtunittest_render1():
     assert pixel_at(5, 5) == rt.Color(0.38066, 0.47583, 0.2855)
 
 
+def rtunittest_tiles1():
+    # Fred test: the tiles cover every pixel of the image exactly once, with smaller tiles at the edges
+    tiles = make_tiles(10, 7, 4)
+    assert len(tiles) == 6
+    assert tiles[0] == (0, 0, 4, 4)
+    assert tiles[2] == (8, 0, 10, 4)
+    assert tiles[5] == (8, 4, 10, 7)
+    covered = set()
+    for xmin, ymin, xmax, ymax in tiles:
+        for y in range(ymin, ymax):
+            for x in range(xmin, xmax):
+                assert (x, y) not in covered
+                covered.add((x, y))
+    assert len(covered) == 70
+
+
+def rtunittest_renderpool1():
+    # Fred test: a RenderPool renders several frames of the same world without restarting its processes
+    w = default_world()
+    c = rt.Camera(11, 11, math.pi/2)
+    c.transform = view_transform(rt.Point(0, 0, -5), rt.Point(0, 0, 0), rt.Vector(0, 1, 0))
+    with rt.RenderPool(w, 2, 1, 5) as pool:
+        pool.render(c, 4)
+        assert pixel_at(5, 5) == rt.Color(0.38066, 0.47583, 0.2855)
+        procs = list(pool.procs)
+        c2 = rt.Camera(5, 3, math.pi/2, c.transform)
+        pool.render(c2, 4)
+        assert get_canvasdims() == (5, 3)
+        assert pool.procs == procs
+
+
+def rtunittest_renderpool2():
+    # Fred test: a RenderPool can hand its processes a world with meshes, instances and image textures, and they
+    # render it as mp_render() does.  Textures from the cache go as the names of the files to map.
+    w = default_world()
+    vertices = [[-1, 0, -1], [1, 0, -1], [0, 0, 1], [0, 1, 0]]
+    mesh = rt.TriangleMesh(vertices, [[0, 1, 3], [1, 2, 3], [2, 0, 3]], transform=rt.translation(-1.5, -1, 0))
+    w.objects.append(mesh)
+    w.objects.append(rt.Instance(mesh, rt.translation(3, 0, 0)))
+    floor = rt.Plane(rt.translation(0, -1, 0))
+    floor.material.pattern = rt.UVImagePattern('raytracer/test_ppm_files/test_checkers_pattern.ppm')
+    w.objects.append(floor)
+    texture = floor.material.pattern.texture
+    if isinstance(texture.values, np.memmap):
+        copied = pickle.loads(pickle.dumps(texture))
+        assert isinstance(copied.values, np.memmap) and copied.values.filename == texture.values.filename
+        assert copied.digest == texture.digest and len(copied.levels) == len(texture.levels)
+
+    c = rt.Camera(12, 9, math.pi/2)
+    c.transform = view_transform(rt.Point(0, 1.5, -5), rt.Point(0, 0, 0), rt.Vector(0, 1, 0))
+    rt.mp_render(c, w, 1, 1)
+    expected = [pixel_at(x, y) for y in range(9) for x in range(12)]
+    with rt.RenderPool(w, 2, 1, 5) as pool:
+        pool.render(c, 4)
+        assert [pixel_at(x, y) for y in range(9) for x in range(12)] == expected
+
+def rtunittest_batchrays1():
+    # Fred test: batched primary rays see the same colors as the scalar renderer, including through groups and for
+    # objects (here a cylinder) that the batch cannot intersect itself
+    w = default_world()
+    g = rt.ObjectGroup(rt.translation(0, -2, 0))
+    g.addchild(rt.Triangle(rt.Point(-3, 0, -3), rt.Point(3, 0, -3), rt.Point(0, 0, 3)))
+    g.addchild(rt.Cube(rt.scaling(0.5, 0.5, 0.5)))
+    w.objects.append(g)
+    w.objects.append(rt.Plane(rt.translation(0, 0, 10)))
+    w.objects.append(rt.Cylinder(rt.translation(2, 0, 0), None, True, -1, 1))
+    c = rt.Camera(11, 11, math.pi/2)
+    c.transform = view_transform(rt.Point(0, 1, -5), rt.Point(0, 0, 0), rt.Vector(0, 1, 0))
+
+    scene = BatchScene(w)
+    assert len(scene.others) == 1
+    xs = []
+    ys = []
+    for y in range(11):
+        for x in range(11):
+            xs.append(x)
+            ys.append(y)
+    origins, directions = c.rays_for_pixels(np.array(xs), np.array(ys))
+    colors = scene.colors_for_rays(origins, directions, 5)
+    for i in range(len(xs)):
+        r = c.ray_for_pixel(xs[i], ys[i])
+        assert r.origin == rt.Point(*origins[i])
+        assert r.direction == rt.Vector(*directions[i])
+        assert colors[i] == w.color_at(r, 5)
+
+
+def rtunittest_batchrays2():
+    # Fred test: with depth of field, batched primary rays draw their aperture points from the same random numbers
+    # as ray_for_pixel()
+    c = rt.Camera(11, 11, math.pi/2, view_transform(rt.Point(0, 1, -5), rt.Point(0, 0, 0), rt.Vector(0, 1, 0)),
+                  0.2, 4)
+    xs = list(range(11))
+    ys = [3] * 11
+    random.seed(7)
+    origins, directions = c.rays_for_pixels(np.array(xs), np.array(ys))
+    random.seed(7)
+    for i in range(len(xs)):
+        r = c.ray_for_pixel(xs[i], ys[i])
+        assert r.origin == rt.Point(*origins[i])
+        assert r.direction == rt.Vector(*directions[i])
+
+
 def rtunittest_shadowed1():
     # is_shadowed tests for occlusion between two points
     w = default_world()
@@ -1199,6 +1523,144 @@ def rtunittest_shadowed1():
     assert not w.is_shadowed(rt.Point(-5, -5, -5), light_position)
 
 
+def rtunittest_occluded1():
+    # Fred test: the any-hit query returns a shadow casting object closer than maxdist, looking inside groups
+    w = rt.World()
+    s1 = rt.Sphere()
+    s1.casts_shadow = False
+    s2 = rt.Sphere()
+    s2.transform = rt.translation(0, 0, 5)
+    g = rt.ObjectGroup()
+    g.addchild(s2)
+    w.objects.extend([s1, g])
+    r = rt.Ray(rt.Point(0, 0, -5), rt.Vector(0, 0, 1))
+
+    assert w.occluded(r, 100) is s2
+    assert w.occluded(r, 9.5) is s2
+    assert w.occluded(r, 9) is None  # s2 is hit at t=9, which has to be strictly closer than maxdist
+    assert w.occluded(r, 7) is None  # s1 is in the way but casts no shadow
+    s1.casts_shadow = True
+    assert w.occluded(r, 7) is s1
+    assert w.occluded(r, 3) is None
+
+
+def rtunittest_closesthit1():
+    # Fred test: rays carry a t interval through transforms, and closest_hit() finds the nearest hit inside it
+    r = rt.Ray(rt.Point(0, 0, -5), rt.Vector(0, 0, 1))
+    assert r.tmin == 0 and r.tmax == math.inf
+    r2 = do_transformray(rt.scaling(2, 2, 2), rt.Ray(rt.Point(0, 0, -5), rt.Vector(0, 0, 1), 1, 3))
+    assert r2.tmin == 1 and r2.tmax == 3
+
+    w = rt.World()
+    s1 = rt.Sphere()
+    s2 = rt.Sphere()
+    s2.transform = rt.translation(0, 0, 5)
+    g = rt.ObjectGroup()
+    g.addchild(s2)
+    g.addchild(s1)
+    w.objects.append(g)
+
+    hit = w.closest_hit(r)
+    assert hit.objhit is s1 and hit.t == 4
+    assert r.tmax == math.inf  # the caller's ray is left alone
+    hit = w.closest_hit(rt.Ray(rt.Point(0, 0, -5), rt.Vector(0, 0, 1), 4.5, math.inf))
+    assert hit.objhit is s1 and hit.t == 6
+    assert w.closest_hit(rt.Ray(rt.Point(0, 0, -5), rt.Vector(0, 0, 1), 0, 4)) is None
+    assert w.closest_hit(rt.Ray(rt.Point(0, 0, 0), rt.Vector(0, 1, 0), 2, math.inf)) is None
+
+
+def rtunittest_raypacket1():
+    # Fred test: a packet of shadow rays, traced through groups, planes, cubes and a cylinder at once, blocks exactly
+    # the rays that is_shadowed() does one at a time
+    w = rt.World()
+    floor = rt.Plane()
+    floor.transform = rt.translation(0, -1, 0)
+    cube = rt.Cube()
+    cube.transform = rt.chain_transforms(rt.scaling(0.5, 0.5, 0.5), rt.translation(2, 0, 0))
+    cylinder = rt.Cylinder()
+    cylinder.transform = rt.translation(-2, 0, 0)
+    g = rt.ObjectGroup(rt.rotation_y(0.5))
+    for i in range(10):
+        s = rt.Sphere()
+        s.transform = rt.chain_transforms(rt.scaling(0.3, 0.3, 0.3), rt.translation(i - 5, 1, 0))
+        g.addchild(s)
+    g.divide(2)
+    w.objects.extend([floor, cube, cylinder, g])
+
+    point = rt.Point(0.1, 0, -3)
+    positions = [rt.Point(x - 6, 4, z) for x in range(12) for z in (-1, 1, 3)]
+    packet = rt.RayPacket.shadow_rays(point, positions)
+    w.occluded_packet(packet)
+    expected = [w.is_shadowed(point, pos) for pos in positions]
+    assert packet.blocked.tolist() == expected
+    assert True in expected and False in expected
+    for k, blocked in enumerate(expected):
+        assert (packet.occluders[k] is not None) == blocked
+    assert w.shadowed_from(point, positions) == expected
+    below = [rt.Point(x, -2, 0) for x in range(30)]
+    assert w.shadowed_from(point, below) == [True] * 30
+
+
+def rtunittest_raypacket2():
+    # Fred test: a packet is only transformed by affine matrices; an object with any other bottom row to its
+    # transform is tested a ray at a time
+    point = rt.Point(0, 0, -5)
+    positions = [rt.Point(x / 4, 0, 5) for x in range(-12, 13)]
+    s = rt.Sphere()
+    s.transform = rt.scaling(2, 2, 2)
+    packet = rt.RayPacket.shadow_rays(point, positions)
+    s.occluded_packet(packet, np.ones(len(positions), dtype=bool))
+    assert packet.rays is None
+
+    for shape in (rt.Sphere(), rt.ObjectGroup()):
+        shape.transform = [[1.0, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0.1, 1]]
+        if isinstance(shape, rt.ObjectGroup):
+            shape.addchild(rt.Sphere())
+        packet = rt.RayPacket.shadow_rays(point, positions)
+        shape.occluded_packet(packet, np.ones(len(positions), dtype=bool))
+        assert packet.rays is not None
+        expected = [shape.occluded(r, d) is not None for r, d in zip(packet.ray_list(), packet.maxdist.tolist())]
+        assert packet.blocked.tolist() == expected
+        assert True in expected and False in expected
+
+
+def rtunittest_occluded2():
+    # Fred test: a world remembers what blocked each light's last shadow ray, or the CSG around it, and tries it
+    # first, and forgets it when the objects change or the light is used in another world
+    w = rt.World()
+    light = rt.PointLight(rt.Point(0, 10, 0))
+    w.lights.append(light)
+    s = rt.Sphere()
+    g = rt.ObjectGroup(rt.translation(0, 5, 0))
+    g.addchild(s)
+    c1 = rt.Cube()
+    c2 = rt.Cube()
+    c2.transform = rt.translation(0, 0.5, 0)
+    csg = rt.CSG('difference', c1, c2)
+    csg.transform = rt.translation(3, 0, 0)
+    w.objects.extend([g, csg])
+
+    assert light.intensity_at(w, rt.Point(0, 0, 0)) == 0.0
+    assert w.lastoccluders[light] is s
+    assert light.intensity_at(w, rt.Point(0.5, 0, 0)) == 0.0
+    assert light.intensity_at(w, rt.Point(10, 0, 0)) == 1.0
+    assert w.lastoccluders[light] is s
+    assert light.intensity_at(w, rt.Point(3, -2, 0)) == 0.0
+    assert w.lastoccluders[light] is csg
+    # the cached CSG is tested as a whole, so its cut away part does not block the light
+    assert w.is_shadowed(rt.Point(3, 0.6, 0), rt.Point(3, 0.9, 0), light) is False
+
+    assert light.intensity_at(w, rt.Point(0, 0, 0)) == 0.0
+    assert rt.World([], [light]).is_shadowed(rt.Point(0, 0, 0), light.position, light) is False
+    g.transform = rt.translation(0, -5, 0)
+    assert light.intensity_at(w, rt.Point(0, 0, 0)) == 1.0
+    g.transform = rt.translation(0, 5, 0)
+    assert light.intensity_at(w, rt.Point(0, 0, 0)) == 0.0
+    w.objects.remove(g)
+    assert light.intensity_at(w, rt.Point(0, 0, 0)) == 1.0
+    assert w.is_shadowed(rt.Point(0, 0, 0), light.position) is False
+
+
 def rtunittest_shadowed2():
     # Point lights evaluate the light intensity at a given bpoint
 
@@ -1982,6 +2444,33 @@ def rtunittest_groups9():
     assert n == rt.Vector(0.2857, 0.42854, -0.85716)
 
 
+def rtunittest_groups10():
+    # Fred test: the flattened world matrices are kept until an ancestor's transform is set or the top of the
+    # chain is added to another group
+    g1 = rt.ObjectGroup()
+    g2 = rt.ObjectGroup()
+    g2.transform = rt.scaling(2, 2, 2)
+    g1.addchild(g2)
+    s = rt.Sphere()
+    s.transform = rt.translation(5, 0, 0)
+    c = rt.CSG('union', s, rt.Cube())
+    g2.addchild(c)
+    g1.freeze()
+    assert s.worldinverse is not None
+    assert s.world_to_object(rt.Point(10, 0, 0)) == rt.Point(0, 0, 0)
+
+    g1.transform = rt.rotation_y(math.pi/2)
+    assert s.worldinverse is None
+    assert s.world_to_object(rt.Point(-2, 0, -10)) == rt.Point(0, 0, -1)
+
+    outer = rt.ObjectGroup()
+    outer.addchild(g1)
+    assert s.worldinverse is None
+    outer.transform = rt.translation(0, 1, 0)
+    assert s.world_to_object(rt.Point(-2, 1, -10)) == rt.Point(0, 0, -1)
+    assert s.normal_at(rt.Point(-2, 1, -10)) == rt.Vector(-1, 0, 0)
+
+
 def rtunittest_triangle1():
     # Constructing a triangle
     p1 = rt.Point(0, 1, 0)
@@ -2166,6 +2655,118 @@ def rtunittest_objfile8():
     assert t1.n3 == t2.n3
 
 
+def rtunittest_objfile9():
+    # Fred test: a file is parsed into arrays, scaled to fit -1..1, and read back from the cache the second time
+    parser = rt.Parser()
+    parser.parse_obj_file('raytracer/test_obj_files/teapot-low.obj')
+    assert parser.vertexarray.shape == (parser.numvertices, 3)
+    assert math.isclose(np.abs(parser.vertexarray).max(), 1)
+    groupinfo = parser.groups['Teapot001']
+    assert groupinfo.builtgroup is None  # no Triangles are made until the group is asked for
+
+    cached = rt.Parser()
+    cached.parse_obj_file('raytracer/test_obj_files/teapot-low.obj')
+    assert np.array_equal(cached.vertexarray, parser.vertexarray)
+    assert [g.name for g in cached.groupinfos] == [g.name for g in parser.groupinfos]
+    g1 = parser.get_group_by_name(groupinfo.name)
+    g2 = cached.get_group_by_name(groupinfo.name)
+    assert len(g1.children) == len(g2.children) == len(groupinfo.faces)
+    assert g1.children[-1].p3 == g2.children[-1].p3
+
+
+def rtunittest_objfile10():
+    # Fred test: a file whose vertices are all at one point cannot be scaled to fit -1..1
+    with open('test_objfile10.obj', 'w') as f:
+        f.write('v 1 2 3\nv 1 2 3\nv 1 2 3\nf 1 2 3\n')
+    parser = rt.Parser()
+    try:
+        parser.parse_obj_file('test_objfile10.obj')
+        assert False
+    except ValueError:
+        pass
+    parser.parse_obj_file('test_objfile10.obj', False)
+    assert parser.numvertices == 3
+    os.remove('test_objfile10.obj')
+
+
+def rtunittest_objfile11():
+    # Fred test: faces using vertex or normal 0, or one past the last read, are errors rather than wrapping around
+    # to other vertices
+    parser = rt.Parser()
+    for text in ['v 0 0 0\nv 1 0 0\nv 0 1 0\nf 0 1 2\n', 'v 0 0 0\nv 1 0 0\nv 0 1 0\nf 1 2 4\n',
+                 'f 1 2 3\nv 0 0 0\nv 1 0 0\nv 0 1 0\n', 'v 0 0 0\nv 1 0 0\nv 0 1 0\nvn 0 0 1\nf 1//1 2//1 3//2\n']:
+        with open('test_objfile11.obj', 'w') as f:
+            f.write(text)
+        try:
+            parser.parse_obj_file('test_objfile11.obj', False)
+            assert False
+        except ValueError:
+            pass
+    os.remove('test_objfile11.obj')
+
+    # a group made the old way still works
+    g = rt.ObjectGroup()
+    groupinfo = rt.GroupInfo('named', g)
+    assert groupinfo.name == 'named' and groupinfo.group is g
+
+
+def rtunittest_trianglemesh1():
+    # Fred test: a TriangleMesh hits the same as the Triangles it replaces, and says which face was hit
+    vertices = [[0, 1, 0], [-1, 0, 0], [1, 0, 0], [0, 1, 2], [-1, 0, 2], [1, 0, 2]]
+    normals = [[0, 1, 0], [-1, 0, 0], [1, 0, 0]]
+    mesh = rt.TriangleMesh(vertices, [[0, 1, 2], [3, 4, 5]], normals, [[-1, -1, -1], [0, 1, 2]])
+    r = rt.Ray(rt.Point(-0.2, 0.3, -2), rt.Vector(0, 0, 1))
+    xs = mesh.intersect(r)
+    assert sorted([(i.t, i.face) for i in xs]) == [(2, 0), (4, 1)]
+    hit = mesh.closest_hit(r)
+    assert hit.t == 2 and hit.face == 0
+    assert mesh.normal_at(r.at(2), hit) == rt.Vector(0, 0, -1)
+    smooth = [i for i in xs if i.face == 1][0]
+    assert mesh.normal_at(r.at(4), smooth) == rt.normalize(rt.Vector(-0.2, 0.3, 0))
+    assert mesh.occluded(r, 3) is mesh
+    assert mesh.occluded(r, 1.5) is None
+
+    parser = rt.Parser()
+    parser.parse_obj_file('raytracer/test_obj_files/teapot-low.obj')
+    g = parser.obj_to_group()
+    g2 = parser.obj_to_group(mesh=True)
+    assert isinstance(g2.children[-1], rt.TriangleMesh)
+    assert len(g2.children[-1].faces) == len(g.children[-1].children)
+    r = rt.Ray(rt.Point(0.1, 0.2, -5), rt.Vector(0, 0, 1))
+    assert sorted([i.t for i in g.intersect(r)]) == sorted([i.t for i in g2.intersect(r)])
+
+
+def rtunittest_instance1():
+    # Fred test: Instances of one group hit and shade as if the group had been copied and transformed
+    s = rt.Sphere()
+    s.transform = rt.translation(5, 0, 0)
+    s.material.color = rt.Color(1, 0, 0)
+    prototype = rt.ObjectGroup()
+    prototype.addchild(s)
+    prototype.transform = rt.scaling(2, 2, 2)
+    red = rt.Instance(prototype, rt.rotation_y(math.pi / 2))
+    blue = rt.Instance(prototype, rt.translation(0, 0, -10), rt.Material(rt.Color(0, 0, 1)))
+    assert prototype.parent is None and s.parent is prototype
+    assert red.parent_space_bounds_of().boxmin == rt.Point(-2, -2, -12)
+
+    r = rt.Ray(rt.Point(0, 0, -20), rt.Vector(0, 0, 1))
+    xs = red.intersect(r)
+    assert len(xs) == 2 and math.isclose(xs[0].t, 8) and math.isclose(xs[1].t, 12)
+    assert xs[0].objhit is xs[1].objhit and xs[0].objhit.obj is s and red.includes(xs[0].objhit)
+    assert xs[0].objhit.material.color == rt.Color(1, 0, 0)
+    assert xs[0].objhit.normal_at(r.at(8), xs[0]) == rt.Vector(0, 0, -1)
+    assert red.closest_hit(r).objhit is xs[0].objhit
+    assert red.occluded(r, 10) is xs[0].objhit
+    assert red.occluded(r, 7) is None
+
+    r = rt.Ray(rt.Point(10, 1, -20), rt.Vector(0, 0, 1))
+    hit = blue.closest_hit(r)
+    assert math.isclose(hit.t, 10 - math.sqrt(3))
+    assert hit.objhit.material.color == rt.Color(0, 0, 1)
+    assert hit.objhit.normal_at(r.at(hit.t), hit) == rt.normalize(rt.Vector(0, 1, -math.sqrt(3)))
+    assert not red.includes(hit.objhit)
+
+
 def rtunittest_intersectionuv1():
     # An intersection can encapsulate 'u' and 'v'
     s = rt.Triangle(rt.Point(0, 1, 0), rt.Point(-1, 0, 0), rt.Point(1, 0, 0))
@@ -2765,6 +3366,151 @@ def rtunittest_bvh10():
     assert len(right.children[1].children) == 1
 
 
+def rtunittest_bvh11():
+    # Fred test: SAH subdivision puts every finite child into a subgroup, leaves infinite ones in the parent,
+    # and does not change what a ray hits
+    g = rt.ObjectGroup()
+    spheres = []
+    for i in range(8):
+        s = rt.Sphere()
+        s.transform = rt.translation(i * 3, 0, 0)
+        spheres.append(s)
+        g.addchild(s)
+    p = rt.Plane()
+    p.transform = rt.translation(0, -1, 0)
+    g.addchild(p)
+
+    r = rt.Ray(rt.Point(-5, 0, 0), rt.Vector(1, 0, 0))
+    before = [(i.t, i.objhit) for i in g.intersect(r)]
+    g.divide_sah(2)
+    assert p in g.children
+    for s in spheres:
+        assert s not in g.children
+        assert s.parent is not g and g.includes(s)
+    after = [(i.t, i.objhit) for i in g.intersect(r)]
+    assert sorted(before, key=lambda x: x[0]) == sorted(after, key=lambda x: x[0])
+
+
+def rtunittest_bvh12():
+    # Fred test: a child that straddles the middle of the group, which divide() leaves in the parent,
+    # is still assigned by the SAH split
+    s1 = rt.Sphere()
+    s1.transform = rt.translation(-10, 0, 0)
+    s2 = rt.Sphere()
+    s2.transform = rt.translation(10, 0, 0)
+    s3 = rt.Sphere()
+    s3.transform = rt.translation(-8, 0, 0)
+    s4 = rt.Sphere()
+    s4.transform = rt.scaling(2, 2, 2)
+    g = rt.ObjectGroup()
+    for s in (s1, s2, s3, s4):
+        g.addchild(s)
+    flatnodes, flatdepth, flatcost = rt.bvh_stats(g)
+    assert flatnodes == 1 and flatdepth == 1
+    g.divide_sah(1)
+    assert s4 not in g.children
+    assert len(g.children) == 2
+    assert g.children[0].includes(s1) and g.children[0].includes(s3)
+    nodes, depth, cost = rt.bvh_stats(g)
+    assert nodes > 1 and depth > 1
+    assert cost < flatcost
+
+
+def rtunittest_bvh13():
+    # Fred test: the compiled hierarchy collapses groups with identity transforms, keeps transformed groups
+    # as primitives, and is rebuilt when a child is added below it
+    s1 = rt.Sphere()
+    inner = rt.ObjectGroup()
+    inner.addchild(s1)
+    s2 = rt.Sphere()
+    moved = rt.ObjectGroup(rt.translation(5, 0, 0))
+    moved.addchild(s2)
+    g = rt.ObjectGroup()
+    g.addchild(inner)
+    g.addchild(moved)
+
+    r = rt.Ray(rt.Point(-5, 0, 0), rt.Vector(1, 0, 0))
+    xs = g.intersect(r)
+    assert len(xs) == 4
+    assert g.linearbvh.nodecount() == 2
+    assert moved in g.linearbvh.prims and inner not in g.linearbvh.prims
+
+    s3 = rt.Sphere()
+    s3.transform = rt.translation(10, 0, 0)
+    inner.addchild(s3)
+    assert g.linearbvh is None
+    xs = g.intersect(r)
+    assert len(xs) == 6
+    assert sorted(x.t for x in xs)[-1] == 16
+
+
+def rtunittest_bvh14():
+    # Fred test: a world with enough finite objects puts them in a hierarchy and keeps planes in a list that is
+    # always tested, and rebuilds both when an object is appended
+    w = rt.World()
+    floor = rt.Plane()
+    floor.transform = rt.translation(0, -1, 0)
+    w.objects.append(floor)
+    for i in range(10):
+        s = rt.Sphere()
+        s.transform = rt.translation(3 * i, 0, 0)
+        w.objects.append(s)
+
+    r = rt.Ray(rt.Point(-5, 0, 0), rt.Vector(1, 0, 0))
+    xs = w.intersect(r)
+    assert len(xs) == 20
+    assert w.toplevel is not None and w.unbounded == [floor]
+    assert len(w.toplevel.prims) == 10
+    assert w.closest_hit(r).t == 4
+    down = rt.Ray(rt.Point(100, 5, 0), rt.Vector(0, -1, 0))
+    assert w.closest_hit(down).objhit is floor
+    assert w.occluded(down, 10) is floor
+
+    s = rt.Sphere()
+    s.transform = rt.translation(100, 0, 0)
+    w.objects.append(s)
+    assert w.closest_hit(down).objhit is s
+    assert len(w.toplevel.prims) == 11
+
+
+def rtunittest_bvh15():
+    # Fred test: a group that was collapsed into its parent's compiled hierarchy while it had the identity
+    # transform is moved when its transform is set afterwards
+    s = rt.Sphere()
+    inner = rt.ObjectGroup()
+    inner.addchild(s)
+    g = rt.ObjectGroup()
+    g.addchild(inner)
+
+    r = rt.Ray(rt.Point(0, 0, -5), rt.Vector(0, 0, 1))
+    assert [x.t for x in g.intersect(r)] == [4, 6]
+    inner.transform = rt.translation(0, 0, 3)
+    assert g.linearbvh is None
+    assert [x.t for x in g.intersect(r)] == [7, 9]
+    assert g.closest_hit(r).t == 7
+
+
+def rtunittest_bvh16():
+    # Fred test: a world rebuilds its top level hierarchy when an object already in it is moved after a ray has
+    # been traced
+    w = rt.World()
+    ss = []
+    for i in range(10):
+        s = rt.Sphere()
+        s.transform = rt.translation(3 * i, 10, 0)
+        ss.append(s)
+    w.objects.extend(ss)
+
+    r = rt.Ray(rt.Point(0, 0, -5), rt.Vector(0, 0, 1))
+    assert w.closest_hit(r) is None
+    built = w.toplevel
+    ss[5].transform = rt.identity4()
+    assert w.closest_hit(r).objhit is ss[5]
+    assert w.toplevel is not built
+    assert [x.t for x in w.intersect(r)] == [4, 6]
+    assert w.occluded(r, 10) is ss[5]
+
+
 def rtunittest_texturemap1():
     # Checker pattern in 2D
     black = rt.Color(0, 0, 0)
@@ -3087,6 +3833,143 @@ def rtunittest_texturemap16():
         assert color == test[2]
 
 
+def rtunittest_texturemap17():
+    # Fred test: binary PPMs read the same as ASCII ones, and a second load maps the binary cache
+    values, maxcolors = read_ppm('raytracer/test_ppm_files/read_pixel_data.ppm')
+    assert values.shape == (3, 4, 3) and maxcolors == 255
+    write_ppm_p6('test_texturemap17.ppm', values, maxcolors)
+    p6values, p6maxcolors = read_ppm('test_texturemap17.ppm')
+    assert p6maxcolors == 255
+    assert np.array_equal(values, p6values)
+
+    load_texture('test_texturemap17.ppm')
+    texture = load_texture('test_texturemap17.ppm')
+    os.remove('test_texturemap17.ppm')
+    assert isinstance(texture.values, np.memmap)
+    assert texture.pixel_at(0, 0) == rt.Color(1, 0.49804, 0)
+    assert texture.pixel_at(3, 2) == rt.Color(0.49804, 0.49804, 0.49804)
+
+
+def rtunittest_texturemap18():
+    # Fred test: the texture registry loads an image once, even under another name, and only drops textures
+    # nobody is using when it is over budget
+    filename = 'raytracer/test_ppm_files/test_checkers_pattern.ppm'
+    with open(filename, 'rb') as f:
+        data = f.read()
+    with open('test_texturemap18.ppm', 'wb') as f:
+        f.write(data)
+
+    registry = TextureRegistry(0)
+    t1 = registry.acquire(filename)
+    t2 = registry.acquire(filename)
+    t3 = registry.acquire('test_texturemap18.ppm')
+    os.remove('test_texturemap18.ppm')
+    assert t1 is t2 and t1 is t3
+    assert registry.loads == 2  # the copy had to be read to find out it was the same
+
+    for i in range(3):
+        registry.release(t1)
+    assert len(registry.textures) == 0  # budget of 0, and nothing uses it any more
+    assert registry.acquire(filename) is not t1
+    assert registry.loads == 3
+
+    pattern = rt.UVImagePattern(filename)
+    copied = deepcopy(pattern)
+    assert copied.texture is pattern.texture
+    # the copy is a user of the texture too, and lets go of it when it goes away
+    digest = pattern.texture.digest
+    users = TEXTUREREGISTRY.refcounts[digest]
+    del copied
+    assert TEXTUREREGISTRY.refcounts[digest] == users - 1
+
+
+def rtunittest_texturemap19():
+    # Fred test: textures get a mip pyramid, cached with the pixels, and sampling blends pixels and levels
+    write_ppm_p6('test_texturemap19.ppm', read_ppm('raytracer/test_ppm_files/read_pixel_data.ppm')[0])
+    load_texture('test_texturemap19.ppm')
+    texture = load_texture('test_texturemap19.ppm')
+    os.remove('test_texturemap19.ppm')
+    assert [level.shape for level in texture.levels] == [(3, 4, 3), (2, 2, 3), (1, 1, 3)]
+    assert isinstance(texture.levels[1], np.memmap)
+    values = texture.values.astype(np.float64)
+    assert np.array_equal(texture.levels[1][0, 0], np.rint(values[0:2, 0:2].mean(axis=(0, 1))))
+    # the odd last row is repeated before it is halved
+    assert np.array_equal(texture.levels[1][1, 1], np.rint(values[2, 2:4].mean(axis=0)))
+
+    assert texture.sample(3, 2, 0) == texture.pixel_at(3, 2)
+    r, g, b = (values[0, 0] + values[0, 1]) / 2 / 255
+    assert texture.sample(0.5, 0, 1) == rt.Color(r, g, b)
+    r, g, b = texture.levels[2][0, 0] / 255
+    assert texture.sample(1, 1, 100) == rt.Color(r, g, b)
+
+
+def rtunittest_texturemap20():
+    # Fred test: camera rays carry their pixel's footprint to the hit, and an image pattern seen from far away
+    # samples a smaller copy of the image
+    c = rt.Camera(201, 101, math.pi / 2)
+    r = c.ray_for_pixel(100, 50)
+    assert math.isclose(r.spread, c.pixel_size)
+    shape = rt.Plane()
+    i = rt.Intersection(shape, 10)
+    r = rt.Ray(rt.Point(0, 10, 0), rt.Vector(0, -1, 0), spread=0.01)
+    comps = prepare_computations(i, r, [i])
+    assert math.isclose(comps.footprint, 0.1)
+
+    pattern = rt.UVImagePattern('raytracer/test_ppm_files/test_checkers_pattern.ppm')
+    p = rt.Point(0, 0, 0)
+    assert pattern.filtered_color_at(p, p, p) == pattern.color_at(p)
+    # half the image away both ways is about 7 pixels, between the 5x5 and 3x3 levels
+    blurred = pattern.filtered_color_at(p, rt.Point(0.5, 0, 0), rt.Point(0, 0, 0.5))
+    assert blurred == pattern.texture.sample(0, 9, math.hypot(5, 5))
+    assert blurred != pattern.color_at(p)
+    pattern.transform = rt.scaling(100, 100, 100)
+    shape.material.pattern = pattern
+    light = rt.PointLight(rt.Point(0, 10, 0))
+    sharp = light.lighting(shape.material, shape, p, rt.Vector(0, 1, 0), rt.Vector(0, 1, 0))
+    assert light.lighting(shape.material, shape, p, rt.Vector(0, 1, 0), rt.Vector(0, 1, 0), 1.0, 0.001) == sharp
+
+
+def rtunittest_texturemap21():
+    # Fred test: the digest of a texture's pixels is cached with them, so loading from the cache does not hash them
+    write_ppm_p6('test_texturemap21.ppm', read_ppm('raytracer/test_ppm_files/read_pixel_data.ppm')[0])
+    first = load_texture('test_texturemap21.ppm')
+    digestfile = os.path.join(TEXTURECACHEDIR, cache_key('test_texturemap21.ppm') + '.digest')
+    with open(digestfile, 'w') as f:
+        f.write('cached')
+    second = load_texture('test_texturemap21.ppm')
+    os.remove('test_texturemap21.ppm')
+    assert first.digest == content_digest(first.values, first.maxcolors)
+    assert second.digest == 'cached'
+
+
+def rtunittest_texturemap22():
+    # Fred test: footprints only wrap around maps that do, are measured across the seams of a cube map, and the mip
+    # levels line up with the image by their pixel centers
+    filename = 'raytracer/test_ppm_files/test_checkers_pattern.ppm'
+    front = rt.UVImagePattern(filename, rt.cube_uv_front)
+    u, v = front.mapfn(rt.Point(-0.8, 0, 1))
+    assert math.isclose(front.footprint(u, v, [rt.Point(0.6, 0, 1)]), 0.7 * front.width)
+    sphere = rt.UVImagePattern(filename, rt.spherical_map)
+    u, v = sphere.mapfn(rt.Point(-0.01, 0, -1))
+    assert sphere.footprint(u, v, [rt.Point(0.01, 0, -1)]) < 1
+
+    cube = rt.CubeMap()
+    cube.leftpattern = cube.rightpattern = cube.backpattern = rt.UVImagePattern(filename, rt.cube_uv_left)
+    cube.uppattern = cube.downpattern = cube.leftpattern
+    cube.frontpattern = front
+    p = rt.Point(0.95, 0, 1)
+    edge = rt.Point(1, 0, 0.9)
+    assert rt.texturemap.fold_onto_face(FACEFRONT, p, edge) == rt.Point(0.8, 0, 1)
+    assert rt.texturemap.fold_onto_face(FACEFRONT, p, rt.Point(0, 0, -1)) is None
+    assert cube.filtered_color_at(p, edge) == front.filtered_color_at(p, rt.Point(0.8, 0, 1))
+
+    write_ppm_p6('test_texturemap22.ppm', read_ppm('raytracer/test_ppm_files/read_pixel_data.ppm')[0])
+    texture = load_texture('test_texturemap22.ppm')
+    os.remove('test_texturemap22.ppm')
+    # halfway between the first two pixels of the top row is the center of the first pixel of the next level
+    assert texture.bilinear_at(1, 0.5, 0) == tuple(texture.levels[1][0, 0].tolist())
+    assert texture.bilinear_at(0, 2, 1) == tuple(texture.values[1, 2].tolist())
+
 def rtunittest_randomvector1():
     # Fred test: ensure random_in_unit_disk creates vectors that have magnitude < 1.
     for i in range(10):
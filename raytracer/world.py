@@ -1,11 +1,35 @@
 import math
 import random
+from bisect import bisect_right
+from itertools import accumulate
+from operator import attrgetter
 import raytracer as rt
-from .objects import EPSILON, Volumetric
-from .rttuple import random_in_unit_sphere
+import numpy as np
+from .objects import EPSILON, Volumetric, geometry_generation
+from .bvh import BoxBVH
+from .matrices import is_affine
+from .lights import surface_color
+from .raypacket import RayPacket, PACKETMINRAYS
+from .rttuple import random_in_unit_sphere, point_from_floats, vector_from_floats
 from .perfcounters import increment_colortests, increment_objintersecttests, increment_objintersections, \
                         increment_reflectionrays, increment_refractionrays
 
+# sort key for lists of intersections; faster than a lambda
+intersection_t = attrgetter('t')
+
+# A World with at least this many finite objects puts them in a BoxBVH; below that, walking the hierarchy costs more
+# than testing each object.
+TOPLEVELMINOBJECTS = 8
+
+# Lights that could add no more than LIGHTCUTOFF (see Light.max_contribution()) to a channel of a point's color only
+# add their ambient light, and send no shadow rays.  The default is half a step of an 8 bit image, so a light culled
+# on its own cannot change a pixel.  When more than MANYLIGHTS lights are left, LIGHTPICKS of them are chosen at
+# random, each in proportion to what it could add, and weighted to make up for the ones left out.
+LIGHTCUTOFF = 0.5 / 255
+MANYLIGHTS = 16
+LIGHTPICKS = 4
+
+
 def objectcount_recurse(obj):
     # returns a tuple, number of group objects inside and number of other objects
     groups = 0
@@ -32,15 +56,101 @@ def objectcount_recurse(obj):
     return groups, objs, csgs
 
 
+def remembered_occluder(hit):
+    # the object a light should try first next time, given what blocked its last shadow ray, or None.  The members
+    # of a CSG only count as hit where the CSG says so, so the outermost CSG around hit is remembered instead.
+    # InstanceHits have no place in the hierarchy of their own, so they are not remembered at all.
+    if not isinstance(hit, rt.HittableObject):
+        return None
+    obj = hit.parent
+    while obj is not None:
+        if isinstance(obj, rt.CSG):
+            hit = obj
+        obj = obj.parent
+    return hit
+
+
+def parent_space(obj, r):
+    # r, which is in world space, in the space of obj's parent, using its flattened world matrix rather than
+    # walking down from the top
+    if obj.parent is None:
+        return r
+    return rt.do_transformray(obj.parent.world_inverse(), r)
+
+
 class World:
-    __slots__ = ['objects', 'lights', 'volumetric', 'tmax']
+    # The objects with finite bounds are put into a hierarchy (toplevel) the first time a ray is traced, and those
+    # without, like planes, into a list (unbounded) that every ray is tested against.  Both are rebuilt when objects
+    # is replaced or its length changes, and after any transform is set or child added to a group.
+    __slots__ = ['objects', 'lights', 'volumetric', 'tmax', 'toplevel', 'unbounded', 'builtobjects', 'builtcount',
+                 'builtgeneration', 'lastoccluders']
 
     def __init__(self, objects=None, lights=None, volumetric=None, tmax=50):
         self.objects = objects or []
         self.lights = lights or []
         self.volumetric = volumetric or Volumetric()
         self.tmax = tmax
-
+        self.invalidate()
+
+    def invalidate(self):
+        self.toplevel = None
+        self.unbounded = None
+        self.builtobjects = None
+        self.builtcount = 0
+        self.builtgeneration = None
+        # light -> the object that blocked its last shadow ray, see is_shadowed().  Only good for the objects and
+        # transforms the hierarchy was built from.
+        self.lastoccluders = {}
+
+    def build_toplevel(self):
+        finite = []
+        unbounded = []
+        boxes = []
+        for obj in self.objects:
+            box = obj.parent_space_bounds_of()
+            if box.is_finite():
+                finite.append(obj)
+                boxes.append(box.boxmin.arr[0:3] + box.boxmax.arr[0:3])
+            else:
+                unbounded.append(obj)
+        if len(finite) < TOPLEVELMINOBJECTS:
+            self.toplevel = None
+            self.unbounded = list(self.objects)
+        else:
+            boxes = np.array(boxes, dtype=np.float64)
+            self.toplevel = BoxBVH(boxes[:, 0:3], boxes[:, 3:6])
+            self.toplevel.prims = [finite[i] for i in self.toplevel.order.tolist()]
+            self.unbounded = unbounded
+        self.builtobjects = self.objects
+        self.builtcount = len(self.objects)
+        self.builtgeneration = geometry_generation()
+        self.lastoccluders = {}
+
+    def freeze(self):
+        # does the work that is otherwise left to the first ray, so that forked render processes share it
+        for obj in self.objects:
+            obj.freeze()
+        self.build_toplevel()
+
+    def check_toplevel(self):
+        if self.objects is not self.builtobjects or len(self.objects) != self.builtcount or \
+                self.builtgeneration != geometry_generation():
+            self.build_toplevel()
+
+    def objects_along(self, r, maxdist=None):
+        # generates the objects that r might hit: the unbounded ones, then those in the nodes of the hierarchy
+        # that r passes through no further than maxdist, or than r.tmax if maxdist is None (see
+        # LinearBVH.nodes_hit(), which reads it again for every node)
+        self.check_toplevel()
+        yield from self.unbounded
+        toplevel = self.toplevel
+        if toplevel is not None:
+            primstart = toplevel.primstart
+            primend = toplevel.primend
+            prims = toplevel.prims
+            for node in toplevel.nodes_hit(r, maxdist):
+                for i in range(primstart[node], primend[node]):
+                    yield prims[i]
 
     def objectcount(self):
         # returns a tuple - number of groups, and number of other objects
@@ -57,7 +167,7 @@ class World:
 
     def intersect(self, r, perfcount=False):
         res = []
-        for i in self.objects:
+        for i in self.objects_along(r, math.inf):
             if perfcount:
                 increment_objintersecttests()
             ints = i.intersect(r)
@@ -65,7 +175,7 @@ class World:
                 increment_objintersections(len(ints))
             res.extend(ints)
 
-        res.sort(key=lambda x: x.t)
+        res.sort(key=intersection_t)
         if self.volumetric.can_interact():
             # find first intersection with positive t, if there are any
             firstobj = None
@@ -82,35 +192,121 @@ class World:
                 res.append(rt.Intersection(self.volumetric.absorbed_particle, random.random() * testt))
             elif self.volumetric.is_scattered(testt):
                 res.append(rt.Intersection(self.volumetric.particle, random.random() * testt))
-            res.sort(key=lambda x: x.t)
+            res.sort(key=intersection_t)
         return res
 
-    def is_shadowed(self, point, light_position):
+    def occluded(self, r, maxdist):
+        # any-hit query: returns an object that casts a shadow and is hit by r with 0 < t < maxdist, or None.
+        # Stops at the first one found, so unlike intersect() nothing is collected or sorted.
+        for obj in self.objects_along(r, maxdist):
+            hit = obj.occluded(r, maxdist)
+            if hit is not None:
+                return hit
+        return None
+
+    def occluded_packet(self, packet):
+        # occluded() for every ray of a RayPacket at once; afterwards packet.blocked says which of them hit something
+        self.check_toplevel()
+        mask = np.ones(len(packet), dtype=bool)
+        for obj in self.unbounded:
+            obj.occluded_packet(packet, mask)
+        if self.toplevel is not None:
+            self.toplevel.occluded_packet(packet, mask)
+
+    def shadowed_from(self, point, light_positions, light=None):
+        # is_shadowed() for each of light_positions, as a list of bools.  Enough of them are traced as a RayPacket.
+        if len(light_positions) < PACKETMINRAYS:
+            return [self.is_shadowed(point, pos, light) for pos in light_positions]
+        packet = RayPacket.shadow_rays(point, light_positions)
+        self.check_toplevel()
+        # without a top level hierarchy the whole world costs a few tests of the packet, and trying the last
+        # occluder first mostly adds one more
+        lastoccluder = self.lastoccluders.get(light)
+        if lastoccluder is not None and self.toplevel is not None:
+            obj = lastoccluder
+            if obj.parent is None:
+                obj.occluded_packet(packet, ~packet.blocked)
+            elif is_affine(obj.parent.world_inverse()):
+                # otherwise it is left to the walk of the whole world below
+                obj.occluded_packet(packet.transformed(obj.parent.world_inverse()), ~packet.blocked)
+        self.occluded_packet(packet)
+        if light is not None:
+            for hit in reversed(packet.occluders):
+                if hit is not None:
+                    if hit is not lastoccluder:
+                        self.lastoccluders[light] = remembered_occluder(hit)
+                    break
+        shadowed = packet.blocked.tolist()
+        if self.volumetric.can_interact():
+            for k, distance in enumerate(packet.maxdist.tolist()):
+                if not shadowed[k]:
+                    shadowed[k] = self.volumetric.is_scattered(min(distance, self.tmax))
+        return shadowed
+
+    def is_shadowed(self, point, light_position, light=None):
+        # If light is given, the object that blocked its last shadow ray in this world is tried first, as
+        # neighbouring points tend to be shadowed by the same thing.  Render processes each have their own copy.
         v = light_position - point
         distance = v.magnitude()
         direction = rt.normalize(v)
 
         r = rt.Ray(point, direction)
-        xs = self.intersect(r)
-        for i in xs:
-            if i.t > 0 and i.objhit.casts_shadow:
-                # if the smallest positive hit from an object that casts a shadow is nearer to the light than
-                # the point, then the point is in shadow.
-                if i.t < distance:
-                    return True
-                else:
-                    return False
+        if light is not None:
+            # checked first, as rebuilding the hierarchy forgets the occluders
+            self.check_toplevel()
+            lastoccluder = self.lastoccluders.get(light)
+            if lastoccluder is not None and lastoccluder.occluded(parent_space(lastoccluder, r), distance) is not None:
+                return True
+            hit = self.occluded(r, distance)
+            if hit is not None:
+                if hit is not lastoccluder:
+                    self.lastoccluders[light] = remembered_occluder(hit)
+                return True
+        elif self.occluded(r, distance) is not None:
+            return True
+        if self.volumetric.can_interact():
+            # the light can still be scattered by the medium between the point and the light
+            return self.volumetric.is_scattered(min(distance, self.tmax))
         return False
 
+    def pick_lights(self, point, over_point, normalv, material=None, color=None):
+        # the weight to shade each light with at a point on a surface, or 0 for just its ambient light
+        estimates = [light.max_contribution(point, over_point, normalv, material, color) for light in self.lights]
+        live = [k for k, estimate in enumerate(estimates) if estimate > LIGHTCUTOFF]
+        weights = [0.0] * len(estimates)
+        if len(live) <= MANYLIGHTS:
+            for k in live:
+                weights[k] = 1.0
+            return weights
+        cumulative = list(accumulate(estimates[k] for k in live))
+        total = cumulative[-1]
+        if math.isinf(total):
+            # a light with no distance left to decay over outshines the rest
+            for k in live:
+                if math.isinf(estimates[k]):
+                    weights[k] = 1.0
+            return weights
+        for _ in range(LIGHTPICKS):
+            k = live[min(bisect_right(cumulative, random.random() * total), len(live) - 1)]
+            # chosen with probability estimate / total, out of LIGHTPICKS goes
+            weights[k] += total / (LIGHTPICKS * estimates[k])
+        return weights
+
     def shade_hit(self, hitrecord, depth, perfcount=False):
+        material = hitrecord.objhit.material
+        color = surface_color(material, hitrecord.objhit, hitrecord.point, hitrecord.eyev, hitrecord.normalv,
+                              hitrecord.footprint)
         surface = rt.Color(0, 0, 0)
-        for light in self.lights:
-            intensity_pct = light.intensity_at(self, hitrecord.over_point)
-            surface += light.lighting(hitrecord.objhit.material, hitrecord.objhit, hitrecord.point, hitrecord.eyev,
-                                      hitrecord.normalv, intensity_pct)
+        weights = self.pick_lights(hitrecord.point, hitrecord.over_point, hitrecord.normalv, material, color)
+        for light, weight in zip(self.lights, weights):
+            if weight == 0:
+                surface += color * light.intensity * material.ambient
+                continue
+            scale, directions = light.light_samples(self, hitrecord.point, hitrecord.over_point)
+            surface += light.shade(material, hitrecord.objhit, hitrecord.point, hitrecord.eyev, hitrecord.normalv,
+                                   scale * weight, directions, hitrecord.footprint, color)
         reflected = self.reflected_color(hitrecord, depth, perfcount)
         refracted = self.refracted_color(hitrecord, depth, perfcount)
-        material = hitrecord.objhit.material
         if material.reflective > 0 and material.transparency > 0:
             # TODO - in mpraytracer/materials.py line 92 - it only reflects if
             # it can't refract and the schlick is greater than a random number from 0-1.
@@ -128,7 +324,8 @@ class World:
         else:
             if perfcount:
                 increment_reflectionrays()
-            reflect_ray = rt.Ray(hitrecord.over_point, hitrecord.reflectv)
+            reflect_ray = rt.Ray(hitrecord.over_point, hitrecord.reflectv, width=hitrecord.footprint,
+                                 spread=hitrecord.spread)
             color = self.color_at(reflect_ray, depth-1, perfcount)
             return color * hitrecord.objhit.material.reflective
 
@@ -166,11 +363,39 @@ class World:
         if perfcount:
             increment_refractionrays()
 
-        refract_ray = rt.Ray(hitrecord.under_point, direction)
+        refract_ray = rt.Ray(hitrecord.under_point, direction, width=hitrecord.footprint, spread=hitrecord.spread)
 
         return self.color_at(refract_ray, depth-1, perfcount) * hitrecord.objhit.material.transparency
 
+    def closest_hit(self, r, perfcount=False):
+        # returns the nearest intersection with r.tmin < t < r.tmax, or None.  Objects are only searched up to the
+        # nearest hit found so far.
+        work = rt.Ray(r.origin, r.direction, r.tmin, r.tmax)
+        best = None
+        for obj in self.objects_along(work):
+            if perfcount:
+                increment_objintersecttests()
+            hit = obj.closest_hit(work)
+            if hit is not None:
+                if perfcount:
+                    increment_objintersections(1)
+                best = hit
+                work.tmax = hit.t
+        return best
+
     def color_at(self, ray, depth, perfcount=False):
+        if not self.volumetric.can_interact():
+            hit = self.closest_hit(ray, perfcount)
+            if hit is None:
+                return self.background_color(ray)
+            if hit.objhit.material.transparency == 0:
+                # n1 and n2 are only used for refraction, so the sorted list of every intersection along the ray
+                # is not needed
+                hitrecord = prepare_computations(hit, ray, [hit])
+                if perfcount:
+                    increment_colortests()
+                return self.shade_hit(hitrecord, depth, perfcount)
+
         xs = self.intersect(ray, perfcount)
         for i in xs:
             if i.t > 0:
@@ -200,9 +425,10 @@ class WorldWithSky(World):
 
 class HitRecord:
     __slots__ = ['t', 'objhit', 'point', 'inside', 'eyev', 'normalv', 'reflectv', 'over_point',
-                 'under_point', 'n1', 'n2']
+                 'under_point', 'n1', 'n2', 'footprint', 'spread']
 
-    def __init__(self, t, objhit, point, inside, eyev, normalv, reflectv, over_point, under_point, n1, n2):
+    def __init__(self, t, objhit, point, inside, eyev, normalv, reflectv, over_point, under_point, n1, n2,
+                 footprint=0.0, spread=0.0):
         self.t = t
         self.objhit = objhit
         self.point = point
@@ -214,6 +440,9 @@ class HitRecord:
         self.under_point = under_point
         self.n1 = n1
         self.n2 = n2
+        # width of the ray's beam where it hit, and how fast it grows; see Ray
+        self.footprint = footprint
+        self.spread = spread
 
 
 def prepare_computations(i, r, xs):
@@ -242,21 +471,38 @@ def prepare_computations(i, r, xs):
                 n2 = containers[-1].material.refractive_index
             break
 
-    point = r.at(i.t)
-    eyev = -r.direction
+    # the vector math below is done on floats, and each tuple is allocated once.
+    t = i.t
+    ro = r.origin.arr
+    rd = r.direction.arr
+    dx = rd[0]
+    dy = rd[1]
+    dz = rd[2]
+    px = ro[0] + dx * t
+    py = ro[1] + dy * t
+    pz = ro[2] + dz * t
+    point = point_from_floats(px, py, pz)
+    eyev = vector_from_floats(-dx, -dy, -dz)
     normalv = i.objhit.normal_at(point, i)
     if i.objhit.material.fuzz > 0:
         normalv = rt.normalize(normalv + (random_in_unit_sphere() * i.objhit.material.fuzz))
-    if rt.dot(normalv, eyev) < 0:
+    nx, ny, nz = normalv.arr[0:3]
+    if nx * dx + ny * dy + nz * dz > 0:
+        # the normal points away from the eye
         inside = True
-        normalv = -normalv
+        nx = -nx
+        ny = -ny
+        nz = -nz
     else:
         inside = False
-    over_point = point + (normalv * EPSILON)
-    under_point = point - (normalv * EPSILON)
-    reflectv = rt.reflect(r.direction, normalv)
-
-    return HitRecord(i.t, i.objhit, point, inside, eyev, normalv, reflectv, over_point, under_point, n1, n2)
+    normalv = vector_from_floats(nx, ny, nz)
+    over_point = point_from_floats(px + nx * EPSILON, py + ny * EPSILON, pz + nz * EPSILON)
+    under_point = point_from_floats(px - nx * EPSILON, py - ny * EPSILON, pz - nz * EPSILON)
+    twodot = 2 * (dx * nx + dy * ny + dz * nz)
+    reflectv = vector_from_floats(dx - nx * twodot, dy - ny * twodot, dz - nz * twodot)
+
+    return HitRecord(t, i.objhit, point, inside, eyev, normalv, reflectv, over_point, under_point, n1, n2,
+                     r.width + t * r.spread, r.spread)
 
 
 def schlick_reflectance(hitrecord):
@@ -28,10 +28,10 @@ def render():
         print('Intersection tests: {}'.format(rt.getcount_objintersecttests()))
         print('Intersections: {}'.format(rt.getcount_objintersections()))
         if ADAPTIVE:
-            maxv = rt.save_raycount(camera.hsize, camera.vsize, 'raycount.ppm')
+            maxv = rt.save_raycount(camera.hsize, camera.vsize, 'raycount.png')
             print('Max rays per pixel: {}'.format(maxv))
 
-    rt.canvas_to_ppm('lamp_demo.ppm')
+    rt.canvas_to_file('lamp_demo.png')
 
 
 if __name__ == '__main__':